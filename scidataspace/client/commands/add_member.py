@@ -18,6 +18,18 @@ def cmd_count_files(process):
             print "   > ", member_name," with id ", member_id
     return cnt_files
 
+###
+##  yields member dicts for a folder and everything below it, so large
+##  trees can be streamed to the server without building a list
+###
+def iter_dir_members(folder):
+    yield dict(data_type="directory", data_uri=os.path.join(folder))
+    for dirname, dirnames, filenames in os.walk(folder):
+        for subdirname in dirnames:
+            yield dict(data_type="directory", data_uri=os.path.join(dirname, subdirname))
+        for filename in filenames:
+            yield dict(data_type="file", data_uri=os.path.join(dirname, filename))
+
 #######################################
 #   Parse add_member
 #######################################
@@ -43,17 +55,14 @@ def parse_cmd_add_member(cmd_splitted,catalog_id, geounit_id, datasetClient, db)
     # add members from folder
     elif os.path.isdir(cmd_2):
 
-        members_list = [dict(data_type="directory", data_uri=os.path.join(cmd_2))]
-        for dirname, dirnames, filenames in os.walk(cmd_2):
-            for subdirname in dirnames:
-                members_list.append(dict(data_type="directory", data_uri=os.path.join(dirname, subdirname)))
-            for filename in filenames:
-                members_list.append(dict(data_type="file", data_uri=os.path.join(dirname, filename)))
-
-        print "adding:",str(members_list)
-        _, members = datasetClient.create_members(catalog_id,geounit_id,members_list)
-        print members
-        #print members.get('code','Error')
+        print "adding:",cmd_2
+        result = datasetClient.create_members_bulk(catalog_id,geounit_id,iter_dir_members(cmd_2))
+        for member, member_id, error in result:
+            if error is None:
+                db.Put("member."+member['data_uri'], str(member_id))
+            else:
+                print "cannot add member "+member['data_uri']+": "+str(error)
+        print "added %d of %d members" % (len(result)-len(result.errors), len(result))
 
     # add_member something
     else:
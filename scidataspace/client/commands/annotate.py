@@ -1,28 +1,32 @@
 from scidataspace.client.commands.util import UNDEFINED
 from scidataspace.client.commands.util import is_geounit_selected
+from globusonline.catalog.client.annotation_defs import AnnotationDefCache
+
+def print_result(write):
+    if write.error is not None:
+        print "failed to add", write.annotations, ":", write.error
+    else:
+        print write.response['code']
 
 #######################################
 #   Parse annotation
 #######################################
-def parse_cmd_annotate(cmd_splitted, catalog_id, geounit_id, datasetClient, db):
+def parse_cmd_annotate(cmd_splitted, catalog_id, geounit_id, datasetClient, db, annotation_defs=None):
     if  not is_geounit_selected(geounit_id): return
+    if annotation_defs is None:
+        annotation_defs = AnnotationDefCache(datasetClient)
 
     cmd_2 = cmd_splitted.get(1,"")
 
     # annotate geounit
     if cmd_2 == "geounit":
-        for geo_prop_value in cmd_splitted[2:]:
-            # print "xxx: ",geo_prop_value
-            geo_property, geo_value = geo_prop_value.split(':')
-
-            #creates a annotation definition; type="text, multivalue=True
-            try:
-                _, _ = datasetClient.create_annotation_def(catalog_id,geo_property,"text",True)
-            except:
-                print "annotation definition already exists"
-                pass
-            _, annotation = datasetClient.add_dataset_annotations(catalog_id,geounit_id, {geo_property: geo_value})
-            print annotation['code']
+        # one request for all the pairs, flushed when leaving the block
+        pairs = [geo_prop_value.split(':') for geo_prop_value in cmd_splitted[2:]]
+        #creates the missing annotation definitions; type="text, multivalue=True
+        annotation_defs.ensure(catalog_id, [p for (p, v) in pairs], "text", True)
+        with datasetClient.annotation_buffer(on_result=print_result) as buf:
+            for geo_property, geo_value in pairs:
+                buf.add(catalog_id, geounit_id, {geo_property: geo_value})
 
     # annotate member
     elif cmd_2 == "member":
@@ -31,17 +35,11 @@ def parse_cmd_annotate(cmd_splitted, catalog_id, geounit_id, datasetClient, db):
             member_ids = [v for (k, v) in db.RangeIter(key_from='member.'+member_name, key_to='member.'+member_name+'zzz')]
             if len(member_ids) != 0:
                 member_id=member_ids[0]
-                for member_prop_value in cmd_splitted[3:]:
-                    member_annotation_name, member_annotation_value = member_prop_value.split(':')
-
-                    try:
-                        _, annotation_def = datasetClient.create_annotation_def(catalog_id,member_annotation_name,"text",True)
-                    except:
-                        # print "annotation definition already exists"
-                        pass
-                    r, annotation = datasetClient.add_member_annotations(catalog_id,geounit_id, member_id,
-                                                                        {member_annotation_name: member_annotation_value})
-                    print annotation['code']
+                pairs = [member_prop_value.split(':') for member_prop_value in cmd_splitted[3:]]
+                annotation_defs.ensure(catalog_id, [n for (n, v) in pairs], "text", True)
+                with datasetClient.annotation_buffer(on_result=print_result) as buf:
+                    for member_annotation_name, member_annotation_value in pairs:
+                        buf.add(catalog_id, geounit_id, {member_annotation_name: member_annotation_value}, member_id=member_id)
                 print "ok"
             else:
                 print "could not find member "+member_name
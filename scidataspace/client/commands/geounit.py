@@ -3,19 +3,29 @@ from scidataspace.client.commands.util import UNDEFINED
 #######################################
 #   Parse geounit command
 #   returns  (geounit_name, geounit_id, err_message)
+#   With a catalog mirror the name is looked up locally, and the
+#   mirror is synced before creating a geounit it does not know
 #######################################
-def parse_cmd_geounit(cmd_splitted, catalog_id, geounit_id, datasetClient):
+def parse_cmd_geounit(cmd_splitted, catalog_id, geounit_id, datasetClient, mirror=None):
     cmd_2 = cmd_splitted.get(1,"")
     if cmd_2 == "start":
         geounit_name = cmd_splitted.get(2,UNDEFINED)
         if geounit_name != UNDEFINED:
             geounit_name = geounit_name
 
-            r, datasets = datasetClient.get_datasets(catalog_id)
-            filtered_datasets = [x for x in datasets if x['name']==geounit_name]
+            if mirror is not None:
+                filtered_datasets = mirror.find_datasets(catalog_id, geounit_name)
+                if len(filtered_datasets)<1:
+                    mirror.sync(datasetClient, catalog_id)
+                    filtered_datasets = mirror.find_datasets(catalog_id, geounit_name)
+            else:
+                datasets = datasetClient.iter_datasets(catalog_id, projection_list=['name'])
+                filtered_datasets = [x for x in datasets if x['name']==geounit_name]
             if len(filtered_datasets)<1:
                 r, data = datasetClient.create_dataset(catalog_id,dict(name=geounit_name))
                 geounit_id = data['id']
+                if mirror is not None:
+                    mirror.put_dataset(catalog_id, dict(data, name=geounit_name))
             elif len(filtered_datasets)== 1:
                 geounit_id = filtered_datasets[0]['id']
             else:
@@ -12,6 +12,12 @@ import configparser
 
 from leveldb import LevelDB, LevelDBError
 from globusonline.catalog.client.dataset_client import DatasetClient
+from globusonline.catalog.client.http_cache import ResponseCache
+from globusonline.catalog.client.instrumentation import LatencyCollector
+from globusonline.catalog.client.circuit_breaker import CircuitBreaker
+from globusonline.catalog.client.cassette import options_from_environ
+from globusonline.catalog.client.annotation_defs import AnnotationDefCache
+from globusonline.catalog.client.mirror import CatalogMirror
 from globusonline.catalog.client.goauth import get_access_token
 from scidataspace.client.completer import BufferAwareCompleter
 from scidataspace.client.query_dataset_client import get_catalogs, get_catalog_by_name, get_last_datasets
@@ -132,8 +138,17 @@ if __name__ == '__main__':
     # Read configuration file
     cfg = GDConfig()
     
-    ## Init a datasetclient
-    datasetClient = DatasetClient(cfg.config['Default']['goauth-token'],cfg.config['Default']['URL'])
+    ## Init a datasetclient; catalog listings are revalidated against a local http cache
+    ## GDCLIENT_RECORD=file records the session to a cassette, GDCLIENT_REPLAY=file replays one
+    http_cache = ResponseCache(directory=os.path.join(dot_gdclient_folder,"http_cache"))
+    datasetClient = DatasetClient(cfg.config['Default']['goauth-token'],cfg.config['Default']['URL'],cache=http_cache,circuit_breaker=CircuitBreaker(),
+                                  **options_from_environ())
+    ## Annotation definitions are listed once per catalog and kept for a while, so
+    ## annotating only creates the missing ones
+    annotation_defs = AnnotationDefCache(datasetClient, directory=os.path.join(dot_gdclient_folder,"annotation_defs"))
+    ## Collect per-endpoint latencies, shown by the "--stats" command
+    request_stats = LatencyCollector()
+    datasetClient.add_listener(request_stats)
     
     ## If datasetclient is not None then connection between client and server established.
     if datasetClient is None:
@@ -143,9 +158,6 @@ if __name__ == '__main__':
     mycatalog_id = cfg.gd_init_catalog(datasetClient)
     #print "mycatalog_id=",mycatalog_id
 
-    dataset_list = get_last_datasets(datasetClient,mycatalog_id)
-    dataset_dict = {key:{} for key in dataset_list}
-
     ## check if the LevelDB local database and histfile exists; if not create; if yes re-use	
     ## LevelDB local database
 
@@ -165,6 +177,18 @@ if __name__ == '__main__':
         print("cannot open db from "+levelDB_local_database)
         exit(1)
 
+    ## The catalog is mirrored in the LevelDB database: after the first start only the
+    ## datasets created since the last sync are fetched, and geounit names and completions
+    ## are looked up locally. The "--sync full" command reconciles deletions right away.
+    mirror = CatalogMirror(db)
+    try:
+        mirror.sync(datasetClient, mycatalog_id)
+    except Exception as e:
+        print "could not sync the local catalog mirror:", e
+
+    dataset_list = get_last_datasets(datasetClient,mycatalog_id,mirror=mirror)
+    dataset_dict = {key:{} for key in dataset_list}
+
     print ('enter "stop" to end session')
     completer_suggestions = {
         'geounit':{'start':dataset_dict, 'delete':{}},
@@ -184,6 +208,8 @@ if __name__ == '__main__':
                           },
                      'member':{}
                      },
+        'stats':{'reset':{}},
+        'sync':{'full':{}},
         'stop':{}
     }
     gd_client_special_string = '--'
@@ -207,7 +233,7 @@ if __name__ == '__main__':
         if first_command.upper() in ['--STOP','X']:
             break
         elif first_command == "--geounit":
-            geounit_name, geounit_id, err_message = parse_cmd_geounit(cmd_splitted, mycatalog_id, geounit_id, datasetClient)
+            geounit_name, geounit_id, err_message = parse_cmd_geounit(cmd_splitted, mycatalog_id, geounit_id, datasetClient, mirror)
             if err_message != "":
                 print err_message
 
@@ -224,8 +250,25 @@ if __name__ == '__main__':
             if new_image_id:
                 docker_image_id = new_image_id
 
-        elif first_command in ["--annotate", "--add_member"]:
-            locals()["parse_cmd_"+first_command[2:]](cmd_splitted, mycatalog_id, geounit_id, datasetClient, db)
+        elif first_command == "--annotate":
+            parse_cmd_annotate(cmd_splitted, mycatalog_id, geounit_id, datasetClient, db, annotation_defs)
+
+        elif first_command == "--add_member":
+            parse_cmd_add_member(cmd_splitted, mycatalog_id, geounit_id, datasetClient, db)
+
+        elif first_command == "--stats":
+            if cmd_splitted.get(1,"") == "reset":
+                request_stats.reset()
+            else:
+                print request_stats.format_report()
+
+        elif first_command == "--sync":
+            try:
+                result = mirror.sync(datasetClient, mycatalog_id, full=cmd_splitted.get(1,"") == "full" or None)
+            except Exception as e:
+                print "could not sync the local catalog mirror:", e
+            else:
+                print "%d datasets updated, %d deleted" % (result.datasets, result.deleted)
 
         elif first_command == "cd":
             try:
@@ -0,0 +1,208 @@
+"""
+Write-behind buffering of annotation writes.
+
+The annotation endpoints accept any number of annotations in one POST, but
+callers tend to add them one property at a time. AnnotationBuffer collects
+the writes per target (a dataset, or a member of one), merges them and
+sends one request per target when flushed:
+
+    with client.annotation_buffer(max_items=200) as buf:
+        for name, value in pairs:
+            buf.add(catalog_id, dataset_id, {name: value})
+    # all writes have been sent here; buf.errors lists the failed ones
+
+A flush happens once max_items annotations are pending, max_delay seconds
+after the first pending write (if set), on flush() or close(), and at
+interpreter exit. Writes to the same target that set an annotation
+already pending in the merged request go into a second request instead,
+so multivalued annotations keep every value and the server sees the
+writes in their original order.
+"""
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_ITEMS = 100
+
+_log = logging.getLogger("globusonline.catalog.annotation_buffer")
+
+# Buffers with pending writes, flushed at exit. A buffer is only held here
+# until it is flushed, so buffers that are done with can be collected.
+_unflushed = set()
+_unflushed_lock = threading.Lock()
+
+
+def _flush_all_at_exit():
+    with _unflushed_lock:
+        buffers = list(_unflushed)
+    for buf in buffers:
+        buf._flush_at_exit()
+
+atexit.register(_flush_all_at_exit)
+
+
+class AnnotationWrite(object):
+    """
+    One buffered write, as returned by AnnotationBuffer.add. Once flushed,
+    done is True and either response holds the response body of the merged
+    request, or error the exception it raised.
+    """
+    def __init__(self, catalog_id, dataset_id, member_id, annotations):
+        self.catalog_id = catalog_id
+        self.dataset_id = dataset_id
+        self.member_id = member_id
+        self.annotations = annotations
+        self.done = False
+        self.response = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.done and self.error is None
+
+    def __repr__(self):
+        return ("AnnotationWrite(catalog=%s, dataset=%s, member=%s, %r, "
+                "done=%s, error=%r)" % (self.catalog_id, self.dataset_id,
+                                        self.member_id, self.annotations,
+                                        self.done, self.error))
+
+
+class _Request(object):
+    """Merged annotations of one or more writes to the same target."""
+    def __init__(self):
+        self.annotations = {}
+        self.writes = []
+
+
+class AnnotationBuffer(object):
+    """
+    @param client: DatasetClient to send the writes with
+    @param max_items: flush once this many annotations are pending
+    @param max_delay: flush at most this many seconds after a write was
+                      added; None to only flush on size, explicitly and at
+                      exit
+    @param on_result: called with each AnnotationWrite once it is done
+    """
+    def __init__(self, client, max_items=DEFAULT_MAX_ITEMS, max_delay=None,
+                 on_result=None):
+        self.client = client
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.on_result = on_result
+
+        self._lock = threading.Lock()
+        # Serializes flushes, so requests to a target go out in order.
+        self._flush_lock = threading.Lock()
+        # (catalog_id, dataset_id, member_id) -> list of _Request
+        self._pending = OrderedDict()
+        self._pending_items = 0
+        self._timer = None
+
+        self.errors = []
+        self.request_count = 0
+        self.write_count = 0
+
+    def add(self, catalog_id, dataset_id, annotations, member_id=None):
+        """Queue annotations (a dictionary of name to value) for a dataset,
+        or for one of its members if member_id is given.
+
+        @return: AnnotationWrite reporting the outcome once flushed
+        """
+        write = AnnotationWrite(catalog_id, dataset_id, member_id,
+                                dict(annotations))
+        target = (catalog_id, dataset_id, member_id)
+        with self._lock:
+            requests = self._pending.setdefault(target, [])
+            if (not requests
+            or any(name in requests[-1].annotations
+                   for name in write.annotations)):
+                requests.append(_Request())
+            request = requests[-1]
+            request.annotations.update(write.annotations)
+            request.writes.append(write)
+            self._pending_items += len(write.annotations)
+            self.write_count += 1
+            with _unflushed_lock:
+                _unflushed.add(self)
+            full = self._pending_items >= self.max_items
+            if (not full and self.max_delay is not None
+            and self._timer is None):
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+        return write
+
+    @property
+    def pending_count(self):
+        """Number of annotations waiting to be sent."""
+        return self._pending_items
+
+    def flush(self):
+        """Send all pending writes, one request per target (more if a
+        target has conflicting writes).
+
+        @return: list of the AnnotationWrites flushed
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = OrderedDict()
+                self._pending_items = 0
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                with _unflushed_lock:
+                    _unflushed.discard(self)
+            flushed = []
+            for target, requests in pending.iteritems():
+                for request in requests:
+                    self._send(target, request)
+                    flushed.extend(request.writes)
+            return flushed
+
+    def _send(self, target, request):
+        catalog_id, dataset_id, member_id = target
+        self.request_count += 1
+        response = error = None
+        try:
+            if member_id is None:
+                _, response = self.client.add_dataset_annotations(
+                    catalog_id, dataset_id, request.annotations)
+            else:
+                _, response = self.client.add_member_annotations(
+                    catalog_id, dataset_id, member_id, request.annotations)
+        except Exception as e:
+            error = e
+            _log.warning("Annotation write to catalog %s dataset %s "
+                         "member %s failed: %s", catalog_id, dataset_id,
+                         member_id, e)
+        for write in request.writes:
+            write.done = True
+            write.response = response
+            write.error = error
+            if error is not None:
+                self.errors.append(write)
+            if self.on_result is not None:
+                try:
+                    self.on_result(write)
+                except Exception:
+                    _log.exception("Annotation result callback failed")
+
+    def close(self):
+        """Flush the pending writes."""
+        return self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _flush_at_exit(self):
+        if self._pending_items:
+            _log.info("Flushing %d buffered annotations at exit",
+                      self._pending_items)
+            self.flush()
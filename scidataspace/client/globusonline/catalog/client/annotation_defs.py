@@ -0,0 +1,215 @@
+"""
+Cache of the annotation definitions of catalogs.
+
+Annotating needs the annotation to be defined first. Rather than listing
+all definitions, or trying to create each one and ignoring the "already
+exists" error, on every command, an AnnotationDefCache loads the
+definitions of a catalog once and keeps them for ttl seconds:
+
+    defs = AnnotationDefCache(client, directory=default_directory())
+    defs.ensure(catalog_id, ["fluid", "pressure"])
+
+Definitions created through ensure() or create() are added to the cache
+right away, so only the ones that are missing cost a request. With a
+directory the definitions are also written there, one file per catalog,
+so they survive between runs of short-lived processes like the CLI.
+
+Definitions created or deleted by others are only seen once the entry has
+expired; a create that fails because the definition already exists
+reloads the catalog instead of failing.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+from globusonline.catalog.client.rest_client import RestClientError
+
+DEFAULT_TTL = 300.0
+DEFAULT_VALUE_TYPE = "text"
+
+
+def default_directory():
+    return os.path.join(os.path.expanduser("~"), ".gdclient",
+                        "annotation_defs")
+
+
+def _def_record(annotation_def):
+    """
+    >>> sorted(_def_record(dict(name="a", value_type="int8", owner="x")).items())
+    [('multivalued', False), ('name', 'a'), ('value_type', 'int8')]
+    """
+    return dict(name=annotation_def["name"],
+                value_type=annotation_def.get("value_type"),
+                multivalued=bool(annotation_def.get("multivalued")))
+
+
+class AnnotationDefCache(object):
+    """
+    Thread-safe cache of the annotation definitions of catalogs, as
+    dictionaries of name, value_type and multivalued, keyed by name.
+
+    @param client: DatasetClient used to list and create definitions
+    @param directory: where to keep the definitions between runs, or None
+                      to keep them in memory only
+    @param ttl: seconds after which the definitions of a catalog are
+                listed again
+    """
+    def __init__(self, client, directory=None, ttl=DEFAULT_TTL):
+        self.client = client
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # catalog key -> (load time, {name: def})
+        self._entries = {}
+
+        self.load_count = 0
+
+    def _key(self, catalog_id):
+        return "%s %s" % (self.client.base_url, catalog_id)
+
+    def get(self, catalog_id):
+        """@return: dictionary of annotation name -> definition"""
+        key = self._key(catalog_id)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and self.directory is not None:
+            entry = self._read(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            entry = self._load(catalog_id)
+        return dict(entry[1])
+
+    def _load(self, catalog_id):
+        _, defs = self.client.get_annotation_defs(catalog_id)
+        entry = (time.time(), dict((d["name"], _def_record(d))
+                                   for d in defs))
+        self.load_count += 1
+        self._store(self._key(catalog_id), entry)
+        return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+        if self.directory is not None:
+            self._write(key, entry)
+
+    def _update(self, catalog_id, fn):
+        key = self._key(catalog_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            defs = dict(entry[1])
+            fn(defs)
+            entry = (entry[0], defs)
+        self._store(key, entry)
+
+    def missing(self, catalog_id, names):
+        """@return: the names that are not defined, in the order given"""
+        defs = self.get(catalog_id)
+        return [name for name in _unique(names) if name not in defs]
+
+    def create(self, catalog_id, annotation_name,
+               value_type=DEFAULT_VALUE_TYPE, multivalued=False):
+        """Define an annotation and add it to the cache. Raises the
+        RestClientError if the server refuses, also if it exists already.
+
+        @return: the definition
+        """
+        _, created = self.client.create_annotation_def(
+            catalog_id, annotation_name, value_type, multivalued)
+        if not isinstance(created, dict) or "name" not in created:
+            created = dict(name=annotation_name, value_type=value_type,
+                           multivalued=multivalued)
+        annotation_def = _def_record(created)
+        self._update(catalog_id,
+                     lambda defs: defs.__setitem__(annotation_name,
+                                                   annotation_def))
+        return annotation_def
+
+    def ensure(self, catalog_id, names, value_type=DEFAULT_VALUE_TYPE,
+               multivalued=True):
+        """Define the annotations in names that are not defined yet, with
+        the given value_type and multivalued.
+
+        @return: list of the names that were created
+        """
+        created = []
+        for name in self.missing(catalog_id, names):
+            try:
+                self.create(catalog_id, name, value_type, multivalued)
+            except RestClientError as e:
+                if e.response.status != 409:
+                    raise
+                # Defined by someone else since we loaded the catalog.
+                self.invalidate(catalog_id)
+                if name not in self.get(catalog_id):
+                    raise
+            else:
+                created.append(name)
+        return created
+
+    def remove(self, catalog_id, annotation_name):
+        """Drop a definition that was deleted on the server."""
+        self._update(catalog_id,
+                     lambda defs: defs.pop(annotation_name, None))
+
+    def invalidate(self, catalog_id):
+        """Forget the definitions of a catalog; the next use lists them."""
+        key = self._key(catalog_id)
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.directory is not None:
+            try:
+                os.remove(self._filename(key))
+            except OSError:
+                pass
+
+    def _filename(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def _read(self, key):
+        try:
+            with open(self._filename(key), "rb") as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get("key") != key:
+            return None
+        entry = (data["time"], dict((d["name"], _def_record(d))
+                                    for d in data["defs"]))
+        with self._lock:
+            self._entries.setdefault(key, entry)
+        return entry
+
+    def _write(self, key, entry):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        data = dict(key=key, time=entry[0],
+                    defs=sorted(entry[1].values(), key=lambda d: d["name"]))
+        filename = self._filename(key)
+        tmp_filename = "%s.tmp%d" % (filename,
+                                     threading.current_thread().ident)
+        try:
+            with open(tmp_filename, "wb") as f:
+                json.dump(data, f)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+
+
+def _unique(names):
+    """
+    >>> _unique(["b", "a", "b"])
+    ['b', 'a']
+    """
+    seen = set()
+    return [n for n in names if not (n in seen or seen.add(n))]
@@ -0,0 +1,130 @@
+"""
+Concurrent variant of the Dataset REST API client.
+
+AsyncDatasetClient has the same methods as DatasetClient, but each call is
+queued to a bounded pool of worker threads and returns immediately with a
+multiprocessing.pool.AsyncResult; get() on it returns the usual
+(response, body) RestResult or raises the RestClientError. The workers
+share one DatasetClient, so URLs are built by exactly the same code, and
+its connection pool is sized to the concurrency limit, which bounds the
+number of requests in flight to the catalog host.
+
+    client = AsyncDatasetClient(token, base_url, concurrency=16)
+    results = [client.add_member_annotations(cat, ds, m, annotations)
+               for m in member_ids]
+    for r in gather(results):
+        ...
+"""
+import inspect
+from multiprocessing.pool import ThreadPool
+
+from globusonline.catalog.client.dataset_client import DatasetClient, \
+    DEFAULT_BASE_URL
+from globusonline.catalog.client.singleflight import SingleFlight
+
+DEFAULT_CONCURRENCY = 8
+
+
+class AsyncDatasetClient(object):
+    """
+    Note: every DatasetClient helper method is available here with the same
+    arguments, but returns an AsyncResult instead of blocking.
+    """
+    def __init__(self, goauth_token, base_url=DEFAULT_BASE_URL,
+                 max_attempts=1, parse_json=True, log_requests=False,
+                 concurrency=DEFAULT_CONCURRENCY, client=None):
+        """
+        @param concurrency: maximum number of requests in flight at once.
+        @param client: existing DatasetClient to issue the requests with;
+                       by default one is created with a connection pool of
+                       size concurrency, which coalesces identical
+                       concurrent GETs. A client passed in is left open by
+                       close().
+        """
+        self._owns_client = client is None
+        if client is None:
+            client = DatasetClient(goauth_token, base_url, max_attempts,
+                                   parse_json, log_requests,
+                                   pool_size=concurrency,
+                                   singleflight=SingleFlight())
+        self.client = client
+        self.concurrency = concurrency
+        self._workers = ThreadPool(concurrency)
+
+    def annotation_buffer(self, *args, **kw):
+        """Buffer on the underlying client; its flushes block."""
+        return self.client.annotation_buffer(*args, **kw)
+
+    def iter_datasets(self, *args, **kw):
+        """Paging iterator on the underlying client; it fetches ahead on
+        its own thread."""
+        return self.client.iter_datasets(*args, **kw)
+
+    def iter_members(self, *args, **kw):
+        """Paging iterator on the underlying client; it fetches ahead on
+        its own thread."""
+        return self.client.iter_members(*args, **kw)
+
+    def scan_datasets(self, *args, **kw):
+        """Range scan on the underlying client; it runs its own workers."""
+        return self.client.scan_datasets(*args, **kw)
+
+    def scan_members(self, *args, **kw):
+        """Range scan on the underlying client; it runs its own workers."""
+        return self.client.scan_members(*args, **kw)
+
+    def iter_member_annotations(self, *args, **kw):
+        """Chunked reads on the underlying client; it runs its own
+        workers."""
+        return self.client.iter_member_annotations(*args, **kw)
+
+    def submit(self, fn, *args, **kw):
+        """Run fn(*args, **kw) on a worker thread.
+
+        @return: AsyncResult for the return value of fn
+        """
+        return self._workers.apply_async(fn, args, kw)
+
+    def close(self):
+        """Wait for queued requests to finish, then stop the workers and,
+        if the client was created here, close its pooled connections."""
+        self._workers.close()
+        self._workers.join()
+        if self._owns_client:
+            self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def gather(results, timeout=None):
+    """Wait for all results and return their values in order. Raises the
+    first exception encountered, after which the remaining results are
+    left running."""
+    return [r.get(timeout) for r in results]
+
+
+def _mirror(name):
+    method = getattr(DatasetClient, name)
+
+    def call(self, *args, **kw):
+        return self._workers.apply_async(getattr(self.client, name), args, kw)
+    call.__name__ = name
+    call.__doc__ = method.__doc__
+    return call
+
+
+# Iterators (like paging iterators) are lazy: on a worker thread the
+# future would resolve to an iterator whose requests then run on the
+# caller's thread. So only plain request methods are mirrored; iterators
+# are passed through above.
+for _name, _method in inspect.getmembers(DatasetClient, inspect.ismethod):
+    if (_name.startswith(("_", "iter_", "scan_"))
+    or hasattr(AsyncDatasetClient, _name)
+    or inspect.isgeneratorfunction(_method)):
+        continue
+    setattr(AsyncDatasetClient, _name, _mirror(_name))
+del _name, _method
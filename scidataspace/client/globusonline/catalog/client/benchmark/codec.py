@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Compare the installed JSON codecs (see json_codec) on catalog payloads.
+
+    python -m globusonline.catalog.client.benchmark.codec [--json] \
+        [--repeat N] [payload ...]
+
+For each codec and payload, reports the best time over the repeats to
+decode and encode the payload, and whether decoding the codec's output
+gives back the same data as the stdlib.
+"""
+import sys
+import json
+import time
+from optparse import OptionParser
+
+from globusonline.catalog.client.json_codec import available_codecs
+from globusonline.catalog.client.benchmark.payloads import PAYLOADS
+
+
+def best_time(fn, arg, repeat):
+    best = None
+    for _ in xrange(repeat):
+        t = time.time()
+        fn(arg)
+        elapsed = time.time() - t
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(payload_names, repeat=5):
+    """@return: list of result dictionaries, one per (codec, payload)"""
+    results = []
+    codecs = available_codecs()
+    for payload_name in payload_names:
+        data = PAYLOADS[payload_name]()
+        text = json.dumps(data)
+        expected = json.loads(text)
+        for codec in codecs:
+            encoded = codec.dumps(data)
+            results.append(dict(
+                codec=codec.name, payload=payload_name, bytes=len(text),
+                loads_seconds=best_time(codec.loads, text, repeat),
+                dumps_seconds=best_time(codec.dumps, data, repeat),
+                roundtrip_ok=(json.loads(encoded) == expected
+                              and codec.loads(text) == expected)))
+    return results
+
+
+def format_results(results):
+    lines = ["%-24s %-11s %10s %10s %10s %9s %s"
+             % ("payload", "codec", "bytes", "loads ms", "dumps ms",
+                "MB/s in", "roundtrip")]
+    for r in results:
+        lines.append("%-24s %-11s %10d %10.2f %10.2f %9.1f %s"
+                     % (r["payload"], r["codec"], r["bytes"],
+                        r["loads_seconds"] * 1000, r["dumps_seconds"] * 1000,
+                        r["bytes"] / r["loads_seconds"] / 1e6,
+                        "ok" if r["roundtrip_ok"] else "DIFFERS"))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = OptionParser(usage="usage: %prog [options] [payload ...]")
+    parser.add_option("--json", action="store_true", dest="json",
+                      help="print results as JSON")
+    parser.add_option("--repeat", type="int", dest="repeat", default=5,
+                      help="runs per measurement, the best is kept")
+    options, names = parser.parse_args(args)
+    for name in names:
+        if name not in PAYLOADS:
+            parser.error("unknown payload %s, expected one of %s"
+                         % (name, ", ".join(sorted(PAYLOADS))))
+    results = run(names or sorted(PAYLOADS), options.repeat)
+    if options.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print format_results(results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
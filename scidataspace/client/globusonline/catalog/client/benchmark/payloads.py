@@ -0,0 +1,94 @@
+"""
+Synthetic catalog payloads, shaped like the responses and request bodies
+of the Dataset API, for benchmarks. The same seed always gives the same
+payload, so runs can be compared.
+"""
+import random
+
+ANNOTATION_TYPES = ("text", "int8", "float8", "boolean", "timestamptz")
+_WORDS = ("climate", "ocean", "run", "model", "output", "raw", "calibrated",
+          "sensor", "station", "grid", "daily", "monthly", "v2", "final")
+
+
+def _word(rng):
+    return rng.choice(_WORDS)
+
+
+def _path(rng, depth=4):
+    return "/" + "/".join(_word(rng) + str(rng.randint(0, 999))
+                          for _ in xrange(depth))
+
+
+def annotation_value(rng, value_type):
+    """Random value of the given annotation value_type."""
+    if value_type == "int8":
+        return rng.randint(0, 10 ** 9)
+    if value_type == "float8":
+        return rng.random() * 1000
+    if value_type == "boolean":
+        return rng.random() < 0.5
+    if value_type == "timestamptz":
+        return "2014-%02d-%02dT%02d:%02d:%02d+00:00" % (
+            rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+            rng.randint(0, 59), rng.randint(0, 59))
+    return " ".join(_word(rng) for _ in xrange(rng.randint(1, 6)))
+
+
+def annotation_defs(n=30, seed=1):
+    """Annotation definitions of a catalog, as get_annotation_defs returns
+    them."""
+    rng = random.Random(seed)
+    return [dict(name="%s_%d" % (_word(rng), i),
+                 value_type=rng.choice(ANNOTATION_TYPES),
+                 multivalued=rng.random() < 0.2,
+                 owner="user%d" % rng.randint(0, 20),
+                 readpolicy="subject", writepolicy="subject")
+            for i in xrange(n)]
+
+
+def annotations(n=10, seed=1):
+    """Annotation dictionary of one dataset or member."""
+    rng = random.Random(seed)
+    return dict(("%s_%d" % (d["name"], i),
+                 annotation_value(rng, d["value_type"]))
+                for i, d in enumerate(annotation_defs(n, seed)))
+
+
+def members(n=1000, dataset_id=1, annotation_count=0, seed=1):
+    """Member listing of a dataset, optionally with annotations."""
+    rng = random.Random(seed)
+    result = []
+    for i in xrange(n):
+        m = dict(id=i + 1, dataset_id=dataset_id,
+                 data_type=rng.choice(("file", "file", "directory")),
+                 data_uri="file://" + _path(rng), owner="user1")
+        if annotation_count:
+            m.update(annotations(annotation_count, seed + i))
+        result.append(m)
+    return result
+
+
+def datasets(n=100, annotation_count=5, seed=1):
+    """Dataset listing of a catalog, with the annotations tagfiler returns
+    alongside each dataset."""
+    rng = random.Random(seed)
+    result = []
+    for i in xrange(n):
+        ds = dict(id=i + 1, name="%s_%s_%d" % (_word(rng), _word(rng), i),
+                  owner="user%d" % rng.randint(0, 20),
+                  read_users=["*"], write_users=[])
+        ds.update(annotations(annotation_count, seed + i))
+        result.append(ds)
+    return result
+
+
+# name -> payload; the sizes cover a small REPL listing up to a large
+# import.
+PAYLOADS = {
+    "annotation_defs": lambda: annotation_defs(50),
+    "datasets_100": lambda: datasets(100),
+    "datasets_2000": lambda: datasets(2000),
+    "members_1000": lambda: members(1000),
+    "members_20000": lambda: members(20000),
+    "annotated_members_5000": lambda: members(5000, annotation_count=8),
+}
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""
+Benchmarks of DatasetClient operations against a local_server.
+
+    python -m globusonline.catalog.client.benchmark.suite \
+        [--latency SECONDS] [--scale N] [--output FILE] \
+        [--compare BASELINE] [scenario ...]
+
+Each scenario times a set of operations and reports, per operation, the
+number of calls, throughput and p50/p95/p99 latency (p95 and p99 only
+with at least MIN_PERCENTILE_SAMPLES calls, n/a otherwise):
+
+    operations   one call of each DatasetClient read and write helper
+    connections  cold (new client and connection per call) vs warm
+                 (pooled keep-alive connection) requests
+    paging       fetching the pages of a dataset's members at different
+                 page sizes
+    bulk_create  create_members with different batch sizes
+    annotations  annotating many members one request each, and through an
+                 AnnotationBuffer
+    concurrency  member listings and annotation reads from several threads
+
+The results are printed as a table, and written as JSON with --output.
+Give a previous JSON file with --compare to print the change of each
+measurement relative to it.
+"""
+import sys
+import json
+import math
+import time
+import platform
+import threading
+from optparse import OptionParser
+
+from globusonline.catalog.client.dataset_client import DatasetClient
+from globusonline.catalog.client.local_server import LocalCatalogServer
+
+TOKEN = "un=bench|local"
+# Fewer calls than this report no p95/p99; they would just repeat the
+# slowest call.
+MIN_PERCENTILE_SAMPLES = 20
+
+
+def percentile(sorted_samples, p):
+    """Nearest rank percentile of an ascending list.
+
+    >>> percentile(range(1, 101), 95)
+    95
+    >>> percentile([3], 50)
+    3
+    """
+    if not sorted_samples:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(sorted_samples))) - 1
+    return sorted_samples[max(0, min(rank, len(sorted_samples) - 1))]
+
+
+def summarize(samples, elapsed, items=None):
+    """Statistics of a list of latencies (seconds) measured over elapsed
+    wall time. items is the number of records processed, if that differs
+    from the number of calls. p95 and p99 are None for too few samples.
+
+    >>> r = summarize([0.1, 0.2], 1.0)
+    >>> r["p50"], r["p95"], r["p99"]
+    (0.1, None, None)
+    >>> summarize([0.1] * 20, 1.0)["p99"]
+    0.1
+    """
+    samples = sorted(samples)
+    n = len(samples)
+    tail = n >= MIN_PERCENTILE_SAMPLES
+    result = dict(calls=n, elapsed=elapsed,
+                  throughput=n / elapsed if elapsed else 0.0,
+                  mean=sum(samples) / n if n else 0.0,
+                  min=samples[0] if n else 0.0,
+                  max=samples[-1] if n else 0.0,
+                  p50=percentile(samples, 50),
+                  p95=percentile(samples, 95) if tail else None,
+                  p99=percentile(samples, 99) if tail else None)
+    if items is not None:
+        result["items"] = items
+        result["items_per_second"] = items / elapsed if elapsed else 0.0
+    return result
+
+
+class Bench(object):
+    """Runs scenarios against one local server and collects results keyed
+    by "scenario/operation"."""
+    def __init__(self, server, scale=1):
+        self.server = server
+        self.scale = scale
+        self.results = {}
+        self.client = DatasetClient(TOKEN, server.url)
+        _, catalog = self.client.create_catalog(config=dict(name="bench"))
+        self.catalog_id = catalog["id"]
+        _, dataset = self.client.create_dataset(self.catalog_id,
+                                                dict(name="bench"))
+        self.dataset_id = dataset["id"]
+        self.member_ids = self._create(self.dataset_id, 200 * scale)
+        for name, value_type in (("bench_text", "text"),
+                                 ("bench_int", "int8")):
+            self.client.create_annotation_def(self.catalog_id, name,
+                                              value_type)
+
+    def _create(self, dataset_id, n, prefix="m"):
+        _, members = self.client.create_members(
+            self.catalog_id, dataset_id,
+            [dict(data_type="file", data_uri="/%s/%d" % (prefix, i))
+             for i in xrange(n)])
+        return [m["id"] for m in members]
+
+    def measure(self, key, fn, calls, items=None):
+        """Call fn(i) for i in range(calls), recording each latency."""
+        samples = []
+        start = time.time()
+        for i in xrange(calls):
+            t = time.time()
+            fn(i)
+            samples.append(time.time() - t)
+        self.results[key] = summarize(samples, time.time() - start, items)
+
+    def measure_threads(self, key, fn, threads, calls):
+        """Like measure, with calls spread over threads running at once."""
+        samples = []
+        lock = threading.Lock()
+
+        def worker(offset):
+            mine = []
+            for i in xrange(offset, calls, threads):
+                t = time.time()
+                fn(i)
+                mine.append(time.time() - t)
+            with lock:
+                samples.extend(mine)
+        workers = [threading.Thread(target=worker, args=(n,))
+                   for n in xrange(threads)]
+        start = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.results[key] = summarize(samples, time.time() - start)
+        self.results[key]["threads"] = threads
+
+    def operations(self):
+        c, cat, ds = self.client, self.catalog_id, self.dataset_id
+        n = 50 * self.scale
+        members = self.member_ids
+        self.measure("operations/get_catalogs",
+                     lambda i: c.get_catalogs(), n)
+        self.measure("operations/get_datasets",
+                     lambda i: c.get_datasets(cat), n)
+        self.measure("operations/get_members",
+                     lambda i: c.get_members(cat, ds), n)
+        self.measure("operations/get_annotation_defs",
+                     lambda i: c.get_annotation_defs(cat), n)
+        self.measure("operations/get_dataset_annotations",
+                     lambda i: c.get_dataset_annotations(
+                         cat, ds, ["id", "bench_text"]), n)
+        self.measure("operations/add_dataset_annotations",
+                     lambda i: c.add_dataset_annotations(
+                         cat, ds, dict(bench_int=i)), n)
+        self.measure("operations/get_member_annotations",
+                     lambda i: c.get_member_annotations(
+                         cat, ds, members[i % len(members)],
+                         ["id", "bench_text"]), n)
+        self.measure("operations/add_member_annotations",
+                     lambda i: c.add_member_annotations(
+                         cat, ds, members[i % len(members)],
+                         dict(bench_int=i)), n)
+        created = []
+        self.measure("operations/create_dataset",
+                     lambda i: created.append(c.create_dataset(
+                         cat, dict(name="op_%d" % i))[1]["id"]), n)
+        self.measure("operations/delete_dataset",
+                     lambda i: c.delete_dataset(cat, created[i]), n)
+
+    def connections(self):
+        n = 50 * self.scale
+        url, cat = self.server.url, self.catalog_id
+
+        def cold(i):
+            client = DatasetClient(TOKEN, url)
+            client.get_datasets(cat)
+            client.close()
+        self.measure("connections/cold", cold, n)
+        warm = DatasetClient(TOKEN, url)
+        warm.get_datasets(cat)
+        self.measure("connections/warm",
+                     lambda i: warm.get_datasets(cat), n)
+        warm.close()
+
+    def paging(self):
+        c, cat = self.client, self.catalog_id
+        _, dataset = c.create_dataset(cat, dict(name="paging"))
+        total = 1000 * self.scale
+        self._create(dataset["id"], total, "paging")
+        for page_size in (10, 100, 1000):
+            last_ids = [None]
+
+            def page(i):
+                _, members = c.get_members(cat, dataset["id"],
+                                           last_id=last_ids[-1],
+                                           limit=page_size)
+                last_ids.append(members[-1]["id"])
+            self.measure("paging/limit_%d" % page_size, page,
+                         total // page_size, items=total)
+
+    def bulk_create(self):
+        c, cat = self.client, self.catalog_id
+        for size in (1, 100, 1000, 10000):
+            calls = max(1, min(20, 20000 * self.scale // (size * 10)))
+            _, dataset = c.create_dataset(cat, dict(name="bulk_%d" % size))
+
+            def create(i):
+                c.create_members(cat, dataset["id"],
+                                 [dict(data_type="file",
+                                       data_uri="/bulk/%d/%d" % (i, j))
+                                  for j in xrange(size)])
+            self.measure("bulk_create/size_%d" % size, create, calls,
+                         items=calls * size)
+
+    def annotations(self):
+        c, cat, ds = self.client, self.catalog_id, self.dataset_id
+        members = self.member_ids
+        self.measure("annotations/per_request",
+                     lambda i: c.add_member_annotations(
+                         cat, ds, members[i],
+                         dict(bench_text="v%d" % i, bench_int=i)),
+                     len(members))
+
+        def buffered(_):
+            with c.annotation_buffer(max_items=len(members) * 2) as buf:
+                for i, member_id in enumerate(members):
+                    buf.add(cat, ds, dict(bench_text="v%d" % i),
+                            member_id=member_id)
+                    buf.add(cat, ds, dict(bench_int=i), member_id=member_id)
+        self.measure("annotations/buffered", buffered, 1,
+                     items=len(members))
+
+    def concurrency(self):
+        cat, ds = self.catalog_id, self.dataset_id
+        members = self.member_ids
+        calls = 100 * self.scale
+        for threads in (1, 4, 16):
+            client = DatasetClient(TOKEN, self.server.url,
+                                   pool_size=threads)
+            self.measure_threads(
+                "concurrency/get_members_threads_%d" % threads,
+                lambda i: client.get_members(cat, ds), threads, calls)
+            self.measure_threads(
+                "concurrency/get_member_annotations_threads_%d" % threads,
+                lambda i: client.get_member_annotations(
+                    cat, ds, members[i % len(members)], ["bench_text"]),
+                threads, calls)
+            client.close()
+
+
+SCENARIOS = ("operations", "connections", "paging", "bulk_create",
+             "annotations", "concurrency")
+
+
+def format_results(results, baseline=None):
+    lines = ["%-50s %6s %9s %8s %8s %8s" % ("operation", "calls", "ops/s",
+                                            "p50 ms", "p95 ms", "p99 ms")]
+    for key in sorted(results):
+        r = results[key]
+        line = "%-50s %6d %9.1f %s %s %s" % (
+            key, r["calls"], r["throughput"], _ms(r["p50"]),
+            _ms(r["p95"]), _ms(r["p99"]))
+        if baseline is not None and key in baseline:
+            base = baseline[key]
+            line += "  p50 %s p95 %s ops/s %s" % (
+                _change(base["p50"], r["p50"]),
+                _change(base["p95"], r["p95"]),
+                _change(base["throughput"], r["throughput"]))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _ms(seconds):
+    if seconds is None:
+        return "%8s" % "n/a"
+    return "%8.2f" % (seconds * 1000)
+
+
+def _change(old, new):
+    if not old or new is None:
+        return "   n/a"
+    return "%+5.0f%%" % ((new - old) * 100.0 / old)
+
+
+def run(scenarios, latency=0.0, scale=1):
+    server = LocalCatalogServer(latency=latency, etag=False, seed=1)
+    server.start()
+    try:
+        bench = Bench(server, scale)
+        for name in scenarios:
+            getattr(bench, name)()
+        bench.client.close()
+    finally:
+        server.stop()
+    return dict(meta=dict(time=time.time(), python=platform.python_version(),
+                          platform=platform.platform(), latency=latency,
+                          scale=scale, scenarios=list(scenarios)),
+                results=bench.results)
+
+
+def main(args=None):
+    parser = OptionParser(usage="usage: %prog [options] [scenario ...]")
+    parser.add_option("--latency", type="float", default=0.001,
+                      help="server side latency per request, in seconds")
+    parser.add_option("--scale", type="int", default=1,
+                      help="multiply the number of calls and records")
+    parser.add_option("--output", help="write the results as JSON to this "
+                                       "file")
+    parser.add_option("--compare", help="JSON results of an earlier run to "
+                                        "compare against")
+    options, scenarios = parser.parse_args(args)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %s, expected one of %s"
+                         % (name, ", ".join(SCENARIOS)))
+    report = run(scenarios or SCENARIOS, options.latency, options.scale)
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)["results"]
+    print format_results(report["results"], baseline)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,254 @@
+"""
+Helpers for bulk operations that are split into chunks and run in
+parallel.
+
+Requests that name many records, like "id=1,2,3,..." selectors, have to
+be split so each URL stays below the length servers and proxies accept;
+chunk_ids does that. parallel_map then runs one request per chunk on a
+thread pool and hands back the results in order, or as they complete.
+
+create_in_chunks posts records in chunks the same way, and reports the
+outcome of every record: a chunk the server certainly did not act on (a
+503 or a failure to connect) is retried on its own, and one the server
+rejects (4xx) is split in halves until the offending records are
+isolated, so one bad record does not lose the rest of the batch. Any
+other failure, like a timeout, may have created the records, so it is
+reported rather than retried.
+"""
+import sys
+import time
+import Queue
+import logging
+import threading
+from itertools import chain, islice
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+
+from globusonline.catalog.client.rest_client import urlquote, \
+    RestClientError, retry_delay, request_sent
+
+# Conservative limit on the length of a request URL (path and query);
+# most servers and proxies accept at least 4-8KB.
+MAX_URL_LENGTH = 2000
+DEFAULT_CONCURRENCY = 4
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CHUNK_ATTEMPTS = 3
+# Statuses meaning the server rejected (some of) the records themselves,
+# rather than the request as a whole.
+REJECTED_STATUSES = (400, 409, 413, 422)
+
+_log = logging.getLogger("globusonline.catalog.bulk")
+
+
+def chunk_ids(ids, max_length, max_count=None):
+    """Split ids into lists whose comma separated, url quoted form is at
+    most max_length characters long, and which have at most max_count ids.
+
+    >>> list(chunk_ids([1, 22, 333, 4444], 6))
+    [[1, 22], [333], [4444]]
+    >>> list(chunk_ids(range(5), 100, max_count=2))
+    [[0, 1], [2, 3], [4]]
+    """
+    chunk = []
+    length = -1
+    for id in ids:
+        id_length = len(urlquote(id)) + 1
+        if id_length - 1 > max_length:
+            raise ValueError("id %r is too long for a request" % (id,))
+        if chunk and (length + id_length > max_length
+                      or len(chunk) == max_count):
+            yield chunk
+            chunk = []
+            length = -1
+        chunk.append(id)
+        length += id_length
+    if chunk:
+        yield chunk
+
+
+def parallel_map(fn, items, concurrency=DEFAULT_CONCURRENCY, ordered=True):
+    """Iterate over fn(item) for every item, calling fn on up to
+    concurrency threads at once. Results come in the order of items if
+    ordered, otherwise as they complete. An exception raised by fn is
+    raised by the iterator; the remaining calls are abandoned.
+
+    Items are taken from the iterable only as calls finish, so a generator
+    of items is never read more than concurrency items ahead:
+
+    >>> drawn = []
+    >>> def numbers():
+    ...     for i in xrange(100):
+    ...         drawn.append(i)
+    ...         yield i
+    >>> results = parallel_map(lambda i: i * 2, numbers(), concurrency=4)
+    >>> results.next(), len(drawn)
+    (0, 5)
+    >>> sum(results)
+    9900
+    >>> sorted(parallel_map(abs, [-1, 2, -3], ordered=False))
+    [1, 2, 3]
+    """
+    items = iter(items)
+    head = list(islice(items, max(concurrency, 1)))
+    if concurrency <= 1 or len(head) <= 1:
+        for item in chain(head, items):
+            yield fn(item)
+        return
+    pool = ThreadPool(len(head))
+    try:
+        if ordered:
+            pending = deque(pool.apply_async(fn, (item,)) for item in head)
+            while pending:
+                result = pending.popleft().get()
+                for item in islice(items, 1):
+                    pending.append(pool.apply_async(fn, (item,)))
+                yield result
+        else:
+            done = Queue.Queue()
+
+            def call(item):
+                try:
+                    done.put((fn(item), None))
+                except Exception:
+                    done.put((None, sys.exc_info()))
+
+            for item in head:
+                pool.apply_async(call, (item,))
+            in_flight = len(head)
+            while in_flight:
+                result, exc_info = done.get()
+                in_flight -= 1
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                for item in islice(items, 1):
+                    pool.apply_async(call, (item,))
+                    in_flight += 1
+                yield result
+    finally:
+        pool.terminate()
+
+
+def chunks(records, size):
+    """Split an iterable into lists of at most size records.
+
+    >>> list(chunks(xrange(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+RecordResult = namedtuple("RecordResult", "record id error")
+
+
+class BulkCreateResult(object):
+    """
+    Outcome of create_in_chunks. results holds a RecordResult(record, id,
+    error) for each record, in input order; either id is the id it was
+    created with, or error the exception that prevented it.
+    """
+    def __init__(self, results, request_count):
+        self.results = results
+        self.request_count = request_count
+
+    @property
+    def ids(self):
+        """Index of each created record in the input -> its id."""
+        return dict((i, r.id) for i, r in enumerate(self.results)
+                    if r.error is None)
+
+    @property
+    def errors(self):
+        """Index of each failed record in the input -> the exception."""
+        return dict((i, r.error) for i, r in enumerate(self.results)
+                    if r.error is not None)
+
+    @property
+    def ok(self):
+        return all(r.error is None for r in self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __repr__(self):
+        return "BulkCreateResult(created=%d, failed=%d, requests=%d)" % (
+            len(self.results) - len(self.errors), len(self.errors),
+            self.request_count)
+
+
+def _client_error_status(e):
+    if isinstance(e, RestClientError) and 400 <= e.response.status < 500:
+        return e.response.status
+    return None
+
+
+def create_in_chunks(create_chunk, records, chunk_size=DEFAULT_CHUNK_SIZE,
+                     concurrency=DEFAULT_CONCURRENCY,
+                     max_attempts=DEFAULT_CHUNK_ATTEMPTS):
+    """Create records by calling create_chunk with lists of at most
+    chunk_size of them, on up to concurrency threads at once.
+
+    A chunk that was refused with a 503, or failed to connect, is retried
+    up to max_attempts times in total. A chunk rejected with one of
+    REJECTED_STATUSES is split. Any other error fails all of its records:
+    after a timeout or a 5xx the server may have created them, and posting
+    them again would create duplicates.
+
+    @param create_chunk: function(list of records) returning the list of
+                         created records, in the same order, with their ids
+    @return: BulkCreateResult
+    """
+    counter = [0]
+    counter_lock = threading.Lock()
+
+    def create(chunk):
+        with counter_lock:
+            counter[0] += 1
+        created = create_chunk(chunk)
+        if len(created) != len(chunk):
+            raise ValueError("Created %d records for a chunk of %d"
+                             % (len(created), len(chunk)))
+        return [RecordResult(record, c["id"], None)
+                for record, c in zip(chunk, created)]
+
+    def create_with_retries(chunk):
+        for attempt in xrange(max_attempts):
+            try:
+                return create(chunk)
+            except Exception as e:
+                status = _client_error_status(e)
+                if status in REJECTED_STATUSES:
+                    return split(chunk, e)
+                if (status is not None or request_sent(e)
+                        or attempt == max_attempts - 1):
+                    _log.warning("Chunk of %d records failed after %d "
+                                 "attempts: %s", len(chunk), attempt + 1, e)
+                    return [RecordResult(record, None, e)
+                            for record in chunk]
+                delay = retry_delay(attempt)
+                _log.info("Chunk of %d records failed, retrying in %.1fs: "
+                          "%s", len(chunk), delay, e)
+                time.sleep(delay)
+
+    def split(chunk, e):
+        # Rejected: one or more records are bad. Halve until they are
+        # isolated; the good halves get created.
+        if len(chunk) == 1:
+            return [RecordResult(chunk[0], None, e)]
+        middle = len(chunk) // 2
+        return (create_with_retries(chunk[:middle])
+                + create_with_retries(chunk[middle:]))
+
+    results = []
+    for chunk_results in parallel_map(create_with_retries,
+                                      chunks(records, chunk_size),
+                                      concurrency):
+        results.extend(chunk_results)
+    return BulkCreateResult(results, counter[0])
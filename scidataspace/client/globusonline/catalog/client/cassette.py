@@ -0,0 +1,363 @@
+"""
+Record API traffic to a cassette file, and replay it without a network.
+
+A Recorder passed to GoauthRestClient as recorder captures every request
+the client sends: method, path, request size, and the response status,
+headers and body exactly as they came over the wire (still compressed),
+with the time spent connecting, waiting for the response and reading it.
+Each exchange is appended to the cassette as one line of JSON.
+
+A ReplayTransport serves a cassette in place of the server. It is a
+connection factory for ConnectionPool, so everything above the socket -
+pooling, retries, decompression, streaming, caching and JSON decoding -
+runs as it did while recording:
+
+    transport = ReplayTransport("session.cassette", speed=10)
+    client = DatasetClient(token, base_url, pool=transport.pool())
+
+Requests are matched to recorded exchanges by method and path, in
+recorded order; once the recordings of a request are used up, the last
+one is served again. Responses are delayed by the recorded times divided
+by speed, so speed=1 replays at the recorded pace and speed=None as fast
+as possible.
+
+gdclient.py and catalog.py record when GDCLIENT_RECORD names a cassette
+file, and replay one named by GDCLIENT_REPLAY, at GDCLIENT_REPLAY_SPEED
+(1 by default, 0 for no delays); see options_from_environ.
+"""
+import os
+import time
+import json
+import base64
+import logging
+import threading
+from collections import deque
+
+from globusonline.catalog.client.connection_pool import ConnectionPool, \
+    DEFAULT_POOL_SIZE
+
+CASSETTE_VERSION = 1
+
+_log = logging.getLogger("globusonline.catalog.cassette")
+
+
+class CassetteMissError(Exception):
+    """Raised on replay for a request that is not in the cassette."""
+    pass
+
+
+class Recorder(object):
+    """
+    Appends the exchanges of the connections it wraps to a cassette file.
+    One Recorder can be shared by any number of clients and threads.
+
+    @param path: cassette file; recordings are appended if it exists
+    """
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+        if self._file.tell() == 0:
+            self._write(dict(cassette=CASSETTE_VERSION, recorded=self.start))
+
+    def wrap(self, conn):
+        """Wrap an httplib connection for the duration of one request."""
+        return _RecordingConnection(self, conn)
+
+    def record(self, exchange):
+        with self._lock:
+            self.count += 1
+            self._write(exchange)
+
+    def _write(self, obj):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(obj, sort_keys=True) + "\n")
+        self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class _RecordingConnection(object):
+    """Proxy for an httplib connection that notes what is sent, and returns
+    a response which records the exchange once its body has been read."""
+    def __init__(self, recorder, conn):
+        self._recorder = recorder
+        self._conn = conn
+        self._exchange = None
+        self._connect_time = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def connect(self):
+        t = time.time()
+        self._conn.connect()
+        self._connect_time = time.time() - t
+
+    def _begin(self, method, url):
+        self._exchange = dict(
+            method=method, path=url, request_bytes=0,
+            offset=time.time() - self._recorder.start,
+            connect_time=self._connect_time)
+
+    def request(self, method, url, body=None, headers={}):
+        self._begin(method, url)
+        self._exchange["request_bytes"] = len(body or "")
+        self._conn.request(method, url, body, headers)
+
+    def putrequest(self, method, url, *args, **kw):
+        self._begin(method, url)
+        self._conn.putrequest(method, url, *args, **kw)
+
+    def send(self, data):
+        self._exchange["request_bytes"] += len(data)
+        self._conn.send(data)
+
+    def getresponse(self):
+        t = time.time()
+        r = self._conn.getresponse()
+        self._exchange["wait_time"] = time.time() - t
+        return _RecordingResponse(self._recorder, self._exchange, r)
+
+
+class _RecordingResponse(object):
+    """Proxy for an httplib response that keeps a copy of the body read."""
+    def __init__(self, recorder, exchange, response):
+        self._recorder = recorder
+        self._exchange = exchange
+        self._response = response
+        self._chunks = []
+        self._read_start = None
+        exchange.update(status=response.status, reason=response.reason,
+                        headers=response.getheaders())
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def read(self, amt=None):
+        if self._read_start is None:
+            self._read_start = time.time()
+        data = self._response.read(amt)
+        if data:
+            self._chunks.append(data)
+        # The body is complete once httplib has closed the response; a
+        # reader that knows where the body ends may never read past it.
+        if not data or amt is None or self._response.isclosed():
+            self._finish()
+        return data
+
+    def _finish(self):
+        if self._exchange is None:
+            return
+        exchange, self._exchange = self._exchange, None
+        exchange["read_time"] = time.time() - self._read_start
+        exchange["body"] = base64.b64encode("".join(self._chunks))
+        self._recorder.record(exchange)
+
+
+def load_cassette(path):
+    """@return: list of the exchanges recorded in a cassette file"""
+    exchanges = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if "cassette" in obj:
+                if obj["cassette"] != CASSETTE_VERSION:
+                    raise ValueError("Unsupported cassette version %s in %s"
+                                     % (obj["cassette"], path))
+                continue
+            obj["body"] = base64.b64decode(obj["body"])
+            exchanges.append(obj)
+    return exchanges
+
+
+class ReplayTransport(object):
+    """
+    Serves the exchanges of a cassette to the connections it creates.
+
+    @param path: cassette file to replay
+    @param speed: divide the recorded delays by this; None or 0 for no
+                  delays at all
+    """
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        # (method, path) -> deque of exchanges not yet served
+        self._pending = {}
+        self._last = {}
+        for exchange in load_cassette(path):
+            key = (exchange["method"], exchange["path"])
+            self._pending.setdefault(key, deque()).append(exchange)
+        self.served_count = 0
+        self.repeat_count = 0
+
+    def connection(self, key):
+        """Connection factory for ConnectionPool."""
+        return _ReplayConnection(self, key)
+
+    def pool(self, max_size=DEFAULT_POOL_SIZE):
+        """@return: a ConnectionPool of replay connections"""
+        return ConnectionPool(factory=self.connection, max_size=max_size,
+                              health_check=None)
+
+    def next_exchange(self, method, path):
+        key = (method, path)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending:
+                exchange = pending.popleft()
+                self._last[key] = exchange
+            elif key in self._last:
+                exchange = self._last[key]
+                self.repeat_count += 1
+            else:
+                raise CassetteMissError("%s %s was not recorded in %s"
+                                        % (method, path, self.path))
+            self.served_count += 1
+        return exchange
+
+    def delay(self, seconds):
+        if self.speed and seconds:
+            time.sleep(seconds / self.speed)
+
+
+class _ReplayConnection(object):
+    """Stands in for an httplib connection, answering from a cassette."""
+    # Never holds a socket, so the client calls connect before every
+    # request; only the first one is paced.
+    sock = None
+
+    def __init__(self, transport, key):
+        self.transport = transport
+        self.key = key
+        self.host = key[1]
+        self.port = key[2]
+        self._connected = False
+        self._connect_pending = False
+        self._request = None
+
+    def connect(self):
+        if not self._connected:
+            self._connected = True
+            self._connect_pending = True
+
+    def request(self, method, url, body=None, headers={}):
+        self._request = (method, url)
+
+    def putrequest(self, method, url, *args, **kw):
+        self._request = (method, url)
+
+    def putheader(self, header, *values):
+        pass
+
+    def endheaders(self, message_body=None):
+        pass
+
+    def send(self, data):
+        pass
+
+    def getresponse(self):
+        if self._request is None:
+            raise CassetteMissError("getresponse without a request")
+        method, path = self._request
+        self._request = None
+        exchange = self.transport.next_exchange(method, path)
+        if self._connect_pending:
+            self._connect_pending = False
+            self.transport.delay(exchange.get("connect_time", 0.0))
+        self.transport.delay(exchange.get("wait_time", 0.0))
+        return _ReplayResponse(self.transport, exchange)
+
+    def close(self):
+        self._connected = False
+
+
+class _ReplayResponse(object):
+    """Minimal httplib.HTTPResponse lookalike for a recorded exchange."""
+    version = 11
+
+    def __init__(self, transport, exchange):
+        self.transport = transport
+        self.status = exchange["status"]
+        self.reason = exchange["reason"]
+        self._headers = [tuple(h) for h in exchange["headers"]]
+        self._body = exchange["body"]
+        self._read_time = exchange.get("read_time", 0.0)
+        self._pos = 0
+
+    def getheader(self, name, default=None):
+        name = name.lower()
+        for header, value in self._headers:
+            if header.lower() == name:
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self._headers)
+
+    def read(self, amt=None):
+        if self._pos == 0 and self._read_time:
+            self.transport.delay(self._read_time)
+        if amt is None:
+            amt = len(self._body) - self._pos
+        data = self._body[self._pos:self._pos + amt]
+        self._pos += len(data)
+        return data
+
+    def isclosed(self):
+        return self._pos >= len(self._body)
+
+    def close(self):
+        self._pos = len(self._body)
+
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_recorder(path):
+    """@return: the process wide Recorder appending to path"""
+    path = os.path.abspath(path)
+    with _recorders_lock:
+        recorder = _recorders.get(path)
+        if recorder is None:
+            recorder = _recorders[path] = Recorder(path)
+        return recorder
+
+
+def options_from_environ(pool_size=DEFAULT_POOL_SIZE, environ=None):
+    """Client keyword arguments to record or replay as requested by the
+    GDCLIENT_RECORD, GDCLIENT_REPLAY and GDCLIENT_REPLAY_SPEED environment
+    variables.
+
+    >>> options_from_environ(environ={})
+    {}
+    """
+    if environ is None:
+        environ = os.environ
+    options = {}
+    replay = environ.get("GDCLIENT_REPLAY")
+    if replay:
+        try:
+            speed = float(environ.get("GDCLIENT_REPLAY_SPEED", "1"))
+        except ValueError:
+            _log.warning("Ignoring bad GDCLIENT_REPLAY_SPEED %r",
+                         environ["GDCLIENT_REPLAY_SPEED"])
+            speed = 1.0
+        _log.info("Replaying %s at speed %s", replay, speed)
+        options["pool"] = ReplayTransport(replay, speed).pool(pool_size)
+    record = environ.get("GDCLIENT_RECORD")
+    if record:
+        _log.info("Recording to %s", record)
+        options["recorder"] = get_recorder(record)
+    return options
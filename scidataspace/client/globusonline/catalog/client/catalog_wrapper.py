@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 from globusonline.catalog.client.goauth import get_access_token
 from globusonline.catalog.client.dataset_client import DatasetClient
+from globusonline.catalog.client.http_cache import ResponseCache, default_directory
+from globusonline.catalog.client.rate_limit import get_rate_limiter
+from globusonline.catalog.client.circuit_breaker import get_circuit_breaker
+from globusonline.catalog.client.singleflight import SingleFlight
+from globusonline.catalog.client.cassette import options_from_environ
+from globusonline.catalog.client.annotation_defs import AnnotationDefCache
+from globusonline.catalog.client import annotation_defs
 from globusonline.transfer.api_client import TransferAPIClient, Transfer
 import re
 import collections
@@ -27,6 +34,7 @@ class CatalogWrapper:
         self.transfer_queue = ''
         #Client Variables
         self.catalogClient  = ''     #client for interfacing with Globus Catalog
+        self.annotationDefs = None   #annotation definitions of the catalogs, kept in ~/.gdclient/annotation_defs
         #Debug Variables
         self.debug = False
         if os.getenv("GCAT_DEBUG", "0") is "1":
@@ -75,7 +83,21 @@ class CatalogWrapper:
             self.username = self.token.split('|')[0][3:] #read the username from the token file which is split by | and listed after un= in the first string          
 
         if(self.token):
-            self.catalogClient = DatasetClient(self.token.strip(), self.catalog_base_url)
+            # GCAT_HTTP_CACHE=1 keeps read responses in ~/.gdclient/http_cache
+            # between runs and revalidates them with conditional GETs
+            cache = None
+            if os.getenv("GCAT_HTTP_CACHE", "0") == "1":
+                cache = ResponseCache(directory=default_directory())
+            # all clients of this catalog in the process back off together
+            # when the server starts answering 503, and retry after it.
+            # GDCLIENT_RECORD / GDCLIENT_REPLAY record or replay the session
+            self.catalogClient = DatasetClient(self.token.strip(), self.catalog_base_url, max_attempts=3, cache=cache,
+                                               rate_limiter=get_rate_limiter(self.catalog_base_url),
+                                               circuit_breaker=get_circuit_breaker(self.catalog_base_url),
+                                               singleflight=SingleFlight(),
+                                               **options_from_environ())
+            self.annotationDefs = AnnotationDefCache(self.catalogClient,
+                                                     directory=annotation_defs.default_directory())
             self.transferClient = TransferAPIClient(self.username, goauth=self.token, base_url=self.transfer_base_url)
 
     def check_authenticate(self):
@@ -107,7 +129,7 @@ class CatalogWrapper:
         return True
     
     def transfer_members(self, catalog_id, dataset_id, local_path=None):
-        _,self.members = self.catalogClient.get_members(catalog_id,dataset_id)
+        self.members = list(self.catalogClient.iter_members(catalog_id,dataset_id))
         self.transfer_details = self.extract_transfer_details(self.members)
         self.transfer_queue = self.group_transfers(self.transfer_details)
         self.activate_endpoints(self.transfer_details)
@@ -0,0 +1,110 @@
+"""
+Circuit breaker for GoauthRestClient.
+
+After failure_threshold consecutive failures (network errors or 5xx
+responses) the circuit opens, and requests fail immediately with
+CircuitOpenError instead of waiting on socket timeouts and retry sleeps.
+After reset_timeout seconds the circuit goes half open and lets up to
+half_open_max probe requests through; a successful probe closes it again,
+a failed one re-opens it for another reset_timeout.
+"""
+import time
+import threading
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit is open.
+    retry_at is the time.time() at which a probe will be let through."""
+    def __init__(self, retry_at):
+        self.retry_at = retry_at
+        Exception.__init__(self, "Circuit open, service unavailable; next "
+                                 "attempt in %.1fs"
+                                 % max(0.0, retry_at - time.time()))
+
+
+class CircuitBreaker(object):
+    """
+    Thread-safe circuit breaker state. The state changing methods return
+    an (old_state, new_state) tuple when they cause a transition, and None
+    otherwise.
+    """
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, half_open_max=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probes = 0
+        self._probe_started = None
+
+    def before_request(self):
+        """Check whether a request may be sent, raising CircuitOpenError
+        if not."""
+        with self._lock:
+            change = None
+            if self.state == OPEN:
+                retry_at = self.opened_at + self.reset_timeout
+                if time.time() < retry_at:
+                    raise CircuitOpenError(retry_at)
+                change = self._set_state(HALF_OPEN)
+                self._probes = 0
+            if self.state == HALF_OPEN:
+                now = time.time()
+                if self._probes >= self.half_open_max:
+                    # A probe whose outcome was never recorded (e.g. it
+                    # raised something else) must not block forever.
+                    retry_at = self._probe_started + self.reset_timeout
+                    if now < retry_at:
+                        raise CircuitOpenError(retry_at)
+                    self._probes = 0
+                if self._probes == 0:
+                    self._probe_started = now
+                self._probes += 1
+            return change
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                return self._set_state(CLOSED)
+            return None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN
+            or (self.state == CLOSED
+                and self.failures >= self.failure_threshold)):
+                self.opened_at = time.time()
+                return self._set_state(OPEN)
+            return None
+
+    def _set_state(self, state):
+        old = self.state
+        self.state = state
+        return (old, state)
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_circuit_breaker(key, **kw):
+    """Get the process wide breaker for key (typically the service base
+    URL), creating it with the keyword arguments on first use."""
+    with _registry_lock:
+        breaker = _registry.get(key)
+        if breaker is None:
+            breaker = _registry[key] = CircuitBreaker(**kw)
+        return breaker
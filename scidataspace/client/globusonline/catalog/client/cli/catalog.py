@@ -5,10 +5,13 @@ import sys
 import json
 import traceback
 from optparse import OptionParser
+from collections import OrderedDict
 
 from globusonline.catalog.client.catalog_wrapper import *
 from globusonline.catalog.client.operators import Op
 from globusonline.catalog.client.rest_client import RestClientError
+from globusonline.catalog.client.instrumentation import LatencyCollector
+from globusonline.catalog.client.async_dataset_client import AsyncDatasetClient, gather
 
 print_text = False  #Variable used to decide whether output should be in JSON (False) or limited plain text (True)
 default_catalog = None
@@ -17,6 +20,7 @@ name_mode = False
 show_output = True
 short_format = False
 use_log_files = False
+show_stats = False
 
 def check_environment():
     global show_output
@@ -298,7 +302,7 @@ def create_annotation_def(args):
 
     bool_multivalue_arg = is_true(multivalue_arg)
     try:
-        response = client.create_annotation_def \
+        response = annotation_defs.create \
             (catalog_id=catalog_arg, annotation_name=annotation_arg,
              value_type=value_arg,   multivalued=bool_multivalue_arg)
     except Exception as e:
@@ -321,6 +325,7 @@ def delete_annotation_def(args):
     annotation_arg = args[0]
     response = client.delete_annotation_def \
         (catalog_id=catalog_arg, annotation_name=annotation_arg)
+    annotation_defs.remove(catalog_arg, annotation_arg)
     return response
 
 def get_annotation_defs(args):
@@ -394,7 +399,6 @@ def get_dataset_annotations(args):
 def add_dataset_annotation(args):
     catalog_arg = None
     dataset_arg = None
-    existing_annotations = []
 
     default_annotation_type = 'text'
     def error(msg):
@@ -419,17 +423,8 @@ def add_dataset_annotation(args):
             # Received list of KEY:VALUE
             annotation_dict = make_annotation_dict(args)
 
-        _,result = client.get_annotation_defs(catalog_arg)
-        for item in result:
-            existing_annotations.append(item['name'])
-
-        for item in annotation_dict:
-            if item not in existing_annotations:
-                client.create_annotation_def \
-                            (catalog_id=catalog_arg, annotation_name=item,
-                             value_type=default_annotation_type,   multivalued=True)
-
-        client.add_dataset_annotations(catalog_arg,dataset_arg,annotation_dict)
+        annotation_defs.ensure(catalog_arg, annotation_dict.keys(),
+                               value_type=default_annotation_type, multivalued=True)
 
     except IndexError:
         if show_output:
@@ -548,9 +543,12 @@ def add_dataset_acl_recursive(args):
         acl = { "principal":      args[0],
                 "principal_type": args[1],
                 "permission":     args[2]}
-    _,result = client.get_datasets(catalog_arg)
-    for dataset in result:
-        client.add_dataset_acl(catalog_arg, dataset['id'], acl)
+    result = client.iter_datasets(catalog_arg, projection_list=['id'])
+    # Runs concurrently; the client's rate limiter keeps the pace at what
+    # the server sustains.
+    with AsyncDatasetClient(None, client=client) as async_client:
+        gather([async_client.add_dataset_acl(catalog_arg, dataset['id'], acl)
+                for dataset in result])
 
 def print_acl(acl):
     print "%s %s %s" % \
@@ -583,17 +581,23 @@ def create_members(args):
     if name_mode:
         dataset_arg = resolve_dataset_name(catalog_arg, dataset_arg)
     member_arg = args[0]
-    if member_arg[0] == '{':
+    if member_arg[0] in '{[':
         members = json.loads(member_arg)
     else:
         if len(args) != 2:
             raise UsageException("requires: <data_type> <data_uri>")
         members = { "data_type": args[0],
                     "data_uri":  args[1]}
-    _,result = client.create_members(catalog_arg,dataset_arg,members)
+    if isinstance(members, dict):
+        members = [members]
+    result = client.create_members_bulk(catalog_arg,dataset_arg,members)
     if show_output:
-        print result['id']
-    return True
+        for member, member_id, error in result:
+            if error is None:
+                print member_id
+            else:
+                print "Failed to create %s: %s" % (member.get("data_uri"), error)
+    return result.ok
 
 def get_dataset_members(args):
     #@arg[0] = catalog ID -- INT
@@ -674,25 +678,25 @@ def get_existing_member_annotations(args):
     catalog_arg = pop_catalog(args)
     if len(args) < 2:
         raise UsageException("get_existing_member_annotations: usage: " +
-                             "<dataset> <member>")
+                             "<dataset> <member> [<member> ...]")
     dataset_arg = args.pop(0)
     if name_mode:
         dataset_arg = resolve_dataset_name(catalog_arg, dataset_arg)
-    member_arg = args.pop(0)
-
-    # Retrieve a list of annotations present on the given member
-    request_string = "/catalog/id=%s/dataset/id=%s/member/id=%s/annotation/annotations_present"%(catalog_arg, dataset_arg, member_arg)
-    _,result = client._request('GET', request_string)
-    print "result: ", result
-    if len(result) == 0:
+    member_args = args
+
+    # Names present and their values for all members, in a couple of
+    # requests per chunk of members rather than two per member
+    result = client.iter_member_annotations(catalog_arg, dataset_arg,
+                                            member_args)
+    records = OrderedDict(result)
+    if not any(records.itervalues()):
         print "No annotations."
-        return True
-    annotations_present = result[0]['annotations_present']
-
-    # With the list of annotations present, retrieve the values
-    _,result = client.get_member_annotations(catalog_arg, dataset_arg, member_arg, annotations_present)
-    if print_text:
-        for record in result:
+    elif print_text:
+        for member_id, record in records.iteritems():
+            if len(member_args) > 1:
+                print "member %s" % member_id
+            if not record:
+                continue
             lengths = map(len, record.keys())
             m = max(lengths)
             for key in record:
@@ -702,9 +706,10 @@ def get_existing_member_annotations(args):
                     print record[key][0]
                 else:
                     print record[key]
-        return True
     else:
-        print json.dumps(result)
+        # Keyed by member id, so the output can be matched to the
+        # arguments; members without annotations map to {}.
+        print json.dumps(records)
     return True
 
 def delete_member_annotation(args):
@@ -886,14 +891,18 @@ def run_parser():
     parser.add_option("-x",
                       action="store_false", dest="show_output", default=True,
                       help="generate no output")
+    parser.add_option("--stats",
+                      action="store_true", dest="show_stats", default=False,
+                      help="print per-endpoint request statistics to stderr")
 
     (options, args) = parser.parse_args()
-    global force, name_mode, short_format, print_text, show_output
+    global force, name_mode, short_format, print_text, show_output, show_stats
     force        = options.force
     name_mode    = options.name_mode
     short_format = options.short_format
     print_text   = options.print_text
     show_output  = options.show_output
+    show_stats   = options.show_stats
 
     if options.help_commands:
         describe_commands()
@@ -916,9 +925,14 @@ if __name__ == "__main__":
     token_file = os.getenv('HOME','')+"/.ssh/gotoken.txt"
     wrap = CatalogWrapper(token_file=token_file)
     client = wrap.catalogClient
+    annotation_defs = wrap.annotationDefs
 
     args = run_parser()
 
+    request_stats = LatencyCollector()
+    if show_stats:
+        client.add_listener(request_stats)
+
     check_environment()
     the_command = args.pop(0)
     success = False
@@ -937,6 +951,9 @@ if __name__ == "__main__":
         print e
         traceback.print_exc()
 
+    if show_stats:
+        sys.stderr.write(request_stats.format_report() + "\n")
+
     arg_list = ['python']+sys.argv
     log_string = ' '.join(arg_list)
 
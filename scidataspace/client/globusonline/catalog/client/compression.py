@@ -0,0 +1,88 @@
+"""
+Content-Encoding support for the REST client: gzip/deflate response bodies
+are decompressed incrementally as they are read off the socket, and
+streamed request bodies can be gzip compressed on the fly.
+"""
+import zlib
+
+ACCEPT_ENCODING = "gzip, deflate"
+READ_CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+
+
+class _DeflateDecompressor(object):
+    """Decompressor for "deflate", which servers send either zlib wrapped
+    (as RFC 2616 says) or as a raw deflate stream."""
+    def __init__(self):
+        self._d = None
+
+    def decompress(self, data):
+        if self._d is None:
+            self._d = zlib.decompressobj()
+            try:
+                return self._d.decompress(data)
+            except zlib.error:
+                self._d = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._d.decompress(data)
+
+    def flush(self):
+        if self._d is None:
+            return ""
+        return self._d.flush()
+
+
+def decompressor(content_encoding):
+    """Get an object with decompress/flush methods for the given
+    Content-Encoding header value, or None if the body is not encoded."""
+    encoding = (content_encoding or "").strip().lower()
+    if encoding in ("", "identity"):
+        return None
+    elif encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        return _DeflateDecompressor()
+    raise ValueError("Unsupported Content-Encoding '%s'" % content_encoding)
+
+
+def iter_body(response, stats=None, chunk_size=READ_CHUNK_SIZE):
+    """Read the body of an httplib response, decoding it according to its
+    Content-Encoding, and yield it chunk by chunk.
+
+    @param stats: optional object with wire_bytes and body_bytes counters,
+                  incremented with the encoded and decoded sizes.
+    """
+    d = decompressor(response.getheader("Content-Encoding"))
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        if stats is not None:
+            stats.wire_bytes += len(chunk)
+        if d is not None:
+            chunk = d.decompress(chunk)
+        if chunk:
+            if stats is not None:
+                stats.body_bytes += len(chunk)
+            yield chunk
+    if d is not None:
+        chunk = d.flush()
+        if chunk:
+            if stats is not None:
+                stats.body_bytes += len(chunk)
+            yield chunk
+
+
+def read_body(response, stats=None):
+    """Read and decode the complete body of an httplib response."""
+    return "".join(iter_body(response, stats))
+
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    """Compress an iterable of strings into a gzip stream, yielding the
+    compressed data as it becomes available."""
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data
+    yield c.flush()
@@ -0,0 +1,253 @@
+"""
+Thread-safe pool of persistent (keep-alive) httplib connections.
+
+GoauthRestClient checks a connection out of the pool for the duration of a
+single request and checks it back in once the response body has been read,
+so several threads sharing one client each get their own warm connection
+instead of serializing on a single socket.
+"""
+import httplib
+import select
+import socket
+import threading
+import time
+
+from globusonline.catalog.client import tls
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_IDLE_SECONDS = 60
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection could be checked out within the pool's
+    checkout timeout."""
+    pass
+
+
+def connection_key(is_https, host, port):
+    """Key identifying the host a pooled connection is bound to."""
+    if is_https:
+        scheme = "https"
+    else:
+        scheme = "http"
+    return (scheme, host, port)
+
+
+def make_connection(key):
+    """Default connection factory: an httplib connection for key, using
+    the process wide TLS context for https."""
+    scheme, host, port = key
+    if scheme == "https":
+        return tls.HTTPSConnection(host, port)
+    return httplib.HTTPConnection(host, port)
+
+
+def is_connection_alive(pconn):
+    """Cheap check that an idle keep-alive connection has not been closed by
+    the server, without sending a request.
+
+    An idle HTTP connection should have nothing to read; if the socket polls
+    readable, the server has either closed it (EOF, or a TLS close_notify
+    alert) or sent something unexpected. Either way it can't be reused.
+    Connections that are not connected yet (sock is None) connect lazily on
+    the next request and count as alive.
+    """
+    sock = getattr(pconn.conn, "sock", None)
+    if sock is None:
+        return True
+    try:
+        if hasattr(sock, "pending") and sock.pending():
+            return False
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (socket.error, select.error, ValueError):
+        return False
+    return not readable
+
+
+class PooledConnection(object):
+    """An httplib connection plus the bookkeeping used by the pool."""
+    def __init__(self, conn, key):
+        self.conn = conn
+        self.key = key
+        self.created = time.time()
+        self.last_used = self.created
+        self.requests = 0
+
+    def idle_seconds(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.last_used
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    Pool of persistent connections, with at most max_size connections per
+    host (idle plus checked out).
+
+    Idle connections are handed out most recently used first, since those
+    are the least likely to have been dropped by the server. Connections
+    idle for longer than max_idle seconds are evicted, and health_check is
+    called with each PooledConnection before it is reused; returning False
+    discards it and counts it in stale_count. The default health check,
+    is_connection_alive, polls the socket so connections the server has
+    already closed are replaced before a request is sent on them.
+
+    When all connections for a host are checked out, checkout blocks until
+    one is returned, or raises PoolTimeoutError after checkout_timeout
+    seconds (None waits forever).
+    """
+    def __init__(self, factory=make_connection, max_size=DEFAULT_POOL_SIZE,
+                 max_idle=DEFAULT_MAX_IDLE_SECONDS, checkout_timeout=None,
+                 health_check=is_connection_alive):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+
+        self._cond = threading.Condition(threading.Lock())
+        # key -> list of idle PooledConnection, most recently used last
+        self._idle = {}
+        # key -> number of open connections, idle or checked out
+        self._open = {}
+
+        self.created_count = 0
+        self.reused_count = 0
+        self.evicted_count = 0
+        self.stale_count = 0
+
+    def checkout(self, key):
+        """Get a connection for key, creating one if the pool has room.
+
+        @return: PooledConnection; must be passed back to checkin or
+                 discard when the caller is done with it.
+        """
+        deadline = None
+        if self.checkout_timeout is not None:
+            deadline = time.time() + self.checkout_timeout
+
+        self._cond.acquire()
+        try:
+            while True:
+                pconn = self._pop_idle(key)
+                if pconn is not None:
+                    self.reused_count += 1
+                    return pconn
+                if self._open.get(key, 0) < self.max_size:
+                    # Reserve the slot now, create outside the lock.
+                    self._open[key] = self._open.get(key, 0) + 1
+                    self.created_count += 1
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(
+                            "no connection to %s:%s available after %ss"
+                            % (key[1], key[2], self.checkout_timeout))
+                    self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+        try:
+            conn = self.factory(key)
+        except:
+            self._release_slot(key)
+            raise
+        return PooledConnection(conn, key)
+
+    def checkin(self, pconn):
+        """Return a healthy connection to the pool for reuse."""
+        pconn.last_used = time.time()
+        pconn.requests += 1
+        self._cond.acquire()
+        try:
+            self._idle.setdefault(pconn.key, []).append(pconn)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def discard(self, pconn):
+        """Close a checked out connection which should not be reused, e.g.
+        after a network error, and free its slot."""
+        pconn.close()
+        self._release_slot(pconn.key)
+
+    def close(self):
+        """Close all idle connections. Connections currently checked out
+        are closed when they are discarded, or are reused if checked in."""
+        self._cond.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+            for key, conns in idle.iteritems():
+                self._open[key] = self._open.get(key, 0) - len(conns)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        for conns in idle.itervalues():
+            for pconn in conns:
+                pconn.close()
+
+    def size(self, key):
+        """Number of open connections for key, idle or checked out."""
+        self._cond.acquire()
+        try:
+            return self._open.get(key, 0)
+        finally:
+            self._cond.release()
+
+    def idle_count(self, key):
+        self._cond.acquire()
+        try:
+            return len(self._idle.get(key, ()))
+        finally:
+            self._cond.release()
+
+    def _pop_idle(self, key):
+        """Pop the most recently used idle connection for key that is still
+        usable. Must be called with the lock held."""
+        conns = self._idle.get(key)
+        if not conns:
+            return None
+        now = time.time()
+        # Anything past max_idle is evicted, including connections further
+        # down the stack, so the pool shrinks back after a burst.
+        if self.max_idle is not None:
+            fresh = [c for c in conns if c.idle_seconds(now) <= self.max_idle]
+            if len(fresh) != len(conns):
+                for c in conns:
+                    if c.idle_seconds(now) > self.max_idle:
+                        self._evict(c)
+                conns[:] = fresh
+        while conns:
+            pconn = conns.pop()
+            if self.health_check is None or self.health_check(pconn):
+                return pconn
+            self.stale_count += 1
+            self._evict(pconn)
+        return None
+
+    def _evict(self, pconn):
+        # Called with the lock held.
+        pconn.close()
+        self._open[pconn.key] -= 1
+        self.evicted_count += 1
+        self._cond.notify()
+
+    def _release_slot(self, key):
+        self._cond.acquire()
+        try:
+            self._open[key] = self._open.get(key, 0) - 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
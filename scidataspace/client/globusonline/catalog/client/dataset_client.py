@@ -1,17 +1,69 @@
 """
 Client for the Dataset REST API.
 """
-import json
 import urllib
 import re
 
-from globusonline.catalog.client import rest_client
+from globusonline.catalog.client import rest_client, json_codec
 from globusonline.catalog.client.rest_client import urlquote
-from globusonline.catalog.client.operators import Op, build_selector
+from globusonline.catalog.client.operators import Op, build_selector, \
+    build_projection
+from globusonline.catalog.client.streaming import json_array_body
+from globusonline.catalog.client.annotation_buffer import AnnotationBuffer, \
+    DEFAULT_MAX_ITEMS
+from globusonline.catalog.client.paging import PageIterator, \
+    DEFAULT_PAGE_SIZE, DEFAULT_PREFETCH
+from globusonline.catalog.client.scan import RangeScanner, \
+    DEFAULT_CONCURRENCY
+from globusonline.catalog.client.bulk import chunk_ids, parallel_map, \
+    create_in_chunks, MAX_URL_LENGTH, DEFAULT_CHUNK_SIZE, \
+    DEFAULT_CHUNK_ATTEMPTS
 
 DEFAULT_BASE_URL = "https://localhost/service/dataset"
 
 
+def _listing_path(path, query, projection_list, qs):
+    """Path of a dataset or member listing. With a projection_list, the
+    listing goes through the annotation resource, which returns only the
+    projected fields; id is always among them, so the result can be paged.
+
+    >>> _listing_path("/catalog/id=1/dataset", "", None, "limit=10")
+    '/catalog/id=1/dataset/?limit=10'
+    >>> _listing_path("/catalog/id=1/dataset", "", ["name"], "limit=10")
+    '/catalog/id=1/dataset/id/annotation/id;name?limit=10'
+    """
+    if not projection_list:
+        return "%s/%s?%s" % (path, query, qs)
+    projection_list = list(projection_list)
+    if "id" not in projection_list:
+        projection_list.insert(0, "id")
+    # The annotation resource needs a selector; every record has an id.
+    return "%s/%s/annotation/%s?%s" % (path, query or "id",
+                                       build_projection(projection_list), qs)
+
+
+def _member_annotations_path(catalog_id, dataset_id, member_list,
+                             annotation_list, limit):
+    if not isinstance(member_list, (list, tuple)):
+        member_list = [member_list]
+    path = ("/catalog/id=%s/dataset/id=%s/member/%s"
+            % (urlquote(catalog_id), urlquote(dataset_id),
+               build_selector([("id", Op.EQUAL, member_list)])))
+    if annotation_list:
+        path = "%s/annotation/%s" % (path, build_projection(annotation_list))
+    return "%s?%s" % (path, urllib.urlencode(dict(limit=limit)))
+
+
+def _without_id(record):
+    """Copy of record without its id. Records may be shared with other
+    callers (see singleflight), so they are never changed in place.
+
+    >>> _without_id({"id": 1, "name": "a"})
+    {'name': 'a'}
+    """
+    return dict((k, v) for k, v in record.iteritems() if k != "id")
+
+
 class DatasetClient(rest_client.GoauthRestClient):
     """
     Note: all helper methods return the response object followed by the
@@ -22,10 +74,16 @@ class DatasetClient(rest_client.GoauthRestClient):
     typically be plain text (need to fix this in tagfielr).
     """
     def __init__(self, goauth_token, base_url=DEFAULT_BASE_URL, max_attempts=1,
-                 parse_json=True, log_requests=False):
+                 parse_json=True, log_requests=False,
+                 pool_size=rest_client.DEFAULT_POOL_SIZE, pool=None,
+                 retry_deadline=None, cache=None, rate_limiter=None,
+                 circuit_breaker=None, singleflight=None, recorder=None):
         super(DatasetClient, self).__init__(goauth_token, base_url,
                                             max_attempts, parse_json,
-                                            log_requests)
+                                            log_requests, pool_size, pool,
+                                            retry_deadline, cache,
+                                            rate_limiter, circuit_breaker,
+                                            singleflight, recorder)
 
     def create_catalog(self, catalog_dict=None, **kw):
         """Create a catalog with the given name and addional attributes
@@ -41,7 +99,7 @@ class DatasetClient(rest_client.GoauthRestClient):
             catalog_dict = kw
         else:
             catalog_dict.update(kw)
-        body = json.dumps(catalog_dict)
+        body = json_codec.dumps(catalog_dict)
         return self._request("POST", "/catalog", body)
 
     def delete_catalog(self, catalog_id):
@@ -67,7 +125,7 @@ class DatasetClient(rest_client.GoauthRestClient):
         """
         return self._request("POST", "/catalog/id=%s/dataset"
                                      % urlquote(catalog_id),
-                             json.dumps(dataset))
+                             json_codec.dumps(dataset))
 
     def delete_dataset(self, catalog_id, dataset_id):
         """Delete the specified dataset."""
@@ -76,11 +134,17 @@ class DatasetClient(rest_client.GoauthRestClient):
                                           urlquote(dataset_id)))
 
     def get_datasets(self, catalog_id, last_id=None, limit=100,
-                     selector_list=None):
+                     selector_list=None, stream=False, projection_list=None):
         """Get a paged list of datasets the user has permission to view.
         Paging is done based on last id from the previous page, not numeric
         offset.
 
+        @param stream: return an iterator which decodes the datasets as
+                       they arrive, instead of a list
+        @param projection_list: optional list of the fields to return (see
+                                build_projection), plus id; defaults to
+                                all fields.
+
         @return: list of dataset dictionaries
         """
         params = dict(limit=limit)
@@ -88,10 +152,46 @@ class DatasetClient(rest_client.GoauthRestClient):
         if selector_list is None:
             selector_list = []
         if last_id is not None:
-            selector_list += [("id", Op.GT, last_id)]
+            selector_list = selector_list + [("id", Op.GT, last_id)]
         query = build_selector(selector_list)
-        return self._request("GET", "/catalog/id=%s/dataset/%s?%s"
-                                    % (urlquote(catalog_id), query, qs))
+        path = _listing_path("/catalog/id=%s/dataset" % urlquote(catalog_id),
+                            query, projection_list, qs)
+        return self._request("GET", path, stream=stream)
+
+    def iter_datasets(self, catalog_id, selector_list=None,
+                      projection_list=None, page_size=DEFAULT_PAGE_SIZE,
+                      prefetch=DEFAULT_PREFETCH):
+        """Iterate over all matching datasets, requesting them page_size at
+        a time and fetching up to prefetch pages ahead in the background
+        (see paging.PageIterator). Close the iterator when abandoning it
+        early.
+
+        @return: iterator of dataset dictionaries
+        """
+        def fetch_page(last_id, limit):
+            _, datasets = self.get_datasets(catalog_id, last_id, limit,
+                                            selector_list,
+                                            projection_list=projection_list)
+            return datasets
+        return PageIterator(fetch_page, page_size, prefetch)
+
+    def scan_datasets(self, catalog_id, selector_list=None,
+                      projection_list=None, concurrency=DEFAULT_CONCURRENCY,
+                      ordered=True, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate over all matching datasets, fetching several id ranges
+        at once (see scan.RangeScanner). For full scans of large catalogs;
+        the connection pool should hold concurrency connections.
+
+        @param ordered: yield the datasets in id order
+        @return: iterator of dataset dictionaries
+        """
+        def fetch_page(selector_list, last_id, limit):
+            _, datasets = self.get_datasets(catalog_id, last_id, limit,
+                                            selector_list,
+                                            projection_list=projection_list)
+            return datasets
+        return RangeScanner(fetch_page, concurrency, page_size).scan(
+            selector_list or (), ordered)
 
     def get_dataset_acl(self, catalog_id, dataset_id):
         path = "/catalog/id=%s/dataset/id=%s/acl" % (
@@ -101,7 +201,7 @@ class DatasetClient(rest_client.GoauthRestClient):
     def add_dataset_acl(self, catalog_id, dataset_id, access_rules):
         path = "/catalog/id=%s/dataset/id=%s/acl" % (
                     urlquote(catalog_id), urlquote(dataset_id))
-        return self._request("POST", path, json.dumps(access_rules))
+        return self._request("POST", path, json_codec.dumps(access_rules))
 
     def get_dataset_access_rule(self, catalog_id, dataset_id, principal_type,
                                 principal):
@@ -123,7 +223,7 @@ class DatasetClient(rest_client.GoauthRestClient):
 
     def get_dataset_annotations(self, catalog_id, dataset_id=None,
                                 annotation_list=None, selector_list=None,
-                                **params):
+                                stream=False, **params):
         """Get a list of annotations on the matching datasets in the specified
         catalog. Pass either dataset_id for a single dataset, a
         selector_list for complex searching, or neither to get all datasets
@@ -133,8 +233,11 @@ class DatasetClient(rest_client.GoauthRestClient):
         @param dataset_id: dataset to return annotation for
         @param selector_list: list of selector tuples, as an alternative to
                               dataset_id
-        @param annotation_list: optional list of annotation names to return;
+        @param annotation_list: optional list of annotation names to return,
+                                or a projection list for build_projection;
                                 defaults to all annotations.
+        @param stream: return an iterator which decodes the records as they
+                       arrive, instead of a list
         """
         if selector_list is not None and dataset_id is not None:
             raise ValueError("specify one of selector_list or dataset_id")
@@ -147,11 +250,10 @@ class DatasetClient(rest_client.GoauthRestClient):
         path = "/catalog/id=%s/dataset/%s/annotation" %(
                 urlquote(catalog_id), query)
         if annotation_list is not None:
-            path = "%s/%s" % (path,
-                              ";".join(urlquote(x) for x in annotation_list))
+            path = "%s/%s" % (path, build_projection(annotation_list))
         if params:
             path = "%s?%s" % (path, urllib.urlencode(params))
-        return self._request("GET", path)
+        return self._request("GET", path, stream=stream)
 
     def get_dataset_annotation_ranges(self, catalog_id, dataset_id=None,
                                       annotation_list=None,
@@ -167,7 +269,7 @@ class DatasetClient(rest_client.GoauthRestClient):
                                 annotations_dict):
         path = "/catalog/id=%s/dataset/id=%s/annotation" %(
                 urlquote(catalog_id), urlquote(dataset_id))
-        return self._request("POST", path, json.dumps(annotations_dict))
+        return self._request("POST", path, json_codec.dumps(annotations_dict))
 
     def delete_dataset_annotation(self, catalog_id, dataset_id,
                                  annotation_name, annotation_value=None):
@@ -188,18 +290,45 @@ class DatasetClient(rest_client.GoauthRestClient):
         interface."""
         return self.create_members(catalog_id, dataset_id, [member])
 
-    def create_members(self, catalog_id, dataset_id, members):
+    def create_members(self, catalog_id, dataset_id, members, stream=False,
+                       compress=False):
         """Create members in the given dataset.
 
         @param catalog_id: catalog to create the member in
-        @param member: list of dictionaries of member properties
+        @param member: list of dictionaries of member properties, or any
+                       iterable of them (e.g. a generator), which is
+                       encoded incrementally and streamed to the server
+        @param stream: stream a list too, instead of encoding it up front
+        @param compress: gzip the request body; implies stream
 
         @return: list of dictionary of member properties (most notably 'id')
         """
+        if stream or compress or not isinstance(members, (list, tuple)):
+            body = json_array_body(members, compress)
+        else:
+            body = json_codec.dumps(members)
         return self._request("POST", "/catalog/id=%s/dataset/id=%s/member"
                                      % (urlquote(catalog_id),
                                         urlquote(dataset_id)),
-                             json.dumps(members))
+                             body)
+
+    def create_members_bulk(self, catalog_id, dataset_id, members,
+                            chunk_size=DEFAULT_CHUNK_SIZE,
+                            concurrency=DEFAULT_CONCURRENCY,
+                            max_attempts=DEFAULT_CHUNK_ATTEMPTS):
+        """Create any number of members, chunk_size per request with up to
+        concurrency requests at once. Failed chunks are retried or split on
+        their own (see bulk.create_in_chunks), so one failure does not lose
+        the whole batch.
+
+        @param members: list or other iterable of member dictionaries
+        @return: bulk.BulkCreateResult with the id or error of each member
+        """
+        def create_chunk(chunk):
+            _, created = self.create_members(catalog_id, dataset_id, chunk)
+            return created
+        return create_in_chunks(create_chunk, members, chunk_size,
+                                concurrency, max_attempts)
 
     def delete_member(self, catalog_id, dataset_id, member_id):
         """Delete the specified member."""
@@ -209,11 +338,17 @@ class DatasetClient(rest_client.GoauthRestClient):
                                  urlquote(dataset_id),
                                  urlquote(member_id)))
 
-    def get_members(self, catalog_id, dataset_id, last_id=None, limit=100, selector_list=None):
+    def get_members(self, catalog_id, dataset_id, last_id=None, limit=100, selector_list=None, stream=False, projection_list=None):
         """Get a list of all members the user has permission to view.
         Paging is done based on last id from the previous page, not numeric
         offset.
 
+        @param stream: return an iterator which decodes the members as they
+                       arrive, instead of a list
+        @param projection_list: optional list of the fields to return (see
+                                build_projection), plus id; defaults to
+                                all fields.
+
         @return: list of member dictionaries
         """
         params = dict(limit=limit)
@@ -221,9 +356,43 @@ class DatasetClient(rest_client.GoauthRestClient):
         if selector_list is None:
             selector_list = []
         if last_id is not None:
-            selector_list += [("id", Op.GT, last_id)]
+            selector_list = selector_list + [("id", Op.GT, last_id)]
         query = build_selector(selector_list)
-        return self._request("GET", "/catalog/id=%s/dataset/id=%s/member/%s?%s" % (urlquote(catalog_id), urlquote(dataset_id),query, qs))
+        path = _listing_path("/catalog/id=%s/dataset/id=%s/member"
+                            % (urlquote(catalog_id), urlquote(dataset_id)),
+                            query, projection_list, qs)
+        return self._request("GET", path, stream=stream)
+
+    def iter_members(self, catalog_id, dataset_id, selector_list=None,
+                     projection_list=None, page_size=DEFAULT_PAGE_SIZE,
+                     prefetch=DEFAULT_PREFETCH):
+        """Iterate over all matching members of a dataset, like
+        iter_datasets.
+
+        @return: iterator of member dictionaries
+        """
+        def fetch_page(last_id, limit):
+            _, members = self.get_members(catalog_id, dataset_id, last_id,
+                                          limit, selector_list,
+                                          projection_list=projection_list)
+            return members
+        return PageIterator(fetch_page, page_size, prefetch)
+
+    def scan_members(self, catalog_id, dataset_id, selector_list=None,
+                     projection_list=None, concurrency=DEFAULT_CONCURRENCY,
+                     ordered=True, page_size=DEFAULT_PAGE_SIZE):
+        """Iterate over all matching members of a dataset, like
+        scan_datasets.
+
+        @return: iterator of member dictionaries
+        """
+        def fetch_page(selector_list, last_id, limit):
+            _, members = self.get_members(catalog_id, dataset_id, last_id,
+                                          limit, selector_list,
+                                          projection_list=projection_list)
+            return members
+        return RangeScanner(fetch_page, concurrency, page_size).scan(
+            selector_list or (), ordered)
 
     def create_annotation_def(self, catalog_id, annotation_name,
                               value_type, multivalued=False, unique=False):
@@ -233,7 +402,7 @@ class DatasetClient(rest_client.GoauthRestClient):
         return self._request("PUT", "/catalog/id=%s/annotation_def/%s"
                                     % (urlquote(catalog_id),
                                        urlquote(annotation_name)),
-                             json.dumps(body))
+                             json_codec.dumps(body))
 
     def get_annotation_defs(self, catalog_id):
         """Get a list of all annotations defined for the catalog.
@@ -253,37 +422,142 @@ class DatasetClient(rest_client.GoauthRestClient):
         path = ("/catalog/id=%s/dataset/id=%s/member/id=%s/annotation"
                 % (urlquote(catalog_id), urlquote(dataset_id),
                    urlquote(member_id)))
-        body = json.dumps(annotation_dict)
+        body = json_codec.dumps(annotation_dict)
         return self._request("POST", path, body)
 
+    def annotation_buffer(self, max_items=DEFAULT_MAX_ITEMS, max_delay=None,
+                          on_result=None):
+        """Get an AnnotationBuffer which merges annotation writes per
+        dataset or member and sends them with this client in batches.
+        Use it as a context manager, or flush it explicitly; anything left
+        is flushed at exit.
+        """
+        return AnnotationBuffer(self, max_items, max_delay, on_result)
+
     def get_member_annotations(self, catalog_id, dataset_id, member_id,
                                annotation_list=None):
         path = ("/catalog/id=%s/dataset/id=%s/member/id=%s/annotation"
                 % (urlquote(catalog_id), urlquote(dataset_id),
                    urlquote(member_id)))
         if annotation_list:
-            # TODO: handle tag=value patterns, useful for multivalued
-            # tags
-            pattern = ";".join(urlquote(x) for x in annotation_list)
-            path = "%s/%s" % (path, pattern)
+            path = "%s/%s" % (path, build_projection(annotation_list))
         return self._request("GET", path)
 
-    def get_all_member_annotations(self, catalog_id, dataset_id, member_list, annotation_list=None, limit=100):
-        path = ("/catalog/id=%s/dataset/id=%s/member"
-                % (urlquote(catalog_id), urlquote(dataset_id)))
-        print path
-
-        params = dict(limit=limit)
-        qs = urllib.urlencode(params)
+    def get_all_member_annotations(self, catalog_id, dataset_id,
+                                   member_list, annotation_list=None,
+                                   limit=100):
+        """Get the annotations of several members in one request.
 
-        if annotation_list:
-            # TODO: handle tag=value patterns, useful for multivalued
-            # tags
-            member_pattern = ";".join(urlquote(x) for x in annotation_list)
-            annotation_pattern = ";".join(urlquote(y) for y in annotation_list)
-            path = "%s/%s/annotation/%s?%s" % (path, member_pattern, annotation_pattern,qs)
-            print path
-        return self._request("GET", path)
+        @param member_list: member id, or list of member ids
+        @param annotation_list: optional list of annotation names to return,
+                                or a projection list for build_projection;
+                                by default the member records are returned.
+        @return: list of dictionaries, one per member found
+        """
+        return self._request("GET", _member_annotations_path(
+            catalog_id, dataset_id, member_list, annotation_list, limit))
+
+    def iter_member_annotations(self, catalog_id, dataset_id,
+                                member_ids=None, annotation_list=None,
+                                concurrency=DEFAULT_CONCURRENCY,
+                                ordered=True):
+        """Iterate over the annotations of many members: all members of the
+        dataset, or those in member_ids. The ids are split into chunks that
+        fit in a URL, which are fetched concurrently.
+
+        Without an annotation_list, every annotation present on a member is
+        returned; that costs two requests per chunk, one for the names
+        present (annotations_present) and one for their values.
+
+        @param annotation_list: optional list of annotation names to return
+        @param ordered: yield in the order of member_ids (in id order for
+                        the whole dataset), otherwise as chunks arrive
+        @return: iterator of (member_id, annotations dictionary) pairs;
+                 ids not found in the dataset are skipped
+        """
+        present = {}
+        if member_ids is None:
+            if annotation_list is not None:
+                members = self.scan_members(catalog_id, dataset_id,
+                                            projection_list=annotation_list,
+                                            concurrency=concurrency,
+                                            ordered=ordered)
+                return ((m["id"], _without_id(m)) for m in members)
+            # The listing gives the names present along with the ids, so
+            # each chunk then needs only one request for the values.
+            for m in self.scan_members(
+                    catalog_id, dataset_id, concurrency=concurrency,
+                    projection_list=["annotations_present"]):
+                present[str(m["id"])] = m["annotations_present"] or ()
+            member_ids = sorted(present, key=int)
+
+        # Room left in the URL for the ids, after everything else. Names
+        # take up to half of the URL; fetch_values splits the requests
+        # that need more.
+        fixed = len("%s/catalog/id=%s/dataset/id=%s/member/id=/annotation/"
+                    "?limit=%d" % (self._base_path, urlquote(catalog_id),
+                                   urlquote(dataset_id), len(member_ids)))
+        projection = build_projection(["id"] + list(annotation_list or []))
+        if annotation_list is None or len(projection) > MAX_URL_LENGTH // 2:
+            fixed += MAX_URL_LENGTH // 2
+        else:
+            fixed += len(projection)
+        chunks = chunk_ids(member_ids, MAX_URL_LENGTH - fixed)
+
+        def names_of(ids):
+            if annotation_list is not None:
+                return list(annotation_list)
+            return sorted(set(name for id in ids
+                              for name in present.get(str(id), ())))
+
+        def fetch_values(ids, names):
+            # As many requests as it takes to keep each URL short enough:
+            # halve the ids, and split the names of a single member.
+            path = _member_annotations_path(catalog_id, dataset_id, ids,
+                                            ["id"] + names, len(ids))
+            if (len(self._base_path + path) <= MAX_URL_LENGTH
+                    or len(ids) == 1 and len(names) <= 1):
+                _, records = self.get_all_member_annotations(
+                    catalog_id, dataset_id, ids, ["id"] + names,
+                    limit=len(ids))
+                return records
+            if len(ids) > 1:
+                middle = len(ids) // 2
+                return (fetch_values(ids[:middle], names_of(ids[:middle]))
+                        + fetch_values(ids[middle:], names_of(ids[middle:])))
+            middle = len(names) // 2
+            merged = {}
+            for part in (names[:middle], names[middle:]):
+                for record in fetch_values(ids, part):
+                    merged.setdefault(record["id"], {}).update(record)
+            return merged.values()
+
+        def fetch_chunk(ids):
+            if annotation_list is None:
+                missing = [id for id in ids if str(id) not in present]
+                if missing:
+                    _, records = self.get_all_member_annotations(
+                        catalog_id, dataset_id, missing,
+                        ["id", "annotations_present"], limit=len(missing))
+                    for record in records:
+                        present[str(record["id"])] = (
+                            record["annotations_present"] or ())
+            records = fetch_values(ids, names_of(ids))
+            by_id = {}
+            for record in records:
+                member_id = record["id"]
+                if annotation_list is None:
+                    # Drop the names only present on other members.
+                    record = dict((k, v) for k, v in record.iteritems()
+                                  if k != "id" and v is not None)
+                else:
+                    record = _without_id(record)
+                by_id[str(member_id)] = (member_id, record)
+            return [by_id[str(id)] for id in ids if str(id) in by_id]
+
+        return (pair for pairs in parallel_map(fetch_chunk, chunks,
+                                               concurrency, ordered)
+                for pair in pairs)
 
     def delete_member_annotation(self, catalog_id, dataset_id, member_id,
                                  annotation_name, annotation_value=None):
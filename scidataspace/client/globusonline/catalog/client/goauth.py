@@ -27,9 +27,9 @@ import getpass
 from collections import namedtuple
 import json
 import base64
-import httplib
 
 from globusonline.catalog.client.verified_https import VerifiedHTTPSConnection
+from globusonline.catalog.client.tls import HTTPSConnection
 
 ##Test Authentication Service
 #HOST = "graph.api.test.globuscs.info"
@@ -102,7 +102,7 @@ def get_access_token(username=None, password=None, ca_certs=None):
     if ca_certs is not None:
         c = VerifiedHTTPSConnection(HOST, PORT, ca_certs=ca_certs)
     else:
-        c = httplib.HTTPSConnection(HOST, PORT)
+        c = HTTPSConnection(HOST, PORT)
     c.request("GET", GOAUTH_PATH, headers=headers)
     response = c.getresponse()
     if response.status == 403:
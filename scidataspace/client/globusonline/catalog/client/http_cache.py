@@ -0,0 +1,271 @@
+"""
+Conditional GET cache for GoauthRestClient.
+
+Responses to GET requests that carry an ETag or Last-Modified header are
+kept, and the next GET of the same path is sent with If-None-Match /
+If-Modified-Since. When the server answers 304 Not Modified the cached body
+is used instead, so unchanged listings cost a round trip but no transfer.
+
+Entries are kept in memory, least recently used first out once max_bytes
+is exceeded, and optionally in a directory on disk so they survive between
+runs of short-lived processes like the CLI.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 64 * 1024 * 1024
+
+
+CacheEntry = namedtuple("CacheEntry",
+                        "path etag last_modified status content_type body")
+
+
+def default_directory():
+    return os.path.join(os.path.expanduser("~"), ".gdclient", "http_cache")
+
+
+def cache_key(goauth_token, path):
+    """Responses depend on who is asking, so entries are per token."""
+    return "%s %s" % (hashlib.sha1(goauth_token).hexdigest()[:16], path)
+
+
+def invalidation_prefix(path):
+    """Paths starting with the returned prefix may have changed after a
+    write to path: everything in the same catalog, or everything when the
+    catalog itself was written.
+
+    >>> invalidation_prefix("/service/dataset/catalog/id=5/dataset/id=7/acl")
+    '/service/dataset/catalog/id=5'
+    >>> invalidation_prefix("/service/dataset/catalog/id=5")
+    '/service/dataset/catalog'
+    >>> invalidation_prefix("/service/dataset/catalog")
+    '/service/dataset/catalog'
+    """
+    path = path.split("?", 1)[0]
+    parts = path.split("/")
+    try:
+        i = parts.index("catalog")
+    except ValueError:
+        return path
+    if len(parts) > i + 2:
+        return "/".join(parts[:i + 2])
+    return "/".join(parts[:i + 1])
+
+
+def under_prefix(path, prefix):
+    """Whether path is prefix or below it, e.g. a listing of it, rather
+    than another path that happens to start the same way.
+
+    >>> under_prefix("/catalog/id=5/dataset", "/catalog/id=5")
+    True
+    >>> under_prefix("/catalog/id=5?limit=10", "/catalog/id=5")
+    True
+    >>> under_prefix("/catalog/id=50/dataset", "/catalog/id=5")
+    False
+    """
+    return (path.startswith(prefix)
+            and (len(path) == len(prefix) or path[len(prefix)] in "/;?"))
+
+
+def _entry_size(entry):
+    return len(entry.body) + len(entry.path) + 128
+
+
+class ResponseCache(object):
+    """
+    Thread-safe LRU store of CacheEntry objects, limited to max_bytes of
+    response bodies in memory. If directory is given, entries are also
+    written there, limited to disk_max_bytes, and read back on a memory
+    miss.
+
+    hits and misses count the lookups that found an entry (in memory or
+    on disk) and those that did not.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None,
+                 disk_max_bytes=DEFAULT_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        if directory is not None:
+            self._disk = _DiskStore(directory, disk_max_bytes)
+        else:
+            self._disk = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+        if self._disk is not None:
+            entry = self._disk.get(key)
+            if entry is not None:
+                self._put_memory(key, entry)
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry
+
+    def put(self, key, entry):
+        self._put_memory(key, entry)
+        if self._disk is not None:
+            self._disk.put(key, entry)
+
+    def invalidate(self, prefix):
+        """Drop all entries for prefix and the paths below it."""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if under_prefix(entry.path, prefix):
+                    del self._entries[key]
+                    self._size -= _entry_size(entry)
+        if self._disk is not None:
+            self._disk.invalidate(prefix)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if self._disk is not None:
+            self._disk.invalidate("")
+
+    def _put_memory(self, key, entry):
+        size = _entry_size(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= _entry_size(old)
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= _entry_size(evicted)
+
+
+class _DiskStore(object):
+    """One file per entry, named by the hash of its key: a line of JSON
+    metadata followed by the raw body. An index of all files is kept in
+    memory, least recently used first, for invalidation and eviction.
+
+    The responses were fetched with the user's token, so the directory and
+    files are only accessible to the user."""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # file name -> (path, size)
+        self._index = OrderedDict()
+        self._size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        else:
+            try:
+                os.chmod(directory, 0700)
+            except OSError:
+                pass
+        self._load_index()
+
+    def _load_index(self):
+        names = []
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            try:
+                names.append((os.path.getmtime(filename), name))
+            except OSError:
+                pass
+        for _, name in sorted(names):
+            filename = os.path.join(self.directory, name)
+            try:
+                with open(filename, "rb") as f:
+                    meta = json.loads(f.readline())
+                size = os.path.getsize(filename)
+            except (IOError, OSError, ValueError):
+                continue
+            self._index[name] = (meta["path"], size)
+            self._size += size
+
+    def _filename(self, key):
+        return hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        name = self._filename(key)
+        with self._lock:
+            if name not in self._index:
+                return None
+            self._index[name] = self._index.pop(name)
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (IOError, ValueError):
+            self._remove(name)
+            return None
+        if meta.get("key") != key:
+            return None
+        return CacheEntry(meta["path"], meta["etag"], meta["last_modified"],
+                          meta["status"], meta["content_type"], body)
+
+    def put(self, key, entry):
+        name = self._filename(key)
+        meta = dict(key=key, path=entry.path, etag=entry.etag,
+                    last_modified=entry.last_modified, status=entry.status,
+                    content_type=entry.content_type, time=time.time())
+        data = json.dumps(meta) + "\n" + entry.body
+        if len(data) > self.max_bytes:
+            return
+        filename = os.path.join(self.directory, name)
+        tmp_filename = "%s.tmp%d" % (filename, threading.current_thread().ident)
+        try:
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            return
+        evict = []
+        with self._lock:
+            old = self._index.pop(name, None)
+            if old is not None:
+                self._size -= old[1]
+            self._index[name] = (entry.path, len(data))
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                evicted, (_, size) = self._index.popitem(last=False)
+                self._size -= size
+                evict.append(evicted)
+        for evicted in evict:
+            self._unlink(evicted)
+
+    def invalidate(self, prefix):
+        with self._lock:
+            names = [name for name, (path, _) in self._index.iteritems()
+                     if under_prefix(path, prefix)]
+        for name in names:
+            self._remove(name)
+
+    def _remove(self, name):
+        with self._lock:
+            old = self._index.pop(name, None)
+            if old is not None:
+                self._size -= old[1]
+        self._unlink(name)
+
+    def _unlink(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
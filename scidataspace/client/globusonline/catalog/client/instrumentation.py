@@ -0,0 +1,270 @@
+"""
+Request instrumentation for GoauthRestClient.
+
+Listeners registered with client.add_listener receive a RequestEvent at
+each stage of a call:
+
+    before_send(event)        before each attempt is sent
+    on_retry(event, delay)    after a failed attempt, before sleeping
+    after_response(event)     once the final response has been read
+    on_error(event, error)    when the call raises, including for HTTP
+                              error statuses (RestClientError)
+    on_circuit_state(old_state, new_state)
+                              when the client's circuit breaker changes
+                              state (see circuit_breaker)
+
+A listener only needs to define the callbacks it is interested in.
+LatencyCollector is a listener which keeps latency histograms per endpoint.
+"""
+import re
+import time
+import threading
+
+# Upper bounds of the histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# Path segments following one of these hold a caller supplied name.
+_NAME_PARENTS = set(["annotation", "annotation_def", "user", "group"])
+_SELECTOR_CHARS = re.compile(r"[=;:,%]")
+
+
+def template_path(path):
+    """Reduce a request path to its endpoint, replacing ids, names,
+    selectors and the query string with placeholders, so calls to the same
+    endpoint can be aggregated.
+
+    >>> template_path("/service/dataset/catalog/id=5/dataset/id=7/member/")
+    '/service/dataset/catalog/id={id}/dataset/id={id}/member/'
+    >>> template_path("/catalog/id=5/dataset/name;id:gt:12?limit=100")
+    '/catalog/id={id}/dataset/{selector}'
+    >>> template_path("/catalog/id=5/annotation_def/size")
+    '/catalog/id={id}/annotation_def/{name}'
+    >>> template_path("/catalog/id=1/dataset/id=2/acl/user/bob")
+    '/catalog/id={id}/dataset/id={id}/acl/user/{name}'
+    """
+    path = path.split("?", 1)[0]
+    parts = path.split("/")
+    for i in xrange(1, len(parts)):
+        part = parts[i]
+        if part.startswith("id=") and ";" not in part:
+            parts[i] = "id={id}"
+        elif part and parts[i - 1] in _NAME_PARENTS:
+            parts[i] = "{name}"
+        elif _SELECTOR_CHARS.search(part):
+            parts[i] = "{selector}"
+    return "/".join(parts)
+
+
+class RequestEvent(object):
+    """
+    State of one call to GoauthRestClient._request, passed to listeners.
+
+    attempt is the zero based number of the current attempt (so the retry
+    count after the call), status is None until a response has been
+    received, and stats is the CallStats of the latest response, which
+    holds the byte counts and the connect, TLS handshake, wait and read
+    times.
+    """
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.start = time.time()
+        self.attempt = 0
+        self.status = None
+        self.stats = None
+        self.error = None
+        self._template = None
+
+    @property
+    def template(self):
+        if self._template is None:
+            self._template = template_path(self.path)
+        return self._template
+
+    @property
+    def endpoint(self):
+        return "%s %s" % (self.method, self.template)
+
+    def _stat(self, name):
+        if self.stats is None:
+            return 0
+        return getattr(self.stats, name)
+
+    bytes_out = property(lambda self: self._stat("sent_bytes"))
+    bytes_in = property(lambda self: self._stat("wire_bytes"))
+    connect_time = property(lambda self: self._stat("connect_time"))
+    handshake_time = property(lambda self: self._stat("handshake_time"))
+    wait_time = property(lambda self: self._stat("wait_time"))
+    read_time = property(lambda self: self._stat("read_time"))
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    def __repr__(self):
+        return ("RequestEvent(%s, attempt=%d, status=%s, bytes_out=%d, "
+                "bytes_in=%d)" % (self.endpoint, self.attempt, self.status,
+                                  self.bytes_out, self.bytes_in))
+
+
+class RequestListener(object):
+    """Base class for listeners, with all callbacks doing nothing."""
+    def before_send(self, event):
+        pass
+
+    def on_retry(self, event, delay):
+        pass
+
+    def after_response(self, event):
+        pass
+
+    def on_error(self, event, error):
+        pass
+
+    def on_circuit_state(self, old_state, new_state):
+        pass
+
+
+class LatencyHistogram(object):
+    """Count of observed latencies per bucket of LATENCY_BUCKETS."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, p):
+        """Upper bound of the bucket containing the p-th percentile, or the
+        maximum if that is lower."""
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return dict(count=self.count, mean=self.mean, min=self.min,
+                    max=self.max, p50=self.percentile(50),
+                    p95=self.percentile(95), p99=self.percentile(99),
+                    buckets=[(b, n) for b, n in zip(self.buckets,
+                                                    self.counts) if n])
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.wait = LatencyHistogram()
+        self.connect_time = 0.0
+        self.handshake_time = 0.0
+        self.read_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+        self.errors = 0
+        self.statuses = {}
+
+    def as_dict(self):
+        return dict(latency=self.latency.as_dict(),
+                    wait=self.wait.as_dict(),
+                    connect_time=self.connect_time,
+                    handshake_time=self.handshake_time,
+                    read_time=self.read_time,
+                    bytes_in=self.bytes_in, bytes_out=self.bytes_out,
+                    retries=self.retries, errors=self.errors,
+                    statuses=self.statuses)
+
+
+class LatencyCollector(RequestListener):
+    """
+    Listener aggregating calls per endpoint ("METHOD templated-path"):
+    latency and server wait histograms, bytes in and out, retries, errors
+    and status counts.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _get(self, event):
+        stats = self._endpoints.get(event.endpoint)
+        if stats is None:
+            stats = self._endpoints[event.endpoint] = EndpointStats()
+        return stats
+
+    def on_retry(self, event, delay):
+        with self._lock:
+            self._get(event).retries += 1
+
+    def after_response(self, event):
+        with self._lock:
+            stats = self._get(event)
+            stats.latency.add(event.elapsed)
+            stats.wait.add(event.wait_time)
+            stats.connect_time += event.connect_time
+            stats.handshake_time += event.handshake_time
+            stats.read_time += event.read_time
+            stats.bytes_in += event.bytes_in
+            stats.bytes_out += event.bytes_out
+            stats.statuses[event.status] = \
+                stats.statuses.get(event.status, 0) + 1
+
+    def on_error(self, event, error):
+        with self._lock:
+            stats = self._get(event)
+            stats.errors += 1
+            if event.status is None:
+                # Network errors never reach after_response.
+                stats.latency.add(event.elapsed)
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def report(self):
+        """Collected statistics as a dictionary keyed by endpoint."""
+        with self._lock:
+            return dict((endpoint, stats.as_dict())
+                        for endpoint, stats in self._endpoints.iteritems())
+
+    def format_report(self):
+        """Human readable table of the collected statistics, slowest
+        endpoints (by total time) first."""
+        report = self.report()
+        lines = ["%-60s %6s %8s %8s %8s %8s %10s %5s %5s"
+                 % ("endpoint", "calls", "mean", "p50", "p95", "p99",
+                    "bytes_in", "retry", "err")]
+        order = sorted(report.iteritems(), reverse=True,
+                       key=lambda item: item[1]["latency"]["mean"]
+                                        * item[1]["latency"]["count"])
+        for endpoint, stats in order:
+            latency = stats["latency"]
+            lines.append("%-60s %6d %8.3f %8.3f %8.3f %8.3f %10d %5d %5d"
+                         % (endpoint[:60], latency["count"], latency["mean"],
+                            latency["p50"], latency["p95"], latency["p99"],
+                            stats["bytes_in"], stats["retries"],
+                            stats["errors"]))
+        return "\n".join(lines)
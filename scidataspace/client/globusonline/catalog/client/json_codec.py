@@ -0,0 +1,116 @@
+"""
+JSON encoding and decoding for the catalog clients.
+
+Member and annotation listings can be several megabytes, and the stdlib
+json module spends a noticeable amount of CPU on them. The clients encode
+and decode through this module instead, which uses the fastest JSON library
+installed, in the order of PREFERENCE, and falls back to the stdlib.
+
+The codec can be chosen per deployment with the GDCLIENT_JSON_CODEC
+environment variable (one of the CODECS names), or in code with set_codec.
+Run the benchmark.codec module to compare the installed codecs on catalog
+shaped payloads.
+
+Incremental decoding (streaming.iterdecode_array) always uses the stdlib,
+since it relies on JSONDecoder.raw_decode.
+"""
+import os
+import json
+import logging
+
+PREFERENCE = ("ujson", "simplejson", "json")
+
+_log = logging.getLogger("globusonline.catalog.json_codec")
+
+
+class JsonCodec(object):
+    """A named pair of loads and dumps functions."""
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return "JsonCodec(%r)" % self.name
+
+
+def _load_ujson():
+    import ujson
+    # ujson encodes floats with at most 15 significant digits, so values
+    # would not survive a round trip; only use it for decoding, which is
+    # exact with precise_float.
+    return JsonCodec("ujson",
+                     lambda s: ujson.loads(s, precise_float=True),
+                     json.dumps)
+
+
+def _load_simplejson():
+    import simplejson
+    # Pure python simplejson is slower than the stdlib, so require the C
+    # extension.
+    from simplejson import _speedups
+    return JsonCodec("simplejson", simplejson.loads, simplejson.dumps)
+
+
+def _load_json():
+    return JsonCodec("json", json.loads, json.dumps)
+
+
+CODECS = {
+    "ujson": _load_ujson,
+    "simplejson": _load_simplejson,
+    "json": _load_json,
+}
+
+
+def load_codec(name):
+    """Get the named codec. Raises ImportError if its library is not
+    installed and ValueError for unknown names."""
+    if name not in CODECS:
+        raise ValueError("Unknown JSON codec %r, expected one of %s"
+                         % (name, ", ".join(PREFERENCE)))
+    return CODECS[name]()
+
+
+def available_codecs():
+    """Codecs whose library is installed, fastest first."""
+    codecs = []
+    for name in PREFERENCE:
+        try:
+            codecs.append(load_codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+
+def _default_codec():
+    name = os.environ.get("GDCLIENT_JSON_CODEC")
+    if name:
+        try:
+            return load_codec(name)
+        except (ImportError, ValueError) as e:
+            _log.warning("Ignoring GDCLIENT_JSON_CODEC=%s: %s", name, e)
+    return available_codecs()[0]
+
+
+_codec = _default_codec()
+
+
+def get_codec():
+    return _codec
+
+
+def set_codec(codec):
+    """Use codec (a JsonCodec or a codec name) from now on."""
+    global _codec
+    if not isinstance(codec, JsonCodec):
+        codec = load_codec(codec)
+    _codec = codec
+
+
+def loads(s):
+    return _codec.loads(s)
+
+
+def dumps(obj):
+    return _codec.dumps(obj)
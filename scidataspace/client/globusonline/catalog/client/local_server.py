@@ -0,0 +1,875 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Dataset API, for running the test suite and the
+benchmarks without a Globus catalog or credentials.
+
+Implements the tagfiler style paths used by DatasetClient in memory:
+catalogs, datasets, members, annotation definitions, dataset and member
+annotations and dataset ACLs, with the build_selector query syntax (all
+operators of operators.Op), paging with id:gt: and limit, and annotation
+projections including annotations_present. Request bodies may be chunked
+and gzip encoded; responses carry an ETag, honour If-None-Match and are
+gzip compressed when the client accepts it.
+
+For measurements, every request can be delayed by a fixed latency plus
+random jitter, answered with a 503 (optionally with Retry-After) or have
+its connection reset, each with a configurable probability, idle keep-alive
+connections can be closed after idle_timeout seconds, and the store can
+be filled with synthetic datasets and members of a given size:
+
+    server = LocalCatalogServer(latency=0.01, error_rate=0.05)
+    server.start()
+    catalog_id = server.store.populate(datasets=10, members=1000)
+    client = DatasetClient("un=tester|", server.url)
+    ...
+    server.stop()
+
+It can also be run standalone:
+
+    python -m globusonline.catalog.client.local_server --port 8080 \
+        --latency 0.02 --error-rate 0.01 --datasets 100 --members 500
+"""
+import re
+import sys
+import atexit
+import gzip
+import json
+import time
+import zlib
+import random
+import socket
+import struct
+import hashlib
+import urllib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+from optparse import OptionParser
+
+from globusonline.catalog.client.operators import BinaryOp, UnaryOp
+
+DEFAULT_BASE_PATH = "/service/dataset"
+
+# Annotations every catalog starts with.
+BUILTIN_DEFS = (
+    ("id", "int8", False),
+    ("name", "text", False),
+    ("owner", "text", False),
+    ("data_type", "text", False),
+    ("data_uri", "text", False),
+    ("dataset_id", "int8", False),
+    ("annotations_present", "text", True),
+)
+BUILTIN_NAMES = frozenset(name for name, _, _ in BUILTIN_DEFS)
+
+# Operators ordered so that no operator is tried before one it is a
+# prefix of.
+_OPS = sorted(set(BinaryOp.values()) | set([UnaryOp.ABSENT]),
+              key=len, reverse=True)
+_TERM = re.compile(r"^(.*?)(%s)(.*)$" % "|".join(re.escape(op)
+                                                for op in _OPS))
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def _unquote(s):
+    return urllib.unquote(s).decode("utf8")
+
+
+def _like_pattern(value):
+    parts = []
+    for c in value:
+        if c == "%":
+            parts.append(".*")
+        elif c == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(c))
+    return re.compile("^%s$" % "".join(parts), re.DOTALL)
+
+
+def _coerce(value, sample):
+    """Convert a selector value (text) to the type of a stored value."""
+    if isinstance(sample, bool):
+        return value.lower() in ("true", "t", "1")
+    if isinstance(sample, (int, long)):
+        return int(value)
+    if isinstance(sample, float):
+        return float(value)
+    return value
+
+
+def _compare(op, stored, value):
+    if op in (BinaryOp.LIKE, BinaryOp.SIMTO):
+        return _like_pattern(value).match(unicode(stored)) is not None
+    if op in (BinaryOp.FULLTEXT, BinaryOp.NOT_FULLTEXT):
+        found = value.lower() in unicode(stored).lower().split()
+        return found == (op == BinaryOp.FULLTEXT)
+    if op in (BinaryOp.REGEXP, BinaryOp.NOT_REGEXP,
+              BinaryOp.REGEXP_CASE_INSENSITIVE,
+              BinaryOp.NOT_REGEXP_CASE_INSENSITIVE):
+        flags = 0
+        if op in (BinaryOp.REGEXP_CASE_INSENSITIVE,
+                  BinaryOp.NOT_REGEXP_CASE_INSENSITIVE):
+            flags = re.IGNORECASE
+        found = re.search(value, unicode(stored), flags) is not None
+        return found == (op in (BinaryOp.REGEXP,
+                                BinaryOp.REGEXP_CASE_INSENSITIVE))
+    try:
+        value = _coerce(value, stored)
+    except ValueError:
+        return op == BinaryOp.NOT_EQUAL
+    if op == BinaryOp.EQUAL:
+        return stored == value
+    if op == BinaryOp.NOT_EQUAL:
+        return stored != value
+    if op == BinaryOp.GT:
+        return stored > value
+    if op == BinaryOp.GEQ:
+        return stored >= value
+    if op == BinaryOp.LT:
+        return stored < value
+    if op == BinaryOp.LEQ:
+        return stored <= value
+    raise HTTPError(400, "Unsupported operator %s" % op)
+
+
+def parse_selector(selector):
+    """Parse a build_selector query into (name, op, values) terms.
+
+    >>> parse_selector("name;id:gt:12;data_type=file,directory")
+    [(u'name', '', []), (u'id', ':gt:', [u'12']), \
+(u'data_type', '=', [u'file', u'directory'])]
+    >>> parse_selector("a%3Bb:absent:")
+    [(u'a;b', ':absent:', [])]
+    """
+    terms = []
+    for term in selector.split(";"):
+        if not term:
+            continue
+        m = _TERM.match(term)
+        if m is None:
+            terms.append((_unquote(term), UnaryOp.TAGGED, []))
+            continue
+        name, op, values = m.groups()
+        if op == UnaryOp.ABSENT:
+            if values:
+                raise HTTPError(400, "Unary operator %s takes no value" % op)
+            values = []
+        else:
+            values = [_unquote(v) for v in values.split(",")]
+        terms.append((_unquote(name), op, values))
+    return terms
+
+
+def match_terms(record, terms):
+    """True if the record (a dict) matches all selector terms. A term
+    matches a multivalued annotation if it matches any of its values."""
+    for name, op, values in terms:
+        stored = record.get(name)
+        if stored is None or stored == []:
+            if op != UnaryOp.ABSENT:
+                return False
+            continue
+        if op == UnaryOp.ABSENT:
+            return False
+        if op == UnaryOp.TAGGED:
+            continue
+        if not isinstance(stored, list):
+            stored = [stored]
+        if op in (BinaryOp.NOT_EQUAL, BinaryOp.NOT_FULLTEXT,
+                  BinaryOp.NOT_REGEXP,
+                  BinaryOp.NOT_REGEXP_CASE_INSENSITIVE):
+            ok = all(_compare(op, s, v) for s in stored for v in values)
+        else:
+            ok = any(_compare(op, s, v) for s in stored for v in values)
+        if not ok:
+            return False
+    return True
+
+
+class CatalogStore(object):
+    """In memory catalogs. All methods take the store lock; records are
+    plain dicts holding both the builtin fields and the annotations."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.catalogs = {}
+        self._next_id = 1
+
+    def _new_id(self):
+        new_id = self._next_id
+        self._next_id += 1
+        return new_id
+
+    def create_catalog(self, body, owner):
+        with self.lock:
+            config = dict(body.get("config") or {})
+            for key in ("name", "description"):
+                if key in body:
+                    config[key] = body[key]
+            config.setdefault("owner", owner)
+            catalog = dict(id=self._new_id(), config=config, defs={},
+                           datasets={}, members={})
+            for name, value_type, multivalued in BUILTIN_DEFS:
+                catalog["defs"][name] = dict(name=name, value_type=value_type,
+                                             multivalued=multivalued,
+                                             unique=name == "id",
+                                             owner=None)
+            self.catalogs[catalog["id"]] = catalog
+            return catalog
+
+    def catalog(self, catalog_id):
+        catalog = self.catalogs.get(catalog_id)
+        if catalog is None:
+            raise HTTPError(404, "Catalog %s not found" % catalog_id)
+        return catalog
+
+    def create_dataset(self, catalog, body, owner):
+        with self.lock:
+            if "name" not in body:
+                raise HTTPError(400, "Dataset name is required")
+            dataset = dict(id=self._new_id(), owner=owner, acl=[])
+            self._set_annotations(catalog, dataset, body, replace=True)
+            catalog["datasets"][dataset["id"]] = dataset
+            return dataset
+
+    def create_members(self, catalog, dataset, members, owner):
+        with self.lock:
+            # Like the catalog, create all of them or none.
+            for body in members:
+                for name in body:
+                    if name not in catalog["defs"]:
+                        raise HTTPError(409, 'Tag "%s" not defined' % name)
+            created = []
+            for body in members:
+                member = dict(id=self._new_id(), dataset_id=dataset["id"],
+                              owner=owner)
+                self._set_annotations(catalog, member, body, replace=True)
+                catalog["members"][member["id"]] = member
+                created.append(member)
+            return created
+
+    def _set_annotations(self, catalog, record, annotations, replace=False):
+        for name in annotations:
+            if name not in catalog["defs"]:
+                raise HTTPError(409, 'Tag "%s" not defined' % name)
+        for name, value in annotations.iteritems():
+            if name in ("id", "annotations_present"):
+                continue
+            if catalog["defs"][name]["multivalued"] and not replace:
+                values = record.get(name) or []
+                if not isinstance(values, list):
+                    values = [values]
+                if not isinstance(value, list):
+                    value = [value]
+                record[name] = values + [v for v in value
+                                         if v not in values]
+            else:
+                record[name] = value
+
+    def add_annotations(self, catalog, record, annotations):
+        with self.lock:
+            self._set_annotations(catalog, record, annotations)
+
+    def delete_annotation(self, record, name, value=None):
+        with self.lock:
+            if name in BUILTIN_NAMES:
+                raise HTTPError(403, "Cannot delete %s" % name)
+            stored = record.get(name)
+            if value is None or not isinstance(stored, list):
+                if value is None or unicode(stored) == value:
+                    record.pop(name, None)
+            else:
+                stored = [v for v in stored if unicode(v) != value]
+                if stored:
+                    record[name] = stored
+                else:
+                    record.pop(name, None)
+
+    def populate(self, datasets=10, members=100, annotations=5,
+                 padding=0, seed=1, owner="tester"):
+        """Create a catalog filled with synthetic datasets, each with the
+        given number of members, and each dataset and member carrying that
+        many annotations. padding adds a text annotation of that many
+        bytes to every record, to control payload sizes.
+
+        @return: the new catalog's id
+        """
+        from globusonline.catalog.client.benchmark import payloads
+        rng = random.Random(seed)
+        with self.lock:
+            catalog = self.create_catalog(
+                dict(name="populated_%d" % seed,
+                     description="Synthetic catalog"), owner)
+            defs = payloads.annotation_defs(annotations, seed)
+            for d in defs:
+                catalog["defs"][d["name"]] = dict(
+                    name=d["name"], value_type=d["value_type"],
+                    multivalued=False, unique=False, owner=owner)
+            if padding:
+                catalog["defs"]["padding"] = dict(
+                    name="padding", value_type="text", multivalued=False,
+                    unique=False, owner=owner)
+
+            def annotate(record):
+                for d in defs:
+                    record[d["name"]] = payloads.annotation_value(
+                        rng, d["value_type"])
+                if padding:
+                    record["padding"] = "x" * padding
+
+            dataset_bodies = payloads.datasets(datasets, 0, seed)
+            member_bodies = payloads.members(members, 0, 0, seed)
+            for body in dataset_bodies:
+                dataset = self.create_dataset(catalog,
+                                              dict(name=body["name"]), owner)
+                annotate(dataset)
+                for mbody in member_bodies:
+                    member = self.create_members(
+                        catalog, dataset,
+                        [dict(data_type=mbody["data_type"],
+                              data_uri=mbody["data_uri"])], owner)[0]
+                    annotate(member)
+            return catalog["id"]
+
+
+def _public(record, fields=None):
+    """The record as returned by listings: everything but internal keys,
+    or only fields if given (None for missing ones)."""
+    if fields is None:
+        return dict((k, v) for k, v in record.iteritems() if k != "acl")
+    result = {}
+    for name in fields:
+        if name == "annotations_present":
+            result[name] = sorted(k for k in record
+                                  if k not in BUILTIN_NAMES and k != "acl")
+        else:
+            result[name] = record.get(name)
+    return result
+
+
+def _select(records, selector, query):
+    terms = parse_selector(selector)
+    matches = [r for r in records.itervalues() if match_terms(r, terms)]
+    matches.sort(key=lambda r: r["id"])
+    limit = query.get("limit")
+    if limit not in (None, "none"):
+        try:
+            matches = matches[:int(limit)]
+        except ValueError:
+            raise HTTPError(400, "Bad limit %s" % limit)
+    return matches
+
+
+def _single_id(selector):
+    """Id of an id=N path segment."""
+    terms = parse_selector(selector)
+    if (len(terms) != 1 or terms[0][0] != "id" or terms[0][1] != "="
+    or len(terms[0][2]) != 1):
+        raise HTTPError(400, "Expected id=N, got %s" % selector)
+    try:
+        return int(terms[0][2][0])
+    except ValueError:
+        raise HTTPError(400, "Bad id %s" % terms[0][2][0])
+
+
+class CatalogRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one write; the default unbuffered writes
+    # stall on delayed ACKs and would dominate any latency measurement.
+    wbufsize = -1
+
+    def setup(self):
+        # StreamRequestHandler puts this timeout on the socket; a keep-alive
+        # connection that stays idle longer is closed.
+        self.timeout = self.server.idle_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip(), 16)
+                if size == 0:
+                    # Trailers, up to the empty line.
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = "".join(parts)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length",
+                                                        0)))
+        encoding = self.headers.get("Content-Encoding", "").lower()
+        if encoding == "gzip":
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        elif encoding == "deflate":
+            body = zlib.decompress(body)
+        return body
+
+    def _reset(self):
+        """Close the connection with a TCP reset."""
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack("ii", 1, 0))
+        self.close_connection = 1
+
+    def _handle(self, method):
+        server = self.server
+        server.count_request()
+        delay = server.latency
+        if server.latency_jitter:
+            delay += server.random.uniform(0, server.latency_jitter)
+        if delay:
+            time.sleep(delay)
+        if server.random.random() < server.reset_rate:
+            server.count_fault("reset")
+            self._reset()
+            return
+        try:
+            body = self._read_body()
+        except (ValueError, IOError, zlib.error):
+            self._send_text(400, "Could not read request body")
+            return
+        if server.random.random() < server.error_rate:
+            server.count_fault("503")
+            headers = {}
+            if server.retry_after is not None:
+                headers["Retry-After"] = str(server.retry_after)
+            self._send_text(503, "Service temporarily unavailable", headers)
+            return
+        if not self.headers.get("Authorization", "").startswith(
+                "Globus-Goauthtoken "):
+            self._send_text(401, "Authorization required")
+            return
+        try:
+            data = None
+            if body:
+                data = json.loads(body)
+            status, result = self._route(method, data)
+        except HTTPError as e:
+            self._send_text(e.status, str(e))
+            return
+        except ValueError as e:
+            self._send_text(400, "Bad request: %s" % e)
+            return
+        self._send_json(method, status, result)
+
+    def _owner(self):
+        token = self.headers.get("Authorization", "").split(" ", 1)[-1]
+        for part in token.split("|"):
+            if part.startswith("un="):
+                return part[3:]
+        return "tester"
+
+    def _route(self, method, data):
+        parsed = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        path = parsed.path
+        i = path.find("/catalog")
+        if i < 0:
+            raise HTTPError(404, "Not found: %s" % path)
+        segs = path[i:].split("/")[1:]
+        store = self.server.store
+        owner = self._owner()
+
+        with store.lock:
+            if segs == ["catalog"] or segs == ["catalog", ""]:
+                if method == "GET":
+                    return 200, [dict(id=c["id"], config=c["config"])
+                                 for _, c in sorted(store.catalogs.items())]
+                if method == "POST":
+                    c = store.create_catalog(data or {}, owner)
+                    return 201, dict(id=c["id"], config=c["config"])
+                raise HTTPError(405, "Method not allowed")
+
+            catalog = store.catalog(_single_id(segs[1]))
+            if len(segs) == 2:
+                if method == "GET":
+                    return 200, dict(id=catalog["id"],
+                                     config=catalog["config"])
+                if method == "DELETE":
+                    del store.catalogs[catalog["id"]]
+                    return 204, None
+                raise HTTPError(405, "Method not allowed")
+
+            if segs[2] == "annotation_def":
+                return self._annotation_defs(method, catalog, segs[3:], data,
+                                             owner)
+            if segs[2] != "dataset":
+                raise HTTPError(404, "Not found: %s" % path)
+
+            if len(segs) == 3 or (len(segs) == 4 and method == "POST"
+                                  and not segs[3]):
+                if method == "POST":
+                    return 201, _public(store.create_dataset(catalog, data,
+                                                             owner))
+                segs.append("")
+            selector = segs[3]
+            rest = segs[4:]
+            if not rest:
+                if method == "GET":
+                    return 200, [_public(d) for d in
+                                 _select(catalog["datasets"], selector,
+                                         query)]
+                if method == "DELETE":
+                    dataset = self._dataset(catalog, selector)
+                    del catalog["datasets"][dataset["id"]]
+                    for member_id, member in catalog["members"].items():
+                        if member["dataset_id"] == dataset["id"]:
+                            del catalog["members"][member_id]
+                    return 204, None
+                raise HTTPError(405, "Method not allowed")
+
+            if rest[0] == "annotation":
+                return self._annotations(method, catalog,
+                                         catalog["datasets"], selector,
+                                         rest[1:], query, data)
+            dataset = self._dataset(catalog, selector)
+            if rest[0] == "acl":
+                return self._acl(method, dataset, rest[1:], data)
+            if rest[0] != "member":
+                raise HTTPError(404, "Not found: %s" % path)
+
+            members = dict((m_id, m) for m_id, m
+                           in catalog["members"].iteritems()
+                           if m["dataset_id"] == dataset["id"])
+            if len(rest) == 1 or (method == "POST" and not rest[1]):
+                if method == "POST":
+                    if not isinstance(data, list):
+                        raise HTTPError(400, "Expected a list of members")
+                    created = store.create_members(catalog, dataset, data,
+                                                   owner)
+                    return 201, [_public(m) for m in created]
+                rest.append("")
+            selector = rest[1]
+            if len(rest) == 2:
+                if method == "GET":
+                    return 200, [_public(m) for m in
+                                 _select(members, selector, query)]
+                if method == "DELETE":
+                    member_id = _single_id(selector)
+                    if member_id not in members:
+                        raise HTTPError(404, "Member %s not found"
+                                        % member_id)
+                    del catalog["members"][member_id]
+                    return 204, None
+                raise HTTPError(405, "Method not allowed")
+            if rest[2] == "annotation":
+                return self._annotations(method, catalog, members, selector,
+                                         rest[3:], query, data)
+            raise HTTPError(404, "Not found: %s" % path)
+
+    def _dataset(self, catalog, selector):
+        dataset_id = _single_id(selector)
+        dataset = catalog["datasets"].get(dataset_id)
+        if dataset is None:
+            raise HTTPError(404, "Dataset %s not found" % dataset_id)
+        return dataset
+
+    def _annotation_defs(self, method, catalog, rest, data, owner):
+        defs = catalog["defs"]
+        if not rest or not rest[0]:
+            if method == "GET":
+                return 200, [dict(d) for _, d in sorted(defs.items())]
+            raise HTTPError(405, "Method not allowed")
+        name = _unquote(rest[0])
+        if method == "PUT":
+            if name in defs:
+                raise HTTPError(409, 'Tag "%s" already exists' % name)
+            data = data or {}
+            defs[name] = dict(name=name,
+                              value_type=data.get("value_type", "text"),
+                              multivalued=bool(data.get("multivalued")),
+                              unique=bool(data.get("unique")), owner=owner)
+            return 201, dict(defs[name])
+        if name not in defs:
+            raise HTTPError(404, 'Tag "%s" not defined' % name)
+        if method == "GET":
+            return 200, dict(defs[name])
+        if method == "DELETE":
+            if name in BUILTIN_NAMES:
+                raise HTTPError(403, "Cannot delete %s" % name)
+            del defs[name]
+            return 204, None
+        raise HTTPError(405, "Method not allowed")
+
+    def _annotations(self, method, catalog, records, selector, rest, query,
+                     data):
+        store = self.server.store
+        if method == "GET":
+            if rest and rest[0]:
+                fields = [_unquote(f) for f in rest[0].split(";") if f]
+            else:
+                # Like tagfiler, without a projection only id and owner.
+                fields = ["id", "owner"]
+            return 200, [_public(r, fields)
+                         for r in _select(records, selector, query)]
+        record_id = _single_id(selector)
+        record = records.get(record_id)
+        if record is None:
+            raise HTTPError(404, "%s not found" % record_id)
+        if method == "POST":
+            if not isinstance(data, dict):
+                raise HTTPError(400, "Expected a dictionary of annotations")
+            store.add_annotations(catalog, record, data)
+            return 200, dict(code=200, message="Annotations added")
+        if method == "DELETE":
+            if not rest or not rest[0]:
+                raise HTTPError(400, "Annotation name required")
+            name, _, value = rest[0].partition("=")
+            store.delete_annotation(record, _unquote(name),
+                                    _unquote(value) if value else None)
+            return 204, None
+        raise HTTPError(405, "Method not allowed")
+
+    def _acl(self, method, dataset, rest, data):
+        acl = dataset["acl"]
+        if not rest or not rest[0]:
+            if method == "GET":
+                return 200, list(acl)
+            if method == "POST":
+                if not isinstance(data, list):
+                    data = [data]
+                acl.extend(data)
+                return 200, list(acl)
+            raise HTTPError(405, "Method not allowed")
+        if len(rest) != 2 or rest[0] not in ("user", "group"):
+            raise HTTPError(404, "Not found")
+        principal_type, principal = rest[0], _unquote(rest[1])
+        rules = [r for r in acl if r.get("principal_type") == principal_type
+                 and r.get("principal") == principal]
+        if method == "GET":
+            if not rules:
+                raise HTTPError(404, "No access rule for %s" % principal)
+            return 200, rules
+        if method == "DELETE":
+            dataset["acl"] = [r for r in acl if r not in rules]
+            return 204, None
+        raise HTTPError(405, "Method not allowed")
+
+    def _send_text(self, status, text, headers=None):
+        body = text.encode("utf8") if isinstance(text, unicode) else text
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, method, status, result):
+        if status == 204:
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(result)
+        etag = None
+        if method == "GET" and self.server.etag:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if (self.server.gzip and len(body) > 1024
+        and "gzip" in self.headers.get("Accept-Encoding", "")):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=1)
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Set at interpreter exit. Daemon handler threads still running then fail
+# in all sorts of ways once module globals are cleared, so the server
+# binds this as a default argument rather than looking up any global.
+_exiting = []
+atexit.register(_exiting.append, True)
+
+
+class LocalCatalogServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server holding a CatalogStore.
+
+    @param latency: seconds added to every request
+    @param latency_jitter: up to this many more seconds, uniformly random
+    @param error_rate: probability of answering a request with a 503
+    @param reset_rate: probability of resetting the connection instead of
+                       answering
+    @param retry_after: Retry-After value sent with injected 503s
+    @param gzip: compress JSON responses over 1KB when accepted
+    @param etag: send ETags and answer If-None-Match with 304
+    @param seed: seed for the fault injection, for repeatable runs
+    @param idle_timeout: close keep-alive connections idle for this many
+                         seconds; None keeps them open
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    # SocketServer's default of 5 overflows with a few dozen concurrent
+    # clients, which then stall for a second on SYN retransmits.
+    request_queue_size = 128
+
+    def __init__(self, host="127.0.0.1", port=0, base_path=DEFAULT_BASE_PATH,
+                 latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 reset_rate=0.0, retry_after=None, gzip=True, etag=True,
+                 seed=None, verbose=False, store=None, idle_timeout=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           CatalogRequestHandler)
+        self.base_path = base_path
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.retry_after = retry_after
+        self.gzip = gzip
+        self.etag = etag
+        self.verbose = verbose
+        self.idle_timeout = idle_timeout
+        self.random = random.Random(seed)
+        if store is None:
+            store = CatalogStore()
+        self.store = store
+
+        self._count_lock = threading.Lock()
+        self.request_count = 0
+        self.fault_counts = {}
+        self._thread = None
+        self.stopped = False
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return "http://%s:%d%s" % (host, port, self.base_path)
+
+    def count_request(self):
+        with self._count_lock:
+            self.request_count += 1
+
+    def count_fault(self, kind):
+        with self._count_lock:
+            self.fault_counts[kind] = self.fault_counts.get(kind, 0) + 1
+
+    def handle_error(self, request, client_address, _exc_info=sys.exc_info,
+                     _exiting=_exiting):
+        # Clients closing keep-alive connections are expected, and so are
+        # errors in handler threads once the server is stopped.
+        if self.stopped or _exiting:
+            return
+        if not isinstance(_exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def process_request_thread(self, request, client_address,
+                               _exiting=_exiting):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        except:
+            # SocketServer.shutdown_request fails at exit, too.
+            if not (self.stopped or _exiting):
+                raise
+
+    def start(self):
+        """Serve on a background daemon thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+
+def main(args=None):
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=8080)
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds added to each request")
+    parser.add_option("--jitter", type="float", default=0.0,
+                      help="random extra latency, up to this many seconds")
+    parser.add_option("--error-rate", type="float", default=0.0,
+                      dest="error_rate", help="probability of a 503")
+    parser.add_option("--reset-rate", type="float", default=0.0,
+                      dest="reset_rate",
+                      help="probability of a connection reset")
+    parser.add_option("--retry-after", dest="retry_after",
+                      help="Retry-After header sent with 503s")
+    parser.add_option("--idle-timeout", type="float", dest="idle_timeout",
+                      help="close connections idle this many seconds")
+    parser.add_option("--datasets", type="int", default=0,
+                      help="populate a catalog with this many datasets")
+    parser.add_option("--members", type="int", default=0,
+                      help="members per populated dataset")
+    parser.add_option("--annotations", type="int", default=5,
+                      help="annotations per populated record")
+    parser.add_option("--padding", type="int", default=0,
+                      help="bytes of padding per populated record")
+    parser.add_option("-v", "--verbose", action="store_true")
+    options, _ = parser.parse_args(args)
+
+    server = LocalCatalogServer(options.host, options.port,
+                                latency=options.latency,
+                                latency_jitter=options.jitter,
+                                error_rate=options.error_rate,
+                                reset_rate=options.reset_rate,
+                                retry_after=options.retry_after,
+                                verbose=options.verbose,
+                                idle_timeout=options.idle_timeout)
+    if options.datasets:
+        catalog_id = server.store.populate(options.datasets, options.members,
+                                           options.annotations,
+                                           options.padding)
+        print "Populated catalog %d" % catalog_id
+    print "Serving on %s" % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,458 @@
+"""
+Local mirror of catalogs, kept in an embedded key/value store.
+
+The gdclient REPL resolves geounit names and offers completions from the
+datasets of its catalog, which used to mean listing them all from the
+server at every start and every "--geounit start". A CatalogMirror keeps
+catalogs, datasets, their members and ACLs in a store with the py-leveldb
+interface (Get, Put, Delete, RangeIter, Write), usually the LevelDB the
+REPL already keeps in ~/.gdclient, and answers those lookups locally:
+
+    mirror = CatalogMirror(LevelDB(path))
+    mirror.sync(client, catalog_id)
+    mirror.find_datasets(catalog_id, "ocean")
+
+The first sync of a catalog lists everything. Later syncs only ask for
+records above the highest id seen so far (the watermark), which is
+usually a single short page. Records deleted or re-annotated on the
+server are not seen that way, so every reconcile_interval seconds, or
+when asked to, a sync lists everything again and brings the mirror in
+line with the server. Mirroring members costs a request per dataset on
+every sync, since members can be added to any dataset, so it is optional.
+
+Keys are prefixed with "mirror." so the store can be shared, and ids are
+zero padded so records iterate in id order.
+"""
+import time
+import bisect
+import threading
+from collections import namedtuple
+
+from globusonline.catalog.client import json_codec
+from globusonline.catalog.client.operators import Op
+from globusonline.catalog.client.rest_client import RestClientError
+from globusonline.catalog.client.bulk import parallel_map, \
+    DEFAULT_CONCURRENCY
+
+try:
+    from leveldb import WriteBatch
+except ImportError:
+    WriteBatch = None
+
+DEFAULT_RECONCILE_INTERVAL = 3600.0
+
+PREFIX = "mirror."
+# Sorts after any character that can follow a key prefix.
+_END = "\xff"
+
+
+SyncResult = namedtuple("SyncResult", "full datasets deleted members")
+
+
+def _id_key(id):
+    """
+    >>> _id_key(42)
+    '000000000042'
+    """
+    return "%012d" % int(id)
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+class MemoryStore(object):
+    """
+    Store with the subset of the py-leveldb LevelDB interface used by
+    CatalogMirror, kept in memory, for processes that don't keep a
+    database.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+        self._keys = []
+
+    def Get(self, key):
+        return self._data[key]
+
+    def Put(self, key, value):
+        with self._lock:
+            if key not in self._data:
+                bisect.insort(self._keys, key)
+            self._data[key] = value
+
+    def Delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def RangeIter(self, key_from=None, key_to=None, include_value=True):
+        with self._lock:
+            start = 0 if key_from is None else bisect.bisect_left(self._keys,
+                                                                  key_from)
+            end = (len(self._keys) if key_to is None
+                   else bisect.bisect_right(self._keys, key_to))
+            keys = self._keys[start:end]
+            items = [(k, self._data[k]) for k in keys]
+        if include_value:
+            return iter(items)
+        return iter(keys)
+
+    def Write(self, batch, sync=False):
+        for key, value in batch.ops:
+            if value is None:
+                self.Delete(key)
+            else:
+                self.Put(key, value)
+
+
+class _Batch(object):
+    """Writes to apply at once, with the interface of leveldb.WriteBatch."""
+    def __init__(self):
+        self.ops = []
+
+    def Put(self, key, value):
+        self.ops.append((key, value))
+
+    def Delete(self, key):
+        self.ops.append((key, None))
+
+
+class CatalogMirror(object):
+    """
+    @param db: LevelDB or MemoryStore to keep the mirror in
+    @param reconcile_interval: seconds after which sync() lists everything
+                               again to catch deletions and changes
+    @param concurrency: requests in flight at once when listing the members
+                        or ACLs of many datasets
+    """
+    def __init__(self, db=None, reconcile_interval=DEFAULT_RECONCILE_INTERVAL,
+                 concurrency=DEFAULT_CONCURRENCY):
+        if db is None:
+            db = MemoryStore()
+        self.db = db
+        self.reconcile_interval = reconcile_interval
+        self.concurrency = concurrency
+
+    # Keys
+
+    def _prefix(self, catalog_id, kind=None):
+        prefix = "%s%s." % (PREFIX, _id_key(catalog_id))
+        if kind is not None:
+            prefix += kind + "."
+        return prefix
+
+    def _dataset_key(self, catalog_id, dataset_id):
+        return self._prefix(catalog_id, "dataset") + _id_key(dataset_id)
+
+    def _member_prefix(self, catalog_id, dataset_id):
+        return "%s%s." % (self._prefix(catalog_id, "member"),
+                          _id_key(dataset_id))
+
+    def _name_key(self, catalog_id, name, dataset_id):
+        return "%s%s\x00%s" % (self._prefix(catalog_id, "name"), _text(name),
+                               _id_key(dataset_id))
+
+    def _acl_key(self, catalog_id, dataset_id):
+        return self._prefix(catalog_id, "acl") + _id_key(dataset_id)
+
+    def _state_key(self, catalog_id):
+        return self._prefix(catalog_id) + "state"
+
+    def _member_watermark_key(self, catalog_id, dataset_id):
+        return self._prefix(catalog_id, "member_watermark") + \
+            _id_key(dataset_id)
+
+    def _get(self, key, default=None):
+        try:
+            return json_codec.loads(self.db.Get(key))
+        except KeyError:
+            return default
+
+    def _range(self, prefix):
+        return self.db.RangeIter(key_from=prefix, key_to=prefix + _END)
+
+    def _batch(self):
+        if isinstance(self.db, MemoryStore) or WriteBatch is None:
+            return _Batch()
+        return WriteBatch()
+
+    # Lookups
+
+    def state(self, catalog_id):
+        """@return: dictionary of the sync state of a catalog: synced (time
+                    of the last sync), reconciled (time of the last full
+                    sync) and dataset_id (the watermark), or None if it
+                    was never synced"""
+        return self._get(self._state_key(catalog_id))
+
+    def catalogs(self):
+        """@return: list of the catalog dictionaries seen by the last full
+                    sync"""
+        return [json_codec.loads(v)
+                for _, v in self._range(PREFIX + "catalog.")]
+
+    def dataset(self, catalog_id, dataset_id):
+        """@return: the dataset dictionary, or None"""
+        return self._get(self._dataset_key(catalog_id, dataset_id))
+
+    def datasets(self, catalog_id):
+        """@return: iterator of the dataset dictionaries, in id order"""
+        for _, value in self._range(self._prefix(catalog_id, "dataset")):
+            yield json_codec.loads(value)
+
+    def dataset_ids(self, catalog_id, name):
+        """@return: ids of the datasets named name, in id order"""
+        prefix = "%s%s\x00" % (self._prefix(catalog_id, "name"), _text(name))
+        return [int(v) for _, v in self._range(prefix)]
+
+    def find_datasets(self, catalog_id, name):
+        """@return: list of the dataset dictionaries named name"""
+        return [d for d in (self.dataset(catalog_id, id)
+                            for id in self.dataset_ids(catalog_id, name))
+                if d is not None]
+
+    def dataset_names(self, catalog_id, prefix=""):
+        """@return: sorted list of the distinct dataset names starting with
+                    prefix, e.g. for completions"""
+        name_prefix = self._prefix(catalog_id, "name")
+        names = []
+        for key, _ in self._range(name_prefix + _text(prefix)):
+            name = key[len(name_prefix):].rsplit("\x00", 1)[0]
+            if not names or names[-1] != name:
+                names.append(name)
+        return [n.decode("utf-8") for n in names]
+
+    def members(self, catalog_id, dataset_id):
+        """@return: iterator of the member dictionaries of a dataset, in id
+                    order; empty unless members are mirrored"""
+        for _, value in self._range(self._member_prefix(catalog_id,
+                                                        dataset_id)):
+            yield json_codec.loads(value)
+
+    def acl(self, catalog_id, dataset_id):
+        """@return: the ACL of a dataset, or None unless ACLs are
+                    mirrored"""
+        return self._get(self._acl_key(catalog_id, dataset_id))
+
+    # Updates
+
+    def put_dataset(self, catalog_id, dataset, batch=None):
+        """Add or replace a dataset, e.g. one just created. The watermark is
+        left alone, so records created by others meanwhile are still
+        fetched by the next sync."""
+        write = batch is None
+        if write:
+            batch = self._batch()
+        key = self._dataset_key(catalog_id, dataset["id"])
+        old = self._get(key)
+        if old is not None and old.get("name") != dataset.get("name"):
+            if old.get("name") is not None:
+                batch.Delete(self._name_key(catalog_id, old["name"],
+                                            old["id"]))
+        if dataset.get("name") is not None:
+            batch.Put(self._name_key(catalog_id, dataset["name"],
+                                     dataset["id"]), str(dataset["id"]))
+        batch.Put(key, json_codec.dumps(dataset))
+        if write:
+            self.db.Write(batch)
+
+    def put_member(self, catalog_id, dataset_id, member, batch=None):
+        """Add or replace a member of a mirrored dataset."""
+        key = self._member_prefix(catalog_id, dataset_id) + \
+            _id_key(member["id"])
+        if batch is None:
+            self.db.Put(key, json_codec.dumps(member))
+        else:
+            batch.Put(key, json_codec.dumps(member))
+
+    def delete_dataset(self, catalog_id, dataset_id, batch=None):
+        """Remove a dataset with its members and ACL."""
+        write = batch is None
+        if write:
+            batch = self._batch()
+        dataset = self.dataset(catalog_id, dataset_id)
+        if dataset is not None and dataset.get("name") is not None:
+            batch.Delete(self._name_key(catalog_id, dataset["name"],
+                                        dataset_id))
+        batch.Delete(self._dataset_key(catalog_id, dataset_id))
+        batch.Delete(self._acl_key(catalog_id, dataset_id))
+        batch.Delete(self._member_watermark_key(catalog_id, dataset_id))
+        for key, _ in self._range(self._member_prefix(catalog_id,
+                                                      dataset_id)):
+            batch.Delete(key)
+        if write:
+            self.db.Write(batch)
+
+    def clear(self, catalog_id):
+        """Forget everything about a catalog; the next sync is a full one."""
+        batch = self._batch()
+        for key, _ in self._range(self._prefix(catalog_id)):
+            batch.Delete(key)
+        self.db.Write(batch)
+
+    # Sync
+
+    def sync(self, client, catalog_id, members=False, acls=False,
+             full=None):
+        """Bring the mirror of a catalog up to date.
+
+        @param client: DatasetClient to fetch the records with
+        @param members: also mirror the members of every dataset
+        @param acls: also mirror the ACL of every dataset
+        @param full: list everything, to catch deletions and changes to
+                     existing records; by default only when the catalog has
+                     not been reconciled for reconcile_interval seconds, or
+                     members or ACLs were not mirrored before
+        @return: SyncResult(full, datasets, deleted, members), the number
+                 of datasets added or updated, datasets deleted and members
+                 added or updated
+        """
+        state = self.state(catalog_id)
+        if full is None:
+            full = (state is None
+                    or time.time() - state["reconciled"]
+                    > self.reconcile_interval
+                    or (members and not state.get("members"))
+                    or (acls and not state.get("acls")))
+        now = time.time()
+        if full:
+            result, watermark = self._sync_full(client, catalog_id, members,
+                                                acls)
+            state = dict(reconciled=now, members=members, acls=acls)
+        else:
+            result, watermark = self._sync_new(client, catalog_id, state,
+                                               members, acls)
+        state["synced"] = now
+        state["dataset_id"] = watermark
+        self.db.Put(self._state_key(catalog_id), json_codec.dumps(state))
+        return result
+
+    def _sync_full(self, client, catalog_id, members, acls):
+        _, catalogs = client.get_catalogs()
+        batch = self._batch()
+        for key, _ in self._range(PREFIX + "catalog."):
+            batch.Delete(key)
+        for catalog in catalogs:
+            batch.Put(PREFIX + "catalog." + _id_key(catalog["id"]),
+                      json_codec.dumps(catalog))
+
+        datasets = list(client.scan_datasets(catalog_id,
+                                             concurrency=self.concurrency))
+        seen = set(d["id"] for d in datasets)
+
+        member_count = 0
+        if members:
+            for dataset_id, records in self._fetch_members(
+                    client, catalog_id, sorted(seen), batch):
+                if records is None:
+                    # Deleted since the scan.
+                    seen.discard(dataset_id)
+                    continue
+                for key, _ in self._range(self._member_prefix(catalog_id,
+                                                              dataset_id)):
+                    batch.Delete(key)
+                for member in records:
+                    self.put_member(catalog_id, dataset_id, member, batch)
+                member_count += len(records)
+            datasets = [d for d in datasets if d["id"] in seen]
+
+        deleted = 0
+        for old in self.datasets(catalog_id):
+            if old["id"] not in seen:
+                self.delete_dataset(catalog_id, old["id"], batch)
+                deleted += 1
+        for dataset in datasets:
+            self.put_dataset(catalog_id, dataset, batch)
+
+        # Drop what is not mirrored any more.
+        kinds = []
+        if not members:
+            kinds += ["member", "member_watermark"]
+        if not acls:
+            kinds.append("acl")
+        for kind in kinds:
+            for key, _ in self._range(self._prefix(catalog_id, kind)):
+                batch.Delete(key)
+
+        if acls:
+            self._put_acls(client, catalog_id, sorted(seen), batch)
+        self.db.Write(batch)
+        watermark = max(seen) if seen else None
+        return SyncResult(True, len(datasets), deleted, member_count), \
+            watermark
+
+    def _sync_new(self, client, catalog_id, state, members, acls):
+        selector_list = None
+        if state.get("dataset_id") is not None:
+            selector_list = [("id", Op.GT, state["dataset_id"])]
+        datasets = list(client.iter_datasets(catalog_id, selector_list))
+        batch = self._batch()
+        for dataset in datasets:
+            self.put_dataset(catalog_id, dataset, batch)
+
+        member_count = 0
+        deleted = 0
+        if members:
+            # Members are added to old datasets too; ask every dataset for
+            # the ones above the highest member id it has. That also finds
+            # datasets that were deleted.
+            dataset_ids = set(d["id"] for d in self.datasets(catalog_id))
+            dataset_ids.update(d["id"] for d in datasets)
+            for dataset_id, records in self._fetch_members(
+                    client, catalog_id, sorted(dataset_ids), batch,
+                    new=True):
+                if records is None:
+                    self.delete_dataset(catalog_id, dataset_id, batch)
+                    deleted += 1
+                    continue
+                for member in records:
+                    self.put_member(catalog_id, dataset_id, member, batch)
+                member_count += len(records)
+        if acls:
+            self._put_acls(client, catalog_id, [d["id"] for d in datasets],
+                           batch)
+        self.db.Write(batch)
+        watermark = state.get("dataset_id")
+        if datasets:
+            watermark = max(watermark, max(d["id"] for d in datasets))
+        return SyncResult(False, len(datasets), deleted, member_count), \
+            watermark
+
+    def _fetch_members(self, client, catalog_id, dataset_ids, batch,
+                       new=False):
+        """Iterate over (dataset id, list of members) for dataset_ids, only
+        the members above the member watermark of each dataset if new, and
+        move the watermarks in batch. The list is None for a dataset that
+        does not exist any more."""
+        def fetch(dataset_id):
+            selector_list = None
+            if new:
+                last_id = self._get(self._member_watermark_key(catalog_id,
+                                                               dataset_id))
+                if last_id is not None:
+                    selector_list = [("id", Op.GT, last_id)]
+            try:
+                return dataset_id, list(client.iter_members(
+                    catalog_id, dataset_id, selector_list, prefetch=0))
+            except RestClientError as e:
+                if e.response.status != 404:
+                    raise
+                return dataset_id, None
+        for dataset_id, records in parallel_map(fetch, dataset_ids,
+                                                self.concurrency):
+            if records:
+                batch.Put(self._member_watermark_key(catalog_id, dataset_id),
+                          json_codec.dumps(max(m["id"] for m in records)))
+            yield dataset_id, records
+
+    def _put_acls(self, client, catalog_id, dataset_ids, batch):
+        def fetch(dataset_id):
+            _, acl = client.get_dataset_acl(catalog_id, dataset_id)
+            return dataset_id, acl
+        for dataset_id, acl in parallel_map(fetch, dataset_ids,
+                                            self.concurrency):
+            batch.Put(self._acl_key(catalog_id, dataset_id),
+                      json_codec.dumps(acl))
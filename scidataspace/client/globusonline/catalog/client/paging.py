@@ -0,0 +1,151 @@
+"""
+Iteration over every page of a keyset paged listing.
+
+The dataset API pages on the id of the last record of the previous page
+(id:gt:), so the next page can only be requested once the current one has
+arrived. PageIterator requests it right away on a background thread, and
+keeps up to prefetch pages queued while the caller works through the
+current one:
+
+    for member in client.iter_members(catalog_id, dataset_id):
+        ...
+
+The iteration ends with the first page shorter than page_size. An error
+fetching a page is raised by the iterator when the caller reaches that
+page.
+"""
+import sys
+import threading
+import Queue
+
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_PREFETCH = 1
+
+# How often a blocked prefetch thread checks whether it has been closed.
+_POLL_SECONDS = 0.1
+
+_END = object()
+
+
+class PageIterator(object):
+    """
+    Iterator over the records of all pages of a listing.
+
+    @param fetch_page: function(last_id, limit) returning the list of
+                       records following last_id (None for the first page)
+    @param page_size: records per request
+    @param prefetch: pages to fetch ahead in the background; 0 fetches each
+                     page only when it is needed, on the calling thread
+    """
+    def __init__(self, fetch_page, page_size=DEFAULT_PAGE_SIZE,
+                 prefetch=DEFAULT_PREFETCH):
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1")
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self._pages = _Pages(fetch_page, page_size)
+        self._page = iter(())
+        self._queue = None
+        if prefetch > 0:
+            # The thread only references _pages and the queue, so an
+            # abandoned iterator is still collected, and closes them.
+            self._queue = Queue.Queue(maxsize=prefetch)
+            thread = threading.Thread(target=self._pages.prefetch,
+                                      args=(self._queue,))
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def page_count(self):
+        """Number of pages fetched so far."""
+        return self._pages.count
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            try:
+                return self._page.next()
+            except StopIteration:
+                pass
+            page = self._next_page()
+            if page is _END:
+                self.close()
+                raise StopIteration
+            self._page = iter(page)
+
+    def _next_page(self):
+        if self._pages.closed:
+            return _END
+        if self._queue is None:
+            return self._pages.fetch_next()
+        item = self._queue.get()
+        if item is _END:
+            return _END
+        page, exc_info = item
+        if exc_info is not None:
+            self.close()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return page
+
+    def close(self):
+        """Stop fetching pages. Pages already fetched are dropped."""
+        self._pages.closed = True
+        self._page = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class _Pages(object):
+    """Paging state, shared by a PageIterator and its prefetch thread."""
+    def __init__(self, fetch_page, page_size):
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.last_id = None
+        self.count = 0
+        self.done = False
+        self.closed = False
+
+    def fetch_next(self):
+        """Fetch the page after the last one. @return: the page, or _END"""
+        if self.done:
+            return _END
+        page = self.fetch_page(self.last_id, self.page_size)
+        self.count += 1
+        if len(page) < self.page_size:
+            self.done = True
+        else:
+            self.last_id = page[-1]["id"]
+        return page
+
+    def prefetch(self, queue):
+        while not self.closed:
+            try:
+                page = self.fetch_next()
+            except Exception:
+                self._put(queue, (None, sys.exc_info()))
+                return
+            if page is _END:
+                break
+            if not self._put(queue, (page, None)):
+                return
+        self._put(queue, _END)
+
+    def _put(self, queue, item):
+        """Queue item for the consumer, unless the iterator is closed
+        first. @return: whether the item was queued"""
+        while not self.closed:
+            try:
+                queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except Queue.Full:
+                pass
+        return False
@@ -18,11 +18,12 @@ class Queries:
     ''' 
     def list_files(self, catalog):
         result = {}
-        _, datasets = self.client.get_datasets(self.catalog_id)
+        datasets = self.client.iter_datasets(self.catalog_id,
+                                             projection_list=['id'])
         for ds in datasets:
             dataset_id = ds['id']
-            _, members = self.client.get_members(self.catalog_id, 
-                                                 dataset_id)
+            members = self.client.iter_members(self.catalog_id, dataset_id,
+                                               projection_list=['data_uri'])
             for m in members:
                 data_uri = m['data_uri']
                 result[data_uri] = dataset_id 
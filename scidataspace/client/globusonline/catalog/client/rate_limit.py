@@ -0,0 +1,98 @@
+"""
+Client side rate limiting for GoauthRestClient.
+
+AdaptiveRateLimiter is a token bucket whose rate is adjusted AIMD style,
+like TCP congestion control: every successful request raises the rate a
+little, every 503 or timeout cuts it by a factor. Clients hitting the same
+catalog then converge on the rate the server can sustain instead of
+oscillating in and out of overload.
+
+A limiter can be given to a single client, or shared by every client in
+the process talking to the same service through get_rate_limiter.
+"""
+import time
+import threading
+
+DEFAULT_RATE = 50.0
+DEFAULT_MIN_RATE = 0.5
+DEFAULT_MAX_RATE = 1000.0
+
+
+class AdaptiveRateLimiter(object):
+    """
+    Token bucket allowing rate requests per second on average, and bursts
+    of up to burst requests.
+
+    @param increase: requests per second added to the rate per second of
+                     successful requests at full rate; each success adds
+                     increase / rate.
+    @param decrease: factor applied to the rate on a 503 or timeout.
+    @param cooldown: minimum seconds between two decreases, so a burst of
+                     failures from requests that were already in flight
+                     counts as one congestion signal.
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=None,
+                 min_rate=DEFAULT_MIN_RATE, max_rate=DEFAULT_MAX_RATE,
+                 increase=1.0, decrease=0.5, cooldown=1.0):
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        if burst is None:
+            burst = max(1.0, rate / 10.0)
+        self.burst = float(burst)
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last_fill = time.time()
+        self._last_decrease = 0.0
+
+        self.throttle_count = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens
+                                   + (now - self._last_fill) * self.rate)
+                self._last_fill = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+                self.wait_time += wait
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+
+    def on_throttle(self):
+        """Signal congestion (503 or timeout) and cut the rate."""
+        with self._lock:
+            now = time.time()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 1.0)
+            self.throttle_count += 1
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_rate_limiter(key, **kw):
+    """Get the process wide limiter for key (typically the service base
+    URL), creating it with the keyword arguments on first use."""
+    with _registry_lock:
+        limiter = _registry.get(key)
+        if limiter is None:
+            limiter = _registry[key] = AdaptiveRateLimiter(**kw)
+        return limiter
@@ -1,33 +1,141 @@
 """
 Base client for JSON REST APIs using GoAuth.
 """
+import sys
 import httplib
 import urllib
-import json
 import ssl
 import socket
 import time
+import random
+from email.utils import parsedate_tz, mktime_tz
 from urlparse import urlparse
 from collections import namedtuple
 import logging
 
-RETRY_WAIT_SECONDS = 5
+from globusonline.catalog.client.connection_pool import ConnectionPool, \
+    DEFAULT_POOL_SIZE, connection_key
+from globusonline.catalog.client.compression import ACCEPT_ENCODING, \
+    iter_body, read_body
+from globusonline.catalog.client.streaming import StreamingBody, \
+    send_chunked, iterdecode_array
+from globusonline.catalog.client.http_cache import CacheEntry, cache_key, \
+    invalidation_prefix
+from globusonline.catalog.client.instrumentation import RequestEvent
+from globusonline.catalog.client import json_codec
+
+# Retries wait a random time between zero and an exponentially growing
+# ceiling, RETRY_BASE_SECONDS * 2**attempt, capped at RETRY_MAX_SECONDS
+# ("full jitter"), so clients that failed together don't retry together.
+RETRY_BASE_SECONDS = 0.5
+RETRY_MAX_SECONDS = 30
+# Longest Retry-After honoured when the call has no deadline.
+RETRY_AFTER_MAX_SECONDS = 120.0
+# Methods that can be resent after a request may have reached the server.
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
 
 
 RestResult = namedtuple("RestResult", "response body")
 
 
+class CallStats(object):
+    """Transfer statistics for one call, attached to the response returned
+    by _request as response.stats.
+
+    wire_bytes is the size of the response body as received, body_bytes
+    its size after decompression, sent_bytes the size of the request body
+    as sent, and elapsed the wall time of the whole call in seconds,
+    including any retries. For the final attempt, connect_time is the time
+    spent opening a new connection (zero when a pooled one was reused),
+    handshake_time the part of it spent in the TLS handshake,
+    session_reused whether that handshake resumed an earlier session,
+    wait_time the time from sending the request to receiving the response
+    headers, and read_time the time spent reading the body.
+    """
+    def __init__(self):
+        self.content_encoding = None
+        self.sent_bytes = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.elapsed = 0.0
+        self.connect_time = 0.0
+        self.handshake_time = 0.0
+        self.session_reused = False
+        self.wait_time = 0.0
+        self.read_time = 0.0
+
+    @property
+    def compression_ratio(self):
+        if not self.wire_bytes:
+            return 1.0
+        return float(self.body_bytes) / self.wire_bytes
+
+    def __repr__(self):
+        return ("CallStats(content_encoding=%r, sent_bytes=%d, "
+                "wire_bytes=%d, body_bytes=%d, elapsed=%.3f)"
+                % (self.content_encoding, self.sent_bytes, self.wire_bytes,
+                   self.body_bytes, self.elapsed))
+
+
 class GoauthRestClient(object):
     """
     Base client for Globusonline APIs which use Goauth and JSON. Specific
     APIs should define subclasses with helper methods.
+
+    Requests go over persistent connections from a ConnectionPool holding up
+    to pool_size connections to the API host, so one client can be shared
+    between threads. Pass pool to share connections between clients.
+
+    Network errors and 503 responses are retried up to max_attempts times
+    in total, with jittered exponential backoff or the delay the server
+    asks for in Retry-After. If retry_deadline is set, no retry is started
+    that would end more than retry_deadline seconds after the call began.
+    Other methods than IDEMPOTENT_METHODS (i.e. POST) are only retried
+    when the server certainly did not act on the request: after a 503, or
+    a failure to connect. A POST that timed out may have been applied, so
+    resending it could create records twice.
+
+    If cache is an http_cache.ResponseCache, GET responses with an ETag or
+    Last-Modified header are cached and revalidated with conditional
+    requests; a 304 is answered from the cache and response.from_cache is
+    set. Any other method invalidates the cached entries it may affect.
+
+    Listeners added with add_listener are notified of each request, see
+    the instrumentation module.
+
+    If rate_limiter is a rate_limit.AdaptiveRateLimiter, every attempt
+    waits for a token from it first, and 503s and timeouts slow it down.
+    Use rate_limit.get_rate_limiter to share one between clients.
+
+    If circuit_breaker is a circuit_breaker.CircuitBreaker, network errors
+    and 5xx responses are reported to it, and while it is open requests
+    fail immediately with CircuitOpenError. Its state changes are sent to
+    listeners as on_circuit_state.
+
+    If singleflight is a singleflight.SingleFlight, a GET issued while an
+    identical one (same token, path and expected status) is still in
+    flight waits for it and returns the same response and parsed body,
+    instead of making a second round trip. Only the leading call is seen
+    by listeners. Callers must then treat response bodies as read-only.
+
+    If recorder is a cassette.Recorder, every exchange with the server is
+    written to its cassette file, to be replayed later without a network by
+    a pool of cassette.ReplayTransport connections.
     """
     def __init__(self, goauth_token, base_url, max_attempts=1, parse_json=True,
-                 log_requests=False):
+                 log_requests=False, pool_size=DEFAULT_POOL_SIZE, pool=None,
+                 retry_deadline=None, cache=None, rate_limiter=None,
+                 circuit_breaker=None, singleflight=None, recorder=None):
         self.goauth_token = goauth_token
         self.base_url = base_url
         self.max_attempts = max_attempts
+        self.retry_deadline = retry_deadline
         self.parse_json = parse_json
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.singleflight = singleflight
+        self.recorder = recorder
 
         self.log_requests = log_requests
         self._log = logging.getLogger("globusonline.catalog.rest_client")
@@ -48,99 +156,348 @@ class GoauthRestClient(object):
             raise ValueError("Illegal netloc: '%s'" % parsed_url.netloc)
         self._base_path = parsed_url.path.rstrip("/")
 
-        self._conn = None
+        self._pool_key = connection_key(self._is_https, self._host,
+                                        self._port)
+        if pool is None:
+            pool = ConnectionPool(max_size=pool_size)
+        self._pool = pool
 
-    def _connect(self):
-        if self._is_https:
-            self._conn = httplib.HTTPSConnection(self._host, self._port)
-        else:
-            self._conn = httplib.HTTPConnection(self._host, self._port)
+        # Requests that were sent on a connection the server had already
+        # closed and had to be repeated, i.e. wasted round trips. Should
+        # stay near zero since the pool probes idle connections first.
+        self.stale_request_count = 0
 
-    def close(self):
-        if self._conn:
-            self._conn.close()
-        self._conn = None
+        self._listeners = []
 
-    def _request(self, method, path, body=None, expected_status=None):
+    def close(self):
+        """Close all idle pooled connections."""
+        self._pool.close()
+
+    def add_listener(self, listener):
+        """Register a request listener (see instrumentation.RequestListener
+        for the callbacks)."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, callback, *args):
+        for listener in self._listeners:
+            fn = getattr(listener, callback, None)
+            if fn is None:
+                continue
+            try:
+                fn(*args)
+            except Exception:
+                # Instrumentation must never break the request itself.
+                self._log.exception("Request listener %r failed in %s",
+                                    listener, callback)
+
+    def _circuit_changed(self, change):
+        if change is not None:
+            self._log.warning("Circuit for %s changed from %s to %s",
+                              self.base_url, change[0], change[1])
+            self._notify("on_circuit_state", change[0], change[1])
+
+    def _request(self, method, path, body=None, expected_status=None,
+                 stream=False):
+        """Make a request and check the response status.
+
+        @param body: request body, either a string or a StreamingBody to
+                     send with chunked transfer encoding.
+        @param stream: for successful JSON responses, return the body as a
+                       ResponseStream iterating over the elements of the
+                       array as they are read. Bypasses the cache and
+                       request coalescing.
+        @return: RestResult; the body is parsed from json if possible.
+        """
         assert path.startswith("/")
+        if (self.singleflight is not None and method == "GET"
+        and body is None and not stream):
+            key = (cache_key(self.goauth_token, self._base_path + path),
+                   expected_status, self.parse_json)
+            result, _ = self.singleflight.do(
+                key, lambda: self._send(method, path, body, expected_status,
+                                        stream))
+            return result
+        return self._send(method, path, body, expected_status, stream)
+
+    def _send(self, method, path, body, expected_status, stream):
         path = self._base_path + path
+        event = RequestEvent(method, path)
+        start = event.start
         headers = { "Authorization": "Globus-Goauthtoken %s"
                                      % self.goauth_token,
-                    "Accept": "application/json" }
+                    "Accept": "application/json",
+                    "Accept-Encoding": ACCEPT_ENCODING }
         if body:
             headers["Content-Type"] = "application/json"
+        cached = None
+        if self.cache is not None and method == "GET" and not stream:
+            cached = self.cache.get(cache_key(self.goauth_token, path))
+            if cached is not None:
+                if cached.etag:
+                    headers["If-None-Match"] = cached.etag
+                if cached.last_modified:
+                    headers["If-Modified-Since"] = cached.last_modified
+        max_attempts = self.max_attempts
+        if isinstance(body, StreamingBody):
+            if body.content_encoding:
+                headers["Content-Encoding"] = body.content_encoding
+            if not body.replayable:
+                max_attempts = 1
 
         if self.log_requests:
             self._log.info("%s %s", method, path)
 
         def do_request():
-            if self._conn is None:
-                self._connect()
-            self._conn.request(method, path, body=body, headers=headers)
-            r = self._conn.getresponse()
-            response_body = r.read()
+            self._notify("before_send", event)
+            if self.circuit_breaker is not None:
+                self._circuit_changed(self.circuit_breaker.before_request())
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            pconn = self._pool.checkout(self._pool_key)
+            stats = CallStats()
+            try:
+                conn = pconn.conn
+                if self.recorder is not None:
+                    conn = self.recorder.wrap(conn)
+                if conn.sock is None:
+                    t = time.time()
+                    try:
+                        conn.connect()
+                    except socket.error as e:
+                        e.request_sent = False
+                        raise
+                    stats.connect_time = time.time() - t
+                    stats.handshake_time = getattr(conn, "handshake_time",
+                                                   0.0)
+                    stats.session_reused = getattr(conn, "session_reused",
+                                                   False)
+                if isinstance(body, StreamingBody):
+                    stats.sent_bytes = send_chunked(conn, method, path, body,
+                                                    headers)
+                else:
+                    conn.request(method, path, body=body, headers=headers)
+                    stats.sent_bytes = len(body or "")
+                t = time.time()
+                r = conn.getresponse()
+                r.stats = stats
+                stats.wait_time = time.time() - t
+                stats.content_encoding = r.getheader("Content-Encoding")
+                event.status = r.status
+                event.stats = stats
+                # Anything the caller would get an error for is read
+                # whole, and checked like any other response.
+                if (stream and self.parse_json and 200 <= r.status < 300
+                and (expected_status is None or r.status == expected_status)
+                and "application/json" in (r.getheader("Content-Type")
+                                           or "")):
+                    return r, ResponseStream(self._pool, pconn, r, start,
+                                             lambda: self._notify(
+                                                 "after_response", event))
+                t = time.time()
+                response_body = read_body(r, stats)
+                stats.read_time = time.time() - t
+            except:
+                self._pool.discard(pconn)
+                raise
+            self._pool.checkin(pconn)
             return r, response_body
 
-        for attempt in xrange(self.max_attempts):
+        try:
+            return self._do_request(method, path, event, do_request, body,
+                                    max_attempts, expected_status, cached)
+        except Exception as e:
+            exc_info = sys.exc_info()
+            event.error = e
+            self._notify("on_error", event, e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _do_request(self, method, path, event, do_request, body,
+                    max_attempts, expected_status, cached):
+        """Retry loop and response handling for _request."""
+        start = event.start
+
+        deadline = None
+        if self.retry_deadline is not None:
+            deadline = time.time() + self.retry_deadline
+
+        idempotent = method in IDEMPOTENT_METHODS
+        for attempt in xrange(max_attempts):
+            event.attempt = attempt
             r = None
+            delay = None
             try:
                 try:
                     r, response_body = do_request()
                 except httplib.BadStatusLine:
-                    # This happens when the connection is closed by the server
-                    # in between request, which is very likely when using
-                    # interactively, in a client that waits for user input
-                    # between requests, or after a retry wait. This does not
-                    # count as an attempt - it just means the old connection
-                    # has gone stale and we need a new one.
-                    # TODO: find a more elegant way to re-use the connection
-                    #       on closely spaced requests. Can we tell that the
-                    #       connection is dead without making a request?
-                    self.close()
+                    # The pool's health check catches connections the server
+                    # closed while they were idle, but the server can still
+                    # close one in the moment between the check and the
+                    # request. This does not count as an attempt - the
+                    # connection has gone stale and we need a new one.
+                    # A body that has been streamed from a generator is
+                    # gone though, so that can't be resent, and the server
+                    # may have acted on a POST before closing.
+                    if (not idempotent
+                    or isinstance(body, StreamingBody)
+                    and not body.replayable):
+                        raise
+                    self.stale_request_count += 1
                     r, response_body = do_request()
             except ssl.SSLError:
                 # This probably has to do with failed authentication, so
                 # retrying is not useful.
-                self.close()
                 raise
-            except socket.error:
-                # Network error. If the last attempt failed, raise,
-                # otherwise do nothing and go on to next attempt.
-                self.close()
-                if attempt == self.max_attempts - 1:
+            except socket.error as e:
+                # Network error. If the last attempt failed, or there is no
+                # time left before the deadline, raise, otherwise wait and
+                # go on to next attempt.
+                if (isinstance(e, socket.timeout)
+                and self.rate_limiter is not None):
+                    self.rate_limiter.on_throttle()
+                if self.circuit_breaker is not None:
+                    self._circuit_changed(
+                        self.circuit_breaker.record_failure())
+                if attempt == max_attempts - 1:
+                    raise
+                if not idempotent and request_sent(e):
+                    raise
+                delay = retry_delay(attempt, deadline=deadline)
+                if delay is None:
                     raise
 
+            if r is not None and self.rate_limiter is not None:
+                if r.status == 503:
+                    self.rate_limiter.on_throttle()
+                elif r.status < 500:
+                    self.rate_limiter.on_success()
+            if r is not None and self.circuit_breaker is not None:
+                if r.status >= 500:
+                    change = self.circuit_breaker.record_failure()
+                else:
+                    change = self.circuit_breaker.record_success()
+                self._circuit_changed(change)
+
             # Check for 503 ServiceUnavailable, which is treated just like
-            # network errors.
+            # network errors, except that the server may say how long to
+            # wait. On the last attempt, or if waiting would pass the
+            # deadline, the 503 error is returned instead.
             if (r is not None and r.status == 503
-            and attempt < self.max_attempts - 1):
-                # Force sleep below and continue loop, unless we are on
-                # the last attempt in which case skip this and return
-                # the 503 error.
-                self.close()
-                r = None
+            and attempt < max_attempts - 1):
+                delay = retry_delay(attempt, r.getheader("Retry-After"),
+                                    deadline)
+                if delay is not None:
+                    r = None
 
             if r is not None:
                 break
             else:
-                time.sleep(RETRY_WAIT_SECONDS)
+                self._notify("on_retry", event, delay)
+                time.sleep(delay)
+
+        r.stats.elapsed = time.time() - start
+        if self.log_requests:
+            self._log.info("%s %s: %d, %d bytes (%d on the wire) in %.3fs",
+                           method, path, r.status, r.stats.body_bytes,
+                           r.stats.wire_bytes, r.stats.elapsed)
 
+        status = r.status
         content_type = r.getheader("Content-Type")
+        r.from_cache = False
+        if isinstance(response_body, ResponseStream):
+            # after_response is sent when the stream has been consumed.
+            return RestResult(r, response_body)
+        if self.cache is not None:
+            if method != "GET":
+                self.cache.invalidate(invalidation_prefix(path))
+            elif status == 304 and cached is not None:
+                r.from_cache = True
+                status = cached.status
+                content_type = cached.content_type
+                response_body = cached.body
+            elif status == 200:
+                etag = r.getheader("ETag")
+                last_modified = r.getheader("Last-Modified")
+                if etag or last_modified:
+                    self.cache.put(cache_key(self.goauth_token, path),
+                                   CacheEntry(path, etag, last_modified,
+                                              status, content_type,
+                                              response_body))
+
         if (content_type and "application/json" in content_type
         and self.parse_json and response_body):
-            response_body = json.loads(response_body)
+            response_body = json_codec.loads(response_body)
+
+        self._notify("after_response", event)
 
         error = False
         if expected_status is None:
-            if r.status >= 400 or r.status < 200:
+            if status >= 400 or status < 200:
                 error = True
-        elif r.status != expected_status:
+        elif status != expected_status:
             error = True
         if error:
             raise RestClientError(r, response_body, expected_status)
         return RestResult(r, response_body)
 
 
+class ResponseStream(object):
+    """
+    Iterator over the elements of a JSON array response, decoded as the
+    body is read from the connection, so only one element needs to be in
+    memory at a time.
+
+    The connection stays checked out of the pool until the body has been
+    read completely, so the stream should be consumed or closed promptly.
+    Closing it before the end discards the connection.
+    """
+    def __init__(self, pool, pconn, response, start, on_finish=None):
+        self._pool = pool
+        self._pconn = pconn
+        self._response = response
+        self._start = start
+        self._on_finish = on_finish
+        self._read_start = time.time()
+        self._items = iterdecode_array(iter_body(response, response.stats))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._pconn is None:
+            raise StopIteration
+        try:
+            return self._items.next()
+        except StopIteration:
+            self._finish(True)
+            raise
+        except:
+            self._finish(False)
+            raise
+
+    def close(self):
+        if self._pconn is not None:
+            self._finish(False)
+
+    def __del__(self):
+        self.close()
+
+    def _finish(self, reusable):
+        pconn = self._pconn
+        self._pconn = None
+        now = time.time()
+        self._response.stats.elapsed = now - self._start
+        self._response.stats.read_time = now - self._read_start
+        if reusable:
+            self._pool.checkin(pconn)
+        else:
+            self._pool.discard(pconn)
+        if self._on_finish is not None:
+            self._on_finish()
+
+
 class RestClientError(Exception):
     """Generic rest error exception, which encapsulates the httplib response
     and body, and provides convenient attribute access to error fields if the
@@ -173,6 +530,66 @@ class RestClientError(Exception):
 _NOT_SET = object()
 
 
+def request_sent(e):
+    """Whether the request that failed with exception e may have reached
+    the server, i.e. unless it failed to connect or was refused with a
+    503."""
+    if isinstance(e, RestClientError):
+        return e.response.status != 503
+    return getattr(e, "request_sent", True)
+
+
+def retry_delay(attempt, retry_after=None, deadline=None,
+                base=RETRY_BASE_SECONDS, cap=RETRY_MAX_SECONDS,
+                retry_after_cap=RETRY_AFTER_MAX_SECONDS):
+    """Seconds to wait before retrying after the given (zero based) failed
+    attempt, or None if the wait would end after deadline (a time.time()
+    value).
+
+    A Retry-After header value from the server takes precedence over the
+    jittered exponential backoff. Without a deadline it is limited to
+    retry_after_cap, so a server can't stall the client indefinitely.
+
+    >>> retry_delay(0, "86400")
+    120.0
+    >>> retry_delay(0, "86400", deadline=time.time() + 60) is None
+    True
+    """
+    delay = parse_retry_after(retry_after)
+    if delay is not None and deadline is None:
+        delay = min(delay, retry_after_cap)
+    if delay is None:
+        delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if deadline is not None and time.time() + delay > deadline:
+        return None
+    return delay
+
+
+def parse_retry_after(value, now=None):
+    """Parse a Retry-After header, which is either a number of seconds or
+    an HTTP date, into a number of seconds from now. Returns None if value
+    is missing or malformed.
+
+    >>> parse_retry_after("120")
+    120.0
+    >>> parse_retry_after("Wed, 21 Oct 2015 07:28:10 GMT", now=1445412480)
+    10.0
+    >>> parse_retry_after("soon") is None
+    True
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, float(mktime_tz(parsed) - now))
+
+
 def urlquote(x):
     """Quote a str, unicode, or value coercable to str, for safe insertion
     in a URL.
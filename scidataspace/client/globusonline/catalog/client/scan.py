@@ -0,0 +1,176 @@
+"""
+Parallel scans of a listing, partitioned by id range.
+
+Keyset paging fetches one page after another. A RangeScanner instead
+splits the id space into ranges with id:gt: and id:leq: selectors and
+pages through several ranges at once, so a full scan of a large catalog
+takes about (pages / concurrency) round trips:
+
+    for dataset in client.scan_datasets(catalog_id, concurrency=8):
+        ...
+
+The ids of a listing are rarely spread evenly (the catalog numbers
+datasets and members from one sequence), so the id space is cut into more
+ranges than there are workers, and a worker that finishes a sparse range
+moves on to the next. Each range is fetched a page at a time, and only
+PAGES_AHEAD pages per range are held ahead of the caller. Records are
+yielded in id order, or with ordered=False as soon as their page arrives.
+
+The API cannot sort by descending id, so the upper end of the id space is
+found by probing for ids above exponentially growing bounds, unless the
+caller passes max_id.
+"""
+import sys
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+
+from globusonline.catalog.client.operators import Op
+from globusonline.catalog.client.paging import DEFAULT_PAGE_SIZE
+
+DEFAULT_CONCURRENCY = 4
+# Ranges per worker; more ranges balance uneven ids better, at the cost of
+# one short page per range.
+RANGES_PER_WORKER = 4
+# First step when probing for the highest id.
+PROBE_STEP = 1024
+# Pages of a range fetched before the caller has taken them.
+PAGES_AHEAD = 2
+
+# How often a worker blocked on a full queue checks whether the scan has
+# been abandoned.
+_POLL_SECONDS = 0.1
+
+_END = object()
+
+
+def id_ranges(min_id, max_id, count):
+    """Split the ids min_id..max_id into at most count (gt, leq) ranges.
+
+    >>> id_ranges(1, 10, 3)
+    [(0, 4), (4, 8), (8, 10)]
+    >>> id_ranges(5, 5, 4)
+    [(4, 5)]
+    """
+    low = min_id - 1
+    width = max(1, -(-(max_id - low) // count))
+    return [(gt, min(gt + width, max_id))
+            for gt in xrange(low, max_id, width)]
+
+
+class RangeScanner(object):
+    """
+    @param fetch_page: function(selector_list, last_id, limit) returning
+                       the records matching selector_list with ids above
+                       last_id (if not None), in id order
+    @param concurrency: ranges fetched at once; the client's connection
+                        pool should be at least this large
+    @param page_size: records per request
+    @param ranges: number of id ranges; RANGES_PER_WORKER per worker by
+                   default
+    """
+    def __init__(self, fetch_page, concurrency=DEFAULT_CONCURRENCY,
+                 page_size=DEFAULT_PAGE_SIZE, ranges=None):
+        self.fetch_page = fetch_page
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.ranges = ranges or concurrency * RANGES_PER_WORKER
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+
+    def _fetch(self, selector_list, last_id, limit):
+        with self._count_lock:
+            self.request_count += 1
+        return self.fetch_page(list(selector_list), last_id, limit)
+
+    def id_bounds(self, selector_list=()):
+        """@return: (lowest id, an id at least as high as the highest), or
+                    None if nothing matches"""
+        first = self._fetch(selector_list, None, 1)
+        if not first:
+            return None
+        known = first[0]["id"]
+        step = PROBE_STEP
+        while True:
+            bound = known + step
+            above = self._fetch(selector_list, bound, 1)
+            if not above:
+                return first[0]["id"], bound
+            known = above[0]["id"]
+            step *= 2
+
+    def _scan_range(self, selector_list, gt, leq, pages, closed):
+        """Put the pages of one range on the queue pages as (page, None),
+        then _END, or (None, exc_info) if a fetch fails. Stops once closed
+        is set."""
+        selector_list = list(selector_list) + [("id", Op.GT, gt),
+                                               ("id", Op.LEQ, leq)]
+        last_id = None
+        try:
+            while not closed.is_set():
+                page = self._fetch(selector_list, last_id, self.page_size)
+                if page and not _put(pages, (page, None), closed):
+                    return
+                if len(page) < self.page_size:
+                    break
+                last_id = page[-1]["id"]
+        except Exception:
+            _put(pages, (None, sys.exc_info()), closed)
+            return
+        _put(pages, _END, closed)
+
+    def scan(self, selector_list=(), ordered=True, min_id=None,
+             max_id=None):
+        """Iterate over all records matching selector_list.
+
+        @param ordered: yield the records in id order; otherwise each page
+                        is yielded as soon as it has been fetched
+        @param min_id, max_id: known bounds of the ids, to save the probes
+        """
+        if min_id is None or max_id is None:
+            bounds = self.id_bounds(selector_list)
+            if bounds is None:
+                return
+            min_id = bounds[0] if min_id is None else min_id
+            max_id = bounds[1] if max_id is None else max_id
+        ranges = id_ranges(min_id, max_id, self.ranges)
+        # One queue per range when ordered; otherwise all pages go to one.
+        if ordered:
+            queues = [Queue.Queue(PAGES_AHEAD) for _ in ranges]
+        else:
+            queues = ([Queue.Queue(PAGES_AHEAD * self.concurrency)]
+                      * len(ranges))
+        closed = threading.Event()
+        # The pool takes the ranges in order, so the one the caller waits
+        # for has always been started.
+        pool = ThreadPool(min(self.concurrency, len(ranges)))
+        try:
+            for (gt, leq), pages in zip(ranges, queues):
+                pool.apply_async(self._scan_range,
+                                 (selector_list, gt, leq, pages, closed))
+            done = 0
+            while done < len(ranges):
+                item = queues[done].get()
+                if item is _END:
+                    done += 1
+                    continue
+                page, exc_info = item
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                for record in page:
+                    yield record
+        finally:
+            closed.set()
+            pool.terminate()
+
+
+def _put(queue, item, closed):
+    """Queue item, unless closed is set first. @return: whether it was
+    queued"""
+    while not closed.is_set():
+        try:
+            queue.put(item, timeout=_POLL_SECONDS)
+            return True
+        except Queue.Full:
+            pass
+    return False
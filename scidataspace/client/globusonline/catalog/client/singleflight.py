@@ -0,0 +1,66 @@
+"""
+Coalescing of identical concurrent calls.
+
+When several threads ask for the same resource at the same time, e.g.
+the annotation definitions of a catalog during a parallel import, only the
+first one (the leader) makes the call; the others wait for it and get the
+same result, or the same exception. Nothing is kept once the call has
+finished, so this never serves stale data: it only removes duplicate round
+trips that overlap in time.
+"""
+import sys
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Thread-safe group of in-flight calls, keyed by the caller.
+
+    Callers that get a shared result receive the very same objects as the
+    leader, so they must not modify them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.call_count = 0
+        self.shared_count = 0
+
+    def do(self, key, fn):
+        """Call fn(), unless a call with the same key is already in flight,
+        in which case wait for that one and return its result.
+
+        @return: (result, shared), shared being True if the result came
+                 from another caller's call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.call_count += 1
+            else:
+                self.shared_count += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except:
+                call.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result, not leader
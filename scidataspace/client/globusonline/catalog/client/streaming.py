@@ -0,0 +1,166 @@
+"""
+Incremental JSON encoding of request bodies, so large batches (e.g. members
+created from a directory walk) can be sent with chunked transfer encoding
+without building the whole document in memory, and incremental decoding of
+JSON array responses, so callers can process list elements as they arrive.
+"""
+import re
+import json
+
+from globusonline.catalog.client.compression import gzip_chunks
+
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+def iterencode_array(items, encoder=None):
+    """Encode an iterable as a JSON array, yielding string fragments. Only
+    one item is encoded at a time, so items can be a generator.
+
+    >>> "".join(iterencode_array(x for x in [1, {"a": None}]))
+    '[1, {"a": null}]'
+    >>> "".join(iterencode_array([]))
+    '[]'
+    """
+    if encoder is None:
+        encoder = json.JSONEncoder()
+    yield "["
+    first = True
+    for item in items:
+        if first:
+            first = False
+        else:
+            yield ", "
+        for fragment in encoder.iterencode(item):
+            yield fragment
+    yield "]"
+
+
+_SKIP = re.compile(r"[\s,]*")
+
+
+def iterdecode_array(chunks, decoder=None):
+    """Decode a JSON array arriving as an iterable of string chunks,
+    yielding each element as soon as it is complete. Only the undecoded
+    remainder of the input is buffered.
+
+    >>> list(iterdecode_array(['[{"a": [1', ', 2]}, 1', '0, "x"', ']']))
+    [{u'a': [1, 2]}, 10, u'x']
+    >>> list(iterdecode_array(["  [ ", "]"]))
+    []
+    """
+    if decoder is None:
+        decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        pos = _SKIP.match(buf, pos).end()
+        if not started:
+            if pos < len(buf):
+                if buf[pos] != "[":
+                    raise ValueError("Expected JSON array, got %r"
+                                     % buf[pos:pos + 20])
+                started = True
+                pos += 1
+                continue
+        elif pos < len(buf):
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                item, end = None, None
+            # A value that runs up to the end of the buffer may be a
+            # truncated number, so wait for the next chunk to be sure.
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+        if eof:
+            raise ValueError("Unterminated JSON array")
+        try:
+            chunk = chunks.next()
+        except StopIteration:
+            eof = True
+            continue
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def rechunk(fragments, size=SEND_CHUNK_SIZE):
+    """Join small string fragments into chunks of roughly size bytes, to
+    avoid a write (and transfer encoding chunk) per fragment."""
+    buf = []
+    buf_len = 0
+    for fragment in fragments:
+        if isinstance(fragment, unicode):
+            fragment = fragment.encode("utf8")
+        buf.append(fragment)
+        buf_len += len(fragment)
+        if buf_len >= size:
+            yield "".join(buf)
+            buf = []
+            buf_len = 0
+    if buf_len:
+        yield "".join(buf)
+
+
+class StreamingBody(object):
+    """
+    Request body which is produced chunk by chunk while it is sent, using
+    chunked transfer encoding.
+
+    @param factory: callable returning an iterable of string fragments.
+                    It is called once per attempt.
+    @param replayable: False if the factory can only be iterated once
+                       (e.g. it consumes a generator); the request is then
+                       not retried, since the body can't be sent again.
+    @param compress: gzip the body, setting Content-Encoding.
+    """
+    def __init__(self, factory, replayable=True, compress=False):
+        self.factory = factory
+        self.replayable = replayable
+        self.compress = compress
+        if compress:
+            self.content_encoding = "gzip"
+        else:
+            self.content_encoding = None
+
+    def __iter__(self):
+        chunks = rechunk(self.factory())
+        if self.compress:
+            chunks = gzip_chunks(chunks)
+        return iter(chunks)
+
+
+def json_array_body(items, compress=False):
+    """StreamingBody encoding items as a JSON array. Lists and tuples can
+    be resent on retry; any other iterable is consumed by the first
+    attempt."""
+    replayable = isinstance(items, (list, tuple))
+    return StreamingBody(lambda: iterencode_array(items), replayable,
+                         compress)
+
+
+def send_chunked(conn, method, path, body, headers):
+    """Send a request with a StreamingBody on an httplib connection.
+
+    @return: number of body bytes sent, before transfer encoding
+    """
+    conn.putrequest(method, path, skip_accept_encoding=True)
+    for name, value in headers.iteritems():
+        conn.putheader(name, value)
+    conn.putheader("Transfer-Encoding", "chunked")
+    conn.endheaders()
+    sent = 0
+    for chunk in body:
+        if not chunk:
+            continue
+        conn.send("%x\r\n%s\r\n" % (len(chunk), chunk))
+        sent += len(chunk)
+    conn.send("0\r\n\r\n")
+    return sent
@@ -1,6 +1,8 @@
 """
-Testsuite for dataset client. Requires access to a dataset instance using
-the globusonline webauthn2 provider and a user that has admin rights.
+Testsuite for dataset client. Runs against a dataset instance using the
+globusonline webauthn2 provider and a user that has admin rights, or, when
+no token is given, against a local_server.LocalCatalogServer started for
+the run.
 
 Can be run with nose like this:
     export DATASET_CLIENT_TEST_GOAUTH_TOKEN=$(cat /path/to/token)
@@ -9,11 +11,58 @@ Can be run with nose like this:
     nosetests -v
 """
 import os
+import sys
+import gc
+import time
+import imp
+import json
 import uuid
+import weakref
+import shutil
+import tempfile
+import socket
+import httplib
 import unittest
+from multiprocessing.pool import ThreadPool
 
-from globusonline.catalog.client import dataset_client
-from globusonline.catalog.client.rest_client import RestClientError
+from globusonline.catalog.client import dataset_client, annotation_buffer, \
+    json_codec
+from globusonline.catalog.client.rest_client import RestClientError, \
+    RETRY_BASE_SECONDS
+from globusonline.catalog.client.instrumentation import RequestListener
+from globusonline.catalog.client.rate_limit import AdaptiveRateLimiter
+from globusonline.catalog.client.cassette import Recorder, \
+    ReplayTransport, CassetteMissError
+from globusonline.catalog.client.circuit_breaker import CircuitBreaker, \
+    CircuitOpenError
+from globusonline.catalog.client.local_server import LocalCatalogServer
+from globusonline.catalog.client.annotation_defs import AnnotationDefCache
+from globusonline.catalog.client.mirror import CatalogMirror, MemoryStore
+from globusonline.catalog.client.singleflight import SingleFlight
+from globusonline.catalog.client.connection_pool import ConnectionPool, \
+    PoolTimeoutError, connection_key
+from globusonline.catalog.client.paging import PageIterator
+from globusonline.catalog.client.scan import RangeScanner, PAGES_AHEAD
+from globusonline.catalog.client.operators import Op
+from globusonline.catalog.client.http_cache import ResponseCache
+from globusonline.catalog.client.async_dataset_client import \
+    AsyncDatasetClient, gather
+
+CONNECTION_ERRORS = (socket.error, httplib.HTTPException)
+
+
+class EventRecorder(RequestListener):
+    """Keeps the retry delays and circuit state changes a client
+    reports."""
+    def __init__(self):
+        self.retry_delays = []
+        self.circuit_states = []
+
+    def on_retry(self, event, delay):
+        self.retry_delays.append(delay)
+
+    def on_circuit_state(self, old, new):
+        self.circuit_states.append((old, new))
 
 
 class TestDatasetClient(unittest.TestCase):
@@ -29,9 +78,11 @@ class TestDatasetClient(unittest.TestCase):
                                   dataset_client.DEFAULT_BASE_URL)
         no_delete = os.environ.get("DATASET_CLIENT_TEST_NO_DELETE")
         cls.no_delete = bool(no_delete)
+        cls.server = None
         if goauth_token is None:
-            raise Exception("Missing required environment variable "
-                           +"DATASET_CLIENT_TEST_GOAUTH_TOKEN")
+            cls.server = LocalCatalogServer().start()
+            goauth_token = "un=tester|local"
+            base_url = cls.server.url
         print "base_url:", base_url
         cls.client = dataset_client.DatasetClient(goauth_token,
                                                   base_url=base_url)
@@ -144,6 +195,341 @@ class TestDatasetClient(unittest.TestCase):
         names2 = set(d["name"] for d in data)
         self.assertEqual(names2, names1 | set(["deftest space1"]))
 
+    def test_annotation_def_cache(self):
+        defs = AnnotationDefCache(self.client)
+        self.assertIn("data_uri", defs.get(self.catalog_id))
+        created = defs.ensure(self.catalog_id, ["data_uri", "defcache1",
+                                                "defcache2", "defcache1"])
+        self.assertEqual(created, ["defcache1", "defcache2"])
+        self.assertEqual(defs.ensure(self.catalog_id, ["defcache2"]), [])
+        self.assertEqual(defs.load_count, 1)
+        self.assertEqual(defs.get(self.catalog_id)["defcache1"],
+                         dict(name="defcache1", value_type="text",
+                              multivalued=True))
+
+        # Created behind the cache's back: found when creating it fails
+        self.client.create_annotation_def(self.catalog_id, "defcache3",
+                                          "text")
+        self.assertEqual(defs.ensure(self.catalog_id, ["defcache3"]), [])
+        self.assertEqual(defs.load_count, 2)
+        _, data = self.client.get_annotation_defs(self.catalog_id)
+        self.assertEqual(set(defs.get(self.catalog_id)),
+                         set(d["name"] for d in data))
+
+    def test_annotation_buffer_released(self):
+        # Only buffers with pending writes are kept for the flush at exit.
+        _, data = self.client.create_dataset(self.catalog_id,
+                                             dict(name="buffer"))
+        dataset_id = data["id"]
+        with self.client.annotation_buffer() as buf:
+            buf.add(self.catalog_id, dataset_id, {"name": "buffer1"})
+        ref = weakref.ref(buf)
+        del buf
+        gc.collect()
+        self.assertIsNone(ref())
+
+        buf = self.client.annotation_buffer()
+        buf.add(self.catalog_id, dataset_id, {"name": "buffer2"})
+        self.assertIn(buf, annotation_buffer._unflushed)
+        annotation_buffer._flush_all_at_exit()
+        self.assertNotIn(buf, annotation_buffer._unflushed)
+        _, data = self.client.get_dataset_annotations(self.catalog_id,
+                                                      dataset_id, ["name"])
+        self.assertEqual(data[0]["name"], "buffer2")
+
+    def test_member_annotations_shared(self):
+        # Concurrent identical reads share their response through
+        # SingleFlight; every caller must get complete records.
+        server = LocalCatalogServer(latency=0.05).start()
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              pool_size=4,
+                                              singleflight=SingleFlight())
+        try:
+            catalog_id = server.store.populate(datasets=1, members=20)
+            _, datasets = client.get_datasets(catalog_id)
+            dataset_id = datasets[0]["id"]
+            _, members = client.get_members(catalog_id, dataset_id)
+            member_ids = [m["id"] for m in members]
+
+            def read():
+                return list(client.iter_member_annotations(
+                    catalog_id, dataset_id, member_ids, ["name"],
+                    concurrency=1))
+            workers = ThreadPool(4)
+            try:
+                results = workers.map(lambda i: read(), range(4))
+            finally:
+                workers.terminate()
+            for result in results:
+                self.assertEqual([id for id, _ in result], member_ids)
+                self.assertEqual(result, results[0])
+            self.assertGreater(client.singleflight.shared_count, 0)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_member_annotations_long_names(self):
+        # More annotation names than fit in one URL, even for one member
+        names = ["long_%02d_%s" % (i, "x" * 100) for i in xrange(30)]
+        for name in names:
+            self.client.create_annotation_def(self.catalog_id, name, "text")
+        dataset_id = self._create_dataset("longnames", 3)
+        _, members = self.client.get_members(self.catalog_id, dataset_id)
+        member_ids = sorted(m["id"] for m in members)
+        for member_id in member_ids:
+            self.client.add_member_annotations(
+                self.catalog_id, dataset_id, member_id,
+                dict((name, "v") for name in names))
+
+        paths = []
+        request = self.client._request
+        def recording_request(method, path, *args, **kw):
+            paths.append(path)
+            return request(method, path, *args, **kw)
+        self.client._request = recording_request
+        try:
+            for member_list, annotation_list in ((None, None),
+                                                 (member_ids, None),
+                                                 (member_ids, names)):
+                result = list(self.client.iter_member_annotations(
+                    self.catalog_id, dataset_id, member_list,
+                    annotation_list))
+                self.assertEqual([id for id, _ in result], member_ids)
+                for _, record in result:
+                    self.assertEqual(dict((k, v) for k, v in record.items()
+                                          if k in names),
+                                     dict((name, "v") for name in names))
+        finally:
+            del self.client._request
+        self.assertLessEqual(max(len(self.client._base_path + path)
+                                 for path in paths),
+                             dataset_client.MAX_URL_LENGTH)
+
+    def test_async_client(self):
+        dataset_id = self._create_dataset("async", 3)
+        _, members = self.client.get_members(self.catalog_id, dataset_id)
+        member_ids = [m["id"] for m in members]
+        with AsyncDatasetClient(None, client=self.client) as async_client:
+            results = gather([async_client.get_members(self.catalog_id,
+                                                       dataset_id)
+                              for _ in xrange(3)])
+            self.assertEqual([[m["id"] for m in body]
+                              for _, body in results], [member_ids] * 3)
+            # Iterators are passed through, not run on a worker
+            pairs = async_client.iter_member_annotations(
+                self.catalog_id, dataset_id, member_ids, ["data_uri"])
+            self.assertEqual([id for id, _ in pairs], member_ids)
+        # The client passed in keeps its pooled connections
+        r, _ = self.client.get_catalogs()
+        self.assertEqual(r.stats.connect_time, 0.0)
+
+    def test_mirror(self):
+        mirror = CatalogMirror()
+        ds1_id = self._create_dataset("mirror1", 3)
+        result = mirror.sync(self.client, self.catalog_id, members=True)
+        self.assertTrue(result.full)
+        self.assertEqual([d["id"] for d in
+                          mirror.find_datasets(self.catalog_id, "mirror1")],
+                         [ds1_id])
+        self.assertEqual(len(list(mirror.members(self.catalog_id, ds1_id))),
+                         3)
+
+        # Later syncs fetch only the new records
+        ds2_id = self._create_dataset("mirror2", 2)
+        self.client.create_member(self.catalog_id, ds1_id,
+                                  dict(data_type="file", data_uri="m"))
+        result = mirror.sync(self.client, self.catalog_id, members=True)
+        self.assertFalse(result.full)
+        self.assertEqual((result.datasets, result.members), (1, 3))
+        self.assertEqual(len(list(mirror.members(self.catalog_id, ds1_id))),
+                         4)
+        self.assertEqual(mirror.dataset_ids(self.catalog_id, "mirror2"),
+                         [ds2_id])
+
+        # Deletions are seen by the next full sync
+        self.client.delete_dataset(self.catalog_id, ds2_id)
+        result = mirror.sync(self.client, self.catalog_id)
+        self.assertEqual(result.deleted, 0)
+        self.assertIsNotNone(mirror.dataset(self.catalog_id, ds2_id))
+        result = mirror.sync(self.client, self.catalog_id, full=True)
+        self.assertEqual(result.deleted, 1)
+        self.assertEqual(mirror.find_datasets(self.catalog_id, "mirror2"),
+                         [])
+        self.assertIn("mirror1", mirror.dataset_names(self.catalog_id,
+                                                      "mirror"))
+
+    def test_mirror_dataset_deleted_during_sync(self):
+        kept_id = self._create_dataset("mirrorkept", 2)
+        gone_id = self._create_dataset("mirrorgone", 2)
+        old_id = self._create_dataset("mirrorold", 2)
+        mirror = CatalogMirror()
+        mirror.sync(self.client, self.catalog_id, members=True)
+        self.client.delete_dataset(self.catalog_id, old_id)
+
+        # Deleted after the datasets were listed, before its members were
+        scan_datasets = self.client.scan_datasets
+        def scan_then_delete(*args, **kw):
+            datasets = list(scan_datasets(*args, **kw))
+            self.client.delete_dataset(self.catalog_id, gone_id)
+            return datasets
+        self.client.scan_datasets = scan_then_delete
+        try:
+            result = mirror.sync(self.client, self.catalog_id, full=True,
+                                 members=True)
+        finally:
+            del self.client.scan_datasets
+        self.assertEqual(result.deleted, 2)
+        for dataset_id in (gone_id, old_id):
+            self.assertIsNone(mirror.dataset(self.catalog_id, dataset_id))
+            self.assertEqual(list(mirror.members(self.catalog_id,
+                                                 dataset_id)), [])
+        self.assertEqual(mirror.find_datasets(self.catalog_id, "mirrorgone"),
+                         [])
+        self.assertEqual(len(list(mirror.members(self.catalog_id, kept_id))),
+                         2)
+
+    def _paged_dataset(self, name, num_members):
+        _, data = self.client.create_dataset(self.catalog_id,
+                                             dict(name=name))
+        dataset_id = data["id"]
+        self.client.create_members(self.catalog_id, dataset_id,
+            [dict(data_type=("file", "directory")[i % 2],
+                  data_uri="/%s/member%d" % (name, i))
+             for i in xrange(num_members)])
+        _, members = self.client.get_members(self.catalog_id, dataset_id)
+        return dataset_id, sorted(m["id"] for m in members)
+
+    def test_iter_members(self):
+        dataset_id, ids = self._paged_dataset("paged", 25)
+        for prefetch in (0, 2):
+            members = self.client.iter_members(self.catalog_id, dataset_id,
+                                               page_size=10,
+                                               prefetch=prefetch)
+            self.assertEqual([m["id"] for m in members], ids)
+            self.assertEqual(members.page_count, 3)
+
+        # A full last page takes one more, empty, page to end
+        members = self.client.iter_members(self.catalog_id, dataset_id,
+                                           page_size=5)
+        self.assertEqual(len(list(members)), 25)
+        self.assertEqual(members.page_count, 6)
+
+        # Closing early stops the prefetching
+        members = self.client.iter_members(self.catalog_id, dataset_id,
+                                           page_size=5, prefetch=2)
+        self.assertEqual(members.next()["id"], ids[0])
+        members.close()
+        self.assertEqual(list(members), [])
+        self.assertLess(members.page_count, 5)
+
+        # Listing a dataset that does not exist fails on the first page
+        members = self.client.iter_members(self.catalog_id, ids[-1] + 1000)
+        try:
+            members.next()
+        except RestClientError as e:
+            self.assertEqual(e.response.status, 404)
+        else:
+            assert False, "expected error, got success"
+        self.assertEqual(list(members), [])
+
+    def test_iter_members_page_error(self):
+        # A page that fails to load is raised when the caller reaches it,
+        # after the records of the pages before it.
+        server = LocalCatalogServer().start()
+        client = dataset_client.DatasetClient("un=tester|local", server.url)
+        try:
+            catalog_id = server.store.populate(datasets=1, members=25)
+            _, datasets = client.get_datasets(catalog_id)
+            dataset_id = datasets[0]["id"]
+            def fetch_page(last_id, limit):
+                if last_id is not None:
+                    server.error_rate = 1.0
+                _, members = client.get_members(catalog_id, dataset_id,
+                                                last_id, limit)
+                return members
+            members = PageIterator(fetch_page, 10)
+            for _ in xrange(10):
+                members.next()
+            try:
+                members.next()
+            except RestClientError as e:
+                self.assertEqual(e.response.status, 503)
+            else:
+                assert False, "expected error, got success"
+            self.assertEqual(members.page_count, 1)
+            self.assertEqual(list(members), [])
+        finally:
+            client.close()
+            server.stop()
+
+    def test_scan_members(self):
+        dataset_id, ids = self._paged_dataset("scanned", 30)
+        for ordered in (True, False):
+            members = list(self.client.scan_members(
+                self.catalog_id, dataset_id, concurrency=3, ordered=ordered,
+                page_size=4))
+            member_ids = [m["id"] for m in members]
+            if ordered:
+                self.assertEqual(member_ids, ids)
+            else:
+                self.assertEqual(sorted(member_ids), ids)
+
+        files = list(self.client.scan_members(
+            self.catalog_id, dataset_id, [("data_type", Op.EQUAL, "file")],
+            concurrency=3, page_size=4))
+        self.assertEqual([m["id"] for m in files], ids[::2])
+
+    def test_scan_pages(self):
+        dataset_id, ids = self._paged_dataset("scanpages", 30)
+        calls = []
+        def fetch_page(selector_list, last_id, limit):
+            calls.append(last_id)
+            if len(calls) == fail_at[0]:
+                raise ValueError("page %d" % len(calls))
+            _, members = self.client.get_members(self.catalog_id, dataset_id,
+                                                 last_id, limit,
+                                                 selector_list)
+            return members
+
+        # Records come as their pages arrive, not once a range is read
+        fail_at = [None]
+        scanner = RangeScanner(fetch_page, concurrency=4, page_size=2,
+                               ranges=1)
+        records = scanner.scan(min_id=ids[0], max_id=ids[-1])
+        self.assertEqual(records.next()["id"], ids[0])
+        self.assertLessEqual(scanner.request_count, PAGES_AHEAD + 2)
+        records.close()
+
+        # Every request is counted, from all workers
+        del calls[:]
+        scanner = RangeScanner(fetch_page, concurrency=4, page_size=2)
+        self.assertEqual([m["id"] for m in scanner.scan()], ids)
+        self.assertEqual(scanner.request_count, len(calls))
+
+        # A failed page is raised after the records before it
+        fail_at = [3]
+        del calls[:]
+        records = RangeScanner(fetch_page, concurrency=1, page_size=2,
+                               ranges=1).scan(min_id=ids[0], max_id=ids[-1])
+        self.assertEqual([records.next()["id"] for _ in xrange(4)], ids[:4])
+        self.assertRaises(ValueError, records.next)
+
+    def test_scan_id_bounds(self):
+        dataset_id, ids = self._paged_dataset("bounds", 5)
+        def fetch_page(selector_list, last_id, limit):
+            _, members = self.client.get_members(self.catalog_id, dataset_id,
+                                                 last_id, limit,
+                                                 selector_list)
+            return members
+        scanner = RangeScanner(fetch_page)
+        low, high = scanner.id_bounds()
+        self.assertEqual(low, ids[0])
+        self.assertGreaterEqual(high, ids[-1])
+        # One request for the lowest id, one probe above it
+        self.assertEqual(scanner.request_count, 2)
+        self.assertIsNone(scanner.id_bounds(
+            [("data_uri", Op.EQUAL, "/nothing")]))
+
     def test_dataset_annotation(self):
         self.client.create_annotation_def(self.catalog_id, "testdstext1",
                                           "text")
@@ -387,6 +773,459 @@ class TestDatasetClient(unittest.TestCase):
         else:
             assert False, "expected error, got success"
 
+    def _bulk_members(self, name, count, bad=()):
+        # The server creates all members of a request or none; members with
+        # an undefined annotation make it reject the whole request.
+        members = []
+        for i in xrange(count):
+            member = dict(data_type="file",
+                          data_uri="/%s/member%d" % (name, i))
+            if i in bad:
+                member["undefined_annotation"] = "x"
+            members.append(member)
+        return members
+
+    def test_create_members_bulk(self):
+        _, data = self.client.create_dataset(self.catalog_id,
+                                             dict(name="bulk"))
+        dataset_id = data["id"]
+        members = self._bulk_members("bulk", 25, bad=(3, 17))
+        result = self.client.create_members_bulk(self.catalog_id, dataset_id,
+                                                 members, chunk_size=10)
+        self.assertFalse(result.ok)
+        self.assertEqual(sorted(result.errors), [3, 17])
+        for error in result.errors.values():
+            self.assertEqual(error.response.status, 409)
+        # Two rejected chunks were split down to the bad members.
+        self.assertGreater(result.request_count, 3)
+        _, created = self.client.get_members(self.catalog_id, dataset_id)
+        self.assertEqual(sorted(m["id"] for m in created),
+                         sorted(result.ids.values()))
+        self.assertEqual(set(m["data_uri"] for m in created),
+                         set(members[i]["data_uri"] for i in result.ids))
+
+    def test_create_members_bulk_retries(self):
+        # 503s are retried; a reset connection may have created the chunk,
+        # so it is reported instead of posted again.
+        server = LocalCatalogServer(retry_after=0).start()
+        client = dataset_client.DatasetClient("un=tester|local", server.url)
+        try:
+            catalog_id = server.store.populate(datasets=1, members=0)
+            _, datasets = client.get_datasets(catalog_id)
+            dataset_id = datasets[0]["id"]
+            server.error_rate = 1.0
+            result = client.create_members_bulk(
+                catalog_id, dataset_id, self._bulk_members("retry", 4), chunk_size=2,
+                max_attempts=2)
+            self.assertEqual(len(result.errors), 4)
+            self.assertEqual(result.request_count, 4)
+
+            server.error_rate = 0.0
+            server.reset_rate = 1.0
+            result = client.create_members_bulk(
+                catalog_id, dataset_id, self._bulk_members("reset", 4), chunk_size=2,
+                max_attempts=2)
+            self.assertEqual(len(result.errors), 4)
+            self.assertEqual(result.request_count, 2)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_add_member_directory(self):
+        try:
+            from scidataspace.client.commands.add_member import \
+                parse_cmd_add_member
+            from scidataspace.client.commands.util import SafeList
+        except ImportError:
+            self.skipTest("scidataspace.client is not on the path")
+        folder = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(folder, "sub"))
+            for name in ("a", os.path.join("sub", "b")):
+                open(os.path.join(folder, name), "w").close()
+            _, data = self.client.create_dataset(self.catalog_id,
+                                                 dict(name="add_member"))
+            dataset_id = data["id"]
+            db = MemoryStore()
+            parse_cmd_add_member(SafeList(["--add_member", folder]),
+                                 self.catalog_id, dataset_id, self.client,
+                                 db)
+            _, created = self.client.get_members(self.catalog_id, dataset_id)
+            self.assertEqual(len(created), 4)
+            for member in created:
+                self.assertEqual(db.Get("member." + member["data_uri"]),
+                                 str(member["id"]))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_cli_create_members(self):
+        try:
+            cli = imp.load_source("catalog_cli", os.path.join(
+                os.path.dirname(dataset_client.__file__), "cli",
+                "catalog.py"))
+        except ImportError as e:
+            self.skipTest("cannot load the CLI: %s" % e)
+        cli.client = self.client
+        cli.show_output = False
+        _, data = self.client.create_dataset(self.catalog_id,
+                                             dict(name="cli_members"))
+        dataset_id = data["id"]
+        members = self._bulk_members("cli", 3)
+        self.assertTrue(cli.create_members([self.catalog_id, dataset_id,
+                                            json.dumps(members)]))
+        self.assertFalse(cli.create_members(
+            [self.catalog_id, dataset_id,
+             json.dumps(self._bulk_members("clibad", 2, bad=(1,)))]))
+        _, created = self.client.get_members(self.catalog_id, dataset_id)
+        self.assertEqual(sorted(m["data_uri"] for m in created),
+                         ["/cli/member0", "/cli/member1", "/cli/member2",
+                          "/clibad/member0"])
+
+    def test_stream_expected_status(self):
+        # A streamed response with another status than expected is an
+        # error, just like a read one.
+        for stream in (False, True):
+            try:
+                self.client._request("GET", "/catalog", expected_status=201,
+                                     stream=stream)
+            except RestClientError as e:
+                self.assertEqual(e.response.status, 200)
+                self.assertEqual(e.expected_status, 201)
+            else:
+                assert False, "expected error, got success"
+
+    def test_http_cache(self):
+        server = LocalCatalogServer().start()
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              cache=ResponseCache())
+        try:
+            # Catalogs whose ids start the same, like 1 and 10
+            catalog_ids = [client.create_catalog(name="cache%d" % i)[1]["id"]
+                           for i in xrange(10)]
+            written, other = min(catalog_ids), max(catalog_ids)
+            self.assertTrue(str(other).startswith(str(written)))
+            listings = {}
+            for catalog_id in (written, other):
+                client.create_dataset(catalog_id, dict(name="cached"))
+                r, listings[catalog_id] = client.get_datasets(catalog_id)
+                self.assertFalse(r.from_cache)
+            r, cached = client.get_datasets(written)
+            self.assertTrue(r.from_cache)
+            self.assertEqual(r.status, 304)
+            self.assertEqual(cached, listings[written])
+            self.assertEqual((client.cache.hits, client.cache.misses), (1, 2))
+
+            # A write invalidates the catalog's entries, and only its own
+            client.create_dataset(written, dict(name="cached2"))
+            r, datasets = client.get_datasets(written)
+            self.assertFalse(r.from_cache)
+            self.assertEqual(len(datasets), 2)
+            r, _ = client.get_datasets(other)
+            self.assertTrue(r.from_cache)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_stream_parse(self):
+        # Streamed listings decode to the same records as read ones, and
+        # hand their connection back to the pool once consumed.
+        server = LocalCatalogServer().start()
+        pool = ConnectionPool(max_size=1)
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              pool=pool)
+        key = connection_key(False, *server.server_address)
+        try:
+            catalog_id = server.store.populate(datasets=3, members=300)
+            _, datasets = client.get_datasets(catalog_id)
+            _, stream = client.get_datasets(catalog_id, stream=True)
+            self.assertEqual(pool.idle_count(key), 0)
+            self.assertEqual(list(stream), datasets)
+            self.assertEqual(pool.idle_count(key), 1)
+
+            dataset_id = datasets[0]["id"]
+            _, members = client.get_members(catalog_id, dataset_id,
+                                            limit=1000)
+            self.assertEqual(len(members), 300)
+            _, stream = client.get_members(catalog_id, dataset_id,
+                                           limit=1000, stream=True)
+            self.assertEqual(list(stream), members)
+            self.assertEqual(pool.idle_count(key), 1)
+            self.assertEqual(pool.created_count, 1)
+
+            # Closing a stream early discards its connection
+            _, stream = client.get_members(catalog_id, dataset_id,
+                                           limit=1000, stream=True)
+            self.assertEqual(stream.next(), members[0])
+            stream.close()
+            self.assertEqual(pool.idle_count(key), 0)
+            self.assertEqual(pool.size(key), 0)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_json_codec_fallback(self):
+        saved_codec = json_codec.get_codec()
+        saved_env = os.environ.get("GDCLIENT_JSON_CODEC")
+        saved_ujson = sys.modules.get("ujson")
+        sys.modules["ujson"] = None  # makes import ujson fail
+        fallback = json_codec.available_codecs()[0].name
+        try:
+            self.assertNotEqual(fallback, "ujson")
+            for name, expected in (("json", "json"), ("ujson", fallback),
+                                   ("bogus", fallback)):
+                os.environ["GDCLIENT_JSON_CODEC"] = name
+                self.assertEqual(json_codec._default_codec().name, expected)
+
+            self.assertRaises(ValueError, json_codec.set_codec, "bogus")
+            self.assertEqual(json_codec.get_codec(), saved_codec)
+            json_codec.set_codec("json")
+            record = {"name": u"caf\xe9", "size": 0.1 + 0.2, "tags": [1]}
+            self.assertEqual(json_codec.loads(json_codec.dumps(record)),
+                             record)
+            _, catalogs = self.client.get_catalogs()
+            self.assertIn(self.catalog_id, [c["id"] for c in catalogs])
+        finally:
+            json_codec.set_codec(saved_codec)
+            if saved_env is None:
+                os.environ.pop("GDCLIENT_JSON_CODEC", None)
+            else:
+                os.environ["GDCLIENT_JSON_CODEC"] = saved_env
+            if saved_ujson is None:
+                del sys.modules["ujson"]
+            else:
+                sys.modules["ujson"] = saved_ujson
+
+    def test_connection_pool(self):
+        server = LocalCatalogServer(latency=0.1).start()
+        pool = ConnectionPool(max_size=2)
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              pool=pool)
+        key = connection_key(False, *server.server_address)
+        try:
+            # Four concurrent calls share two connections, two at a time
+            workers = ThreadPool(4)
+            start = time.time()
+            try:
+                workers.map(lambda i: client.get_catalogs(), range(4))
+            finally:
+                workers.terminate()
+            self.assertGreaterEqual(time.time() - start, 0.2)
+            self.assertEqual((pool.created_count, pool.reused_count), (2, 2))
+            self.assertEqual(pool.idle_count(key), 2)
+
+            r, _ = client.get_catalogs()
+            self.assertEqual(r.stats.connect_time, 0.0)
+            self.assertEqual(pool.created_count, 2)
+
+            # With every connection checked out, callers wait for one
+            pool.checkout_timeout = 0.05
+            held = [pool.checkout(key) for _ in xrange(2)]
+            try:
+                self.assertRaises(PoolTimeoutError, client.get_catalogs)
+            finally:
+                for pconn in held:
+                    pool.checkin(pconn)
+            client.get_catalogs()
+        finally:
+            client.close()
+            server.stop()
+
+    def test_stale_connection(self):
+        # The server closes connections idle for 0.1s
+        server = LocalCatalogServer(idle_timeout=0.1).start()
+        pool = ConnectionPool()
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              pool=pool)
+        try:
+            client.get_catalogs()
+            time.sleep(0.3)
+            # The probe finds it closed before a request is sent on it
+            r, _ = client.get_catalogs()
+            self.assertGreater(r.stats.connect_time, 0.0)
+            self.assertEqual(pool.stale_count, 1)
+            self.assertEqual(client.stale_request_count, 0)
+            self.assertEqual(server.request_count, 2)
+
+            # Without the probe the request goes out on the closed
+            # connection, fails and is sent again on a new one
+            pool.health_check = None
+            time.sleep(0.3)
+            client.get_catalogs()
+            self.assertEqual(client.stale_request_count, 1)
+            self.assertEqual(pool.stale_count, 1)
+        finally:
+            client.close()
+            server.stop()
+
+    def _assert_503(self, fn, *args):
+        try:
+            fn(*args)
+        except RestClientError as e:
+            self.assertEqual(e.response.status, 503)
+        else:
+            assert False, "expected error, got success"
+
+    def test_retry_delays(self):
+        server = LocalCatalogServer(error_rate=1.0, retry_after=1).start()
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              max_attempts=2)
+        events = EventRecorder()
+        client.add_listener(events)
+        try:
+            # The server's Retry-After is honoured
+            start = time.time()
+            self._assert_503(client.get_catalogs)
+            self.assertGreaterEqual(time.time() - start, 1.0)
+            self.assertEqual(events.retry_delays, [1.0])
+            self.assertEqual(server.request_count, 2)
+
+            # unless waiting would pass the deadline
+            client.retry_deadline = 0.5
+            self._assert_503(client.get_catalogs)
+            self.assertEqual(events.retry_delays, [1.0])
+            self.assertEqual(server.request_count, 3)
+
+            # Without Retry-After, jittered exponential backoff
+            server.retry_after = None
+            client.retry_deadline = None
+            client.max_attempts = 3
+            del events.retry_delays[:]
+            self._assert_503(client.get_catalogs)
+            self.assertEqual(server.request_count, 6)
+            self.assertEqual(len(events.retry_delays), 2)
+            for attempt, delay in enumerate(events.retry_delays):
+                self.assertTrue(
+                    0 <= delay <= RETRY_BASE_SECONDS * 2 ** attempt)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_rate_limiter(self):
+        server = LocalCatalogServer(error_rate=1.0).start()
+        limiter = AdaptiveRateLimiter(rate=10, cooldown=0)
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              max_attempts=1,
+                                              rate_limiter=limiter)
+        try:
+            # Each 503 halves the rate
+            self._assert_503(client.get_catalogs)
+            self._assert_503(client.get_catalogs)
+            self.assertEqual(limiter.throttle_count, 2)
+            self.assertEqual(limiter.rate, 2.5)
+
+            # and the bucket paces the requests that follow
+            server.error_rate = 0.0
+            for i in xrange(3):
+                client.get_catalogs()
+            self.assertGreater(limiter.wait_time, 0.5)
+
+            # Successes raise it again
+            self.assertEqual(limiter.throttle_count, 2)
+            self.assertGreater(limiter.rate, 2.5)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_circuit_breaker(self):
+        server = LocalCatalogServer(error_rate=1.0).start()
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              max_attempts=1,
+                                              circuit_breaker=breaker)
+        events = EventRecorder()
+        client.add_listener(events)
+        try:
+            self._assert_503(client.get_catalogs)
+            self._assert_503(client.get_catalogs)
+            self.assertEqual(events.circuit_states, [("closed", "open")])
+
+            # Fail fast without reaching the server
+            self.assertRaises(CircuitOpenError, client.get_catalogs)
+            self.assertEqual(server.request_count, 2)
+
+            # A failed probe re-opens the circuit
+            time.sleep(0.25)
+            self._assert_503(client.get_catalogs)
+            self.assertEqual(breaker.state, "open")
+            self.assertRaises(CircuitOpenError, client.get_catalogs)
+
+            # and a successful one closes it
+            server.error_rate = 0.0
+            time.sleep(0.25)
+            client.get_catalogs()
+            self.assertEqual(breaker.state, "closed")
+            self.assertEqual(server.request_count, 4)
+            self.assertEqual(events.circuit_states,
+                             [("closed", "open"), ("open", "half_open"),
+                              ("half_open", "open"), ("open", "half_open"),
+                              ("half_open", "closed")])
+        finally:
+            client.close()
+            server.stop()
+
+    def test_cassette(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "session.cassette")
+        server = LocalCatalogServer().start()
+        recorder = Recorder(path)
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              recorder=recorder)
+        try:
+            catalog_id = server.store.populate(datasets=2, members=10)
+            _, datasets = client.get_datasets(catalog_id)
+            dataset_id = datasets[0]["id"]
+            _, members = client.get_members(catalog_id, dataset_id)
+            self.assertEqual(recorder.count, 2)
+        finally:
+            client.close()
+            recorder.close()
+            server.stop()
+
+        # Replay needs no server
+        transport = ReplayTransport(path, speed=None)
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              pool=transport.pool())
+        try:
+            self.assertEqual(client.get_datasets(catalog_id)[1], datasets)
+            self.assertEqual(client.get_members(catalog_id, dataset_id)[1],
+                             members)
+            # Once used up, the last recording is served again
+            self.assertEqual(client.get_datasets(catalog_id)[1], datasets)
+            self.assertEqual(transport.served_count, 3)
+            self.assertEqual(transport.repeat_count, 1)
+            self.assertRaises(CassetteMissError, client.get_members,
+                              catalog_id, datasets[1]["id"])
+        finally:
+            client.close()
+            shutil.rmtree(folder)
+
+    def test_retry_only_unsent_post(self):
+        # A reset connection may have been acted on: a POST is not resent,
+        # a GET is. A 503 was not acted on, so a POST is retried too.
+        server = LocalCatalogServer(reset_rate=1.0).start()
+        client = dataset_client.DatasetClient("un=tester|local", server.url,
+                                              max_attempts=3)
+        try:
+            self.assertRaises(CONNECTION_ERRORS, client.create_dataset, 1,
+                              dict(name="x"))
+            self.assertEqual(server.request_count, 1)
+            self.assertRaises(CONNECTION_ERRORS, client.get_catalogs)
+            self.assertGreater(server.request_count, 2)
+            server.request_count = 0
+            server.reset_rate = 0.0
+            server.error_rate = 1.0
+            server.retry_after = 0
+            try:
+                client.create_catalog(config=dict(name="x"))
+            except RestClientError as e:
+                self.assertEqual(e.response.status, 503)
+            else:
+                assert False, "expected error, got success"
+            self.assertEqual(server.request_count, 3)
+        finally:
+            client.close()
+            server.stop()
+
     @classmethod
     def tearDownClass(cls):
         if cls.no_delete:
@@ -394,3 +1233,5 @@ class TestDatasetClient(unittest.TestCase):
                                                     cls.catalog_id)
         else:
             cls.client.delete_catalog(cls.catalog_id)
+        if cls.server is not None:
+            cls.server.stop()
@@ -0,0 +1,129 @@
+"""
+TLS connection setup shared by the REST clients.
+
+Each call to ssl.wrap_socket builds a new SSL context and parses the CA
+bundle again before the handshake even starts. Connections made here use
+one context per configuration for the whole process instead, and time the
+TCP connect and the TLS handshake separately (tcp_connect_time and
+handshake_time on the connection), so handshake cost shows up in the
+request statistics.
+
+Where the ssl module supports it (ssl.SSLSession), the session of the last
+handshake with each host is also kept and offered on the next connect, so
+reconnects can resume it with an abbreviated handshake. The Python 2 ssl
+module has no session API, so there every connect does a full handshake.
+"""
+import ssl
+import time
+import socket
+import httplib
+import threading
+
+RESUMPTION_SUPPORTED = hasattr(ssl, "SSLSession")
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def get_context(ca_certs=None, key_file=None, cert_file=None):
+    """Get the process wide SSLContext for the given configuration,
+    creating it on first use. Without ca_certs the default trust store is
+    used and the host name is checked during the handshake; with ca_certs
+    the certificate is verified against them and the caller checks the
+    host name."""
+    key = (ca_certs, key_file, cert_file)
+    with _contexts_lock:
+        context = _contexts.get(key)
+        if context is None:
+            if ca_certs is None:
+                context = ssl.create_default_context()
+            else:
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(ca_certs)
+            if cert_file is not None:
+                context.load_cert_chain(cert_file, key_file)
+            _contexts[key] = context
+        return context
+
+
+class SessionCache(object):
+    """Last TLS session per (host, port), for resumption."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+        self.resumed_count = 0
+        self.full_count = 0
+
+    def get(self, key):
+        with self._lock:
+            return self._sessions.get(key)
+
+    def put(self, key, session, reused):
+        with self._lock:
+            if session is not None:
+                self._sessions[key] = session
+            if reused:
+                self.resumed_count += 1
+            else:
+                self.full_count += 1
+
+
+default_session_cache = SessionCache()
+
+
+def handshake(context, sock, server_hostname, port, session_cache=None):
+    """Wrap a connected socket and perform the TLS handshake, resuming a
+    cached session for server_hostname if possible.
+
+    @return: (ssl_socket, handshake seconds, session_reused)
+    """
+    if session_cache is None:
+        session_cache = default_session_cache
+    kw = {}
+    key = (server_hostname, port)
+    if RESUMPTION_SUPPORTED:
+        session = session_cache.get(key)
+        if session is not None:
+            kw["session"] = session
+    ssl_sock = context.wrap_socket(sock, server_hostname=server_hostname,
+                                   do_handshake_on_connect=False, **kw)
+    t = time.time()
+    ssl_sock.do_handshake()
+    elapsed = time.time() - t
+    if RESUMPTION_SUPPORTED:
+        reused = ssl_sock.session_reused
+        session_cache.put(key, ssl_sock.session, reused)
+    else:
+        reused = False
+        session_cache.put(key, None, False)
+    return ssl_sock, elapsed, reused
+
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    """
+    httplib.HTTPSConnection using the shared default context, which
+    verifies the server certificate and host name, with the connect and
+    handshake timed separately.
+    """
+    def __init__(self, host, port=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 context=None, session_cache=None):
+        if context is None:
+            context = get_context()
+        httplib.HTTPSConnection.__init__(self, host, port, timeout=timeout,
+                                         context=context)
+        self.session_cache = session_cache
+        self.tcp_connect_time = 0.0
+        self.handshake_time = 0.0
+        self.session_reused = False
+
+    def connect(self):
+        t = time.time()
+        # Opens the TCP connection and sets up any proxy tunnel.
+        httplib.HTTPConnection.connect(self)
+        self.tcp_connect_time = time.time() - t
+        server_hostname = self._tunnel_host or self.host
+        self.sock, self.handshake_time, self.session_reused = handshake(
+            self._context, self.sock, server_hostname,
+            self._tunnel_port or self.port, self.session_cache)
@@ -25,9 +25,12 @@ import socket
 import ssl
 import os
 import re
+import time
 from httplib import HTTPSConnection
 from urlparse import urlsplit
 
+from globusonline.catalog.client.tls import get_context, handshake
+
 
 __all__ = ["VerifiedHTTPSConnection"]
 
@@ -81,21 +84,28 @@ class VerifiedHTTPSConnection(HTTPSConnection):
                 self._set_tunnel(real_host, real_port)
 
         self.ca_certs = ca_certs
+        self.tcp_connect_time = 0.0
+        self.handshake_time = 0.0
+        self.session_reused = False
 
     def connect(self):
         """
-        Identical to the standard library version except for the addition
-        of the cert_reqs and ca_certs arguments to ssl.wrap_socket.
+        Like the standard library version, but requires a server
+        certificate signed by one of ca_certs. The SSL context is shared
+        between connections (see the tls module), and the TCP connect and
+        the handshake are timed separately.
         """
+        t = time.time()
         sock = socket.create_connection((self.host, self.port), self.timeout)
-        if hasattr(self, "_tunnel_host") and self._tunnel_host:
+        tunnel_host = getattr(self, "_tunnel_host", None)
+        if tunnel_host:
             self.sock = sock
             self._tunnel()
-        self.sock = ssl.wrap_socket(sock,
-                                    self.key_file,
-                                    self.cert_file,
-                                    cert_reqs=ssl.CERT_REQUIRED,
-                                    ca_certs=self.ca_certs)
+        self.tcp_connect_time = time.time() - t
+        context = get_context(self.ca_certs, self.key_file, self.cert_file)
+        self.sock, self.handshake_time, self.session_reused = handshake(
+            context, sock, tunnel_host or self.host,
+            getattr(self, "_tunnel_port", None) or self.port)
 
         match_hostname(self.sock.getpeercert(), self.host)
 
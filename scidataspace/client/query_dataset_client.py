@@ -70,18 +70,22 @@ def get_catalog_by_name(client, name=".*"):
      return selected_catalog
 
 ###
-#   Returns a list with last 5 datasets, having different names
+#   Returns a list with last 5 datasets, having different names;
+#   read from the catalog mirror if one is given
 ##
-def get_last_datasets(client, catalog_id, how_many=5):
-    _, dataset = client.get_datasets(catalog_id)
-    newlist = sorted(dataset, key=lambda k: k['id'], reverse=True)
+def get_last_datasets(client, catalog_id, how_many=5, mirror=None):
+    if mirror is not None:
+        datasets = mirror.datasets(catalog_id)
+    else:
+        datasets = client.iter_datasets(catalog_id, projection_list=["name"])
+    newlist = sorted(((ds['id'], ds['name']) for ds in datasets), reverse=True)
 
     count = 0
     result = []
-    for i in newlist:
-        if i['name'] in result:
+    for _, name in newlist:
+        if name in result:
             continue
-        result.append(i['name'])
+        result.append(name)
         count +=1
         if count>how_many-1:
             break
@@ -11,7 +11,8 @@ setup(name="globusonline-catalog-api-client",
                 "globusonline.catalog",
                 "globusonline.catalog.client",
                 "globusonline.catalog.client.ca",
-                "globusonline.catalog.client.examples"],
+                "globusonline.catalog.client.examples",
+                "globusonline.catalog.client.benchmark"],
       package_data={ "globusonline.catalog.client": ["ca/*.pem"] },
       scripts = ["globusonline/catalog/client/cli/catalog.py"],
       keywords = ["globusonline"],
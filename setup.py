@@ -15,6 +15,7 @@ setup(name="scidataspace-sciunit-client",
                 "scidataspace.client.globusonline.catalog.client",
                 "scidataspace.client.globusonline.catalog.client.ca",
                 "scidataspace.client.globusonline.catalog.client.examples",
+                "scidataspace.client.globusonline.catalog.client.benchmark",
 		"scidataspace.client.commands"],
       package_data={
       		"scidataspace.client":[".gdclient/*"],